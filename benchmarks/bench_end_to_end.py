@@ -0,0 +1,510 @@
+# benchmarks/bench_end_to_end.py
+"""Сквозной нагрузочный тест: вебхук -> обработка -> ответ пользователю.
+
+Бот поднимается из init_app в этом процессе, а Telegram Bot API и YandexGPT заменяет
+локальная заглушка в отдельном процессе, чтобы ее работа не попадала в event loop бота.
+Задержки заглушки распределены логнормально (медиана и разброс задаются), часть ответов
+YandexGPT можно сделать ошибками 500 и 429. Генератор отправляет синтетические Update
+с заголовком X-Telegram-Bot-Api-Secret-Token с заданной частотой; каждое обновление - от
+нового пользователя, поэтому время до ответа однозначно (первый sendMessage в этот чат).
+С --polling бот работает в режиме UPDATE_MODE=polling: генератор кладет обновления
+в очередь заглушки, а бот забирает их через getUpdates (long polling с offset, как Telegram).
+
+Считаются: пропускная способность, задержка подтверждения вебхука, время до ответа
+(p50/p90/p99), прирост памяти процесса (RSS) и задержка event loop. Результат пишется
+в JSON, чтобы сравнивать версии между собой.
+
+Лимиты запросов бота (MAX_REQUESTS_PER_MINUTE, GLOBAL_RATE_LIMIT) по умолчанию снимаются,
+иначе тест упрется в них; --keep-limits оставляет боевые значения. Остальные настройки
+бота (OUTBOUND_GLOBAL_RATE, LLM_MAX_CONCURRENCY и т.д.) берутся из окружения как обычно.
+
+Запуск: python benchmarks/bench_end_to_end.py --rate 20 --duration 30 --output e2e.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import itertools
+from collections import deque
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector  # noqa: E402
+
+BOT_TOKEN = "123456:BENCHMARK-token"
+WEBHOOK_SECRET = "benchmark-secret"
+YANDEX_PATH = "/foundationModels/v1/completion"
+
+# Вопросы, которые уходят в LLM; номер делает вопрос уникальным и исключает кэш ответов
+LLM_QUESTIONS = [
+    "Подскажите, как ухаживать за кузовом после нанесения керамики, машине {n} лет?",
+    "Что лучше для кроссовера {n} года выпуска: керамика или защитная пленка?",
+    "Можно ли убрать разводы на стекле после мойки, если машина стоит на улице {n} дней?",
+    "Как часто нужно обновлять защиту кузова при пробеге {n} тысяч км в год?",
+]
+# Частые вопросы, на которые бот отвечает без LLM
+FAQ_QUESTIONS = [
+    "Сколько стоит полировка?",
+    "Какой у вас адрес?",
+    "Во сколько вы открываетесь?",
+]
+
+ANSWER_LINES = [
+    "Здравствуйте! Спасибо за вопрос.",
+    "1. Мойка: используйте только нейтральные шампуни без воска.",
+    "2. Сушка: микрофибра с длинным ворсом, без нажима.",
+    "- Первые две недели избегайте автоматических моек.",
+    "- Раз в полгода делайте профилактический осмотр покрытия.",
+    "Стоимость: обслуживание покрытия от 3 000 ₽.",
+    "Если появятся царапины или скол, приезжайте на диагностику.",
+]
+
+def percentiles(values, scale=1000.0):
+    values = sorted(values)
+    if not values:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None, 'count': 0}
+
+    def pick(fraction):
+        return round(values[min(len(values) - 1, int(len(values) * fraction))] * scale, 1)
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': round(values[-1] * scale, 1), 'count': len(values)}
+
+def lognormal_delay(rng, median_ms, sigma):
+    if median_ms <= 0:
+        return 0.0
+    return median_ms * math.exp(sigma * rng.gauss(0, 1)) / 1000
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def rss_bytes():
+    """Текущий RSS процесса; без /proc - пиковый RSS"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# ==================== ЗАГЛУШКА TELEGRAM И YANDEXGPT ====================
+
+class FakeServices:
+    """Telegram Bot API и YandexGPT в одном aiohttp-приложении (запускается в отдельном процессе)"""
+
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.first_answer = {}  # chat_id -> время первого sendMessage (time.monotonic)
+        self.methods = {}
+        self.llm = {'requests': 0, 'errors_500': 0, 'errors_429': 0, 'streams': 0}
+        self.message_id = 0
+        self.webhook = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        self.updates = deque()  # очередь getUpdates: подтвержденные (id < offset) удаляются
+        self.updates_added = asyncio.Event()
+
+    async def _parameters(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle_bot_api(self, request):
+        method = request.match_info['method']
+        self.methods[method] = self.methods.get(method, 0) + 1
+        params = await self._parameters(request)
+        await asyncio.sleep(lognormal_delay(self.rng, self.options['telegram_latency_ms'], 0.3))
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif method == 'getWebhookInfo':
+            result = self.webhook
+        elif method == 'getUpdates':
+            if self.webhook['url']:
+                return web.json_response({'ok': False, 'error_code': 409, 'description':
+                                          "Conflict: can't use getUpdates method while webhook is active"})
+            result = await self._get_updates(params)
+        elif method == 'deleteWebhook':
+            self.webhook = dict(self.webhook, url='', allowed_updates=None)
+            result = True
+        elif method == 'setWebhook':
+            # Как Telegram: следующий getWebhookInfo вернет установленный адрес
+            allowed = params.get('allowed_updates')
+            self.webhook = dict(self.webhook, url=params.get('url', ''),
+                                allowed_updates=json.loads(allowed) if isinstance(allowed, str) else allowed)
+            result = True
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            if method == 'sendMessage':
+                self.first_answer.setdefault(chat_id, time.monotonic())
+            self.message_id += 1
+            result = {'message_id': int(params.get('message_id') or self.message_id), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        if not self.updates and float(params.get('timeout') or 0):
+            # Long polling: пустой запрос ждет новых обновлений до timeout
+            self.updates_added.clear()
+            try:
+                await asyncio.wait_for(self.updates_added.wait(), float(params['timeout']))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, int(params.get('limit') or 100)))
+
+    async def handle_enqueue(self, request):
+        """Обновление для getUpdates (режим --polling)"""
+        self.updates.append(await request.json())
+        self.updates_added.set()
+        return web.json_response({'ok': True})
+
+    async def handle_completion(self, request):
+        payload = await request.json()
+        self.llm['requests'] += 1
+        delay = lognormal_delay(self.rng, self.options['llm_latency_ms'], self.options['llm_latency_sigma'])
+        roll = self.rng.random()
+        if roll < self.options['llm_error_rate']:
+            await asyncio.sleep(delay / 4)
+            self.llm['errors_500'] += 1
+            return web.json_response({'error': 'internal'}, status=500)
+        if roll < self.options['llm_error_rate'] + self.options['llm_429_rate']:
+            self.llm['errors_429'] += 1
+            return web.json_response({'error': 'too many requests'}, status=429, headers={'Retry-After': '1'})
+
+        text = "\n".join(self.rng.sample(ANSWER_LINES, k=len(ANSWER_LINES)))
+        if not payload.get('completionOptions', {}).get('stream'):
+            await asyncio.sleep(delay)
+            return web.json_response(self._completion(text))
+
+        # Потоковый ответ: накопленный текст по частям, по строке JSON на часть
+        self.llm['streams'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await response.prepare(request)
+        chunks = 8
+        for index in range(1, chunks + 1):
+            await asyncio.sleep(delay / chunks)
+            part = text[:len(text) * index // chunks]
+            await response.write((json.dumps(self._completion(part)) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    def _completion(text):
+        return {'result': {'alternatives': [{'message': {'role': 'assistant', 'text': text},
+                                             'status': 'ALTERNATIVE_STATUS_FINAL'}],
+                           'usage': {'inputTextTokens': '300', 'completionTokens': str(len(text) // 3),
+                                     'totalTokens': str(300 + len(text) // 3)},
+                           'modelVersion': 'benchmark'}}
+
+    async def handle_stats(self, request):
+        return web.json_response({
+            'first_answer': {str(chat_id): at for chat_id, at in self.first_answer.items()},
+            'methods': self.methods,
+            'llm': self.llm,
+        })
+
+    def build_app(self):
+        app = web.Application(client_max_size=4 * 1024 * 1024)
+        app.router.add_post(r"/bot{token}/{method}", self.handle_bot_api)
+        app.router.add_post(YANDEX_PATH, self.handle_completion)
+        app.router.add_get("/__stats", self.handle_stats)
+        app.router.add_post("/__updates", self.handle_enqueue)
+        return app
+
+def run_fake_services(port, options):
+    logging.basicConfig(level=logging.WARNING)
+    web.run_app(FakeServices(options).build_app(), host="127.0.0.1", port=port,
+                print=None, access_log=None)
+
+# ==================== ГЕНЕРАТОР НАГРУЗКИ ====================
+
+class LoopLagMonitor:
+    """Задержка event loop: насколько позже срока просыпается задача со sleep(interval)"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lags = []
+        self.rss = []
+        self.task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - started - self.interval))
+            if len(self.lags) % 20 == 0:
+                self.rss.append(rss_bytes())
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+def make_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'Load'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'language_code': 'ru'},
+            'text': text,
+        },
+    }
+
+async def replay_updates(args, webhook_url, rng):
+    """Отправляет обновления с постоянной (или пуассоновской) частотой, не дожидаясь ответов"""
+    sent_at = {}
+    acks = []
+    statuses = {}
+    errors = 0
+    total = int(args.rate * args.duration)
+
+    connector = TCPConnector(limit=args.max_connections)
+    async with ClientSession(connector=connector, timeout=ClientTimeout(total=30)) as session:
+        async def send(update_id, user_id, text):
+            nonlocal errors
+            started = time.monotonic()
+            sent_at[user_id] = started
+            try:
+                async with session.post(webhook_url, json=make_update(update_id, user_id, text),
+                                        headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+            except Exception:
+                errors += 1
+                return
+            acks.append(time.monotonic() - started)
+
+        tasks = []
+        start = time.monotonic()
+        next_at = start
+        for index in range(total):
+            if args.poisson:
+                next_at += rng.expovariate(args.rate)
+            else:
+                next_at = start + index / args.rate
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if rng.random() < args.faq_share:
+                text = rng.choice(FAQ_QUESTIONS)
+            else:
+                text = rng.choice(LLM_QUESTIONS).format(n=rng.randint(1, 10 ** 6))
+            tasks.append(asyncio.create_task(send(index + 1, 10_000_000 + index, text)))
+        await asyncio.gather(*tasks)
+        send_duration = time.monotonic() - start
+
+    return {'sent_at': sent_at, 'acks': acks, 'statuses': statuses, 'errors': errors,
+            'send_duration': send_duration}
+
+async def fetch_fake_stats(session, url):
+    async with session.get(url) as response:
+        return await response.json()
+
+async def wait_for_answers(stats_url, expected, timeout):
+    """Ждет, пока на все обновления придут ответы (или истечет timeout)"""
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while True:
+            stats = await fetch_fake_stats(session, stats_url)
+            if len(stats['first_answer']) >= expected or time.monotonic() >= deadline:
+                return stats
+            await asyncio.sleep(0.5)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def configure_bot_environment(args, fake_port, bot_port):
+    base = f"http://127.0.0.1:{fake_port}"
+    os.environ.update({
+        'TELEGRAM_TOKEN': BOT_TOKEN,
+        'YANDEX_API_KEY': "benchmark-api-key",
+        'YANDEX_FOLDER_ID': "benchmark-folder",
+        'WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'WEBHOOK_URL': f"http://127.0.0.1:{bot_port}/",
+        'TELEGRAM_API_BASE_URL': f"{base}/bot",
+        'YANDEX_GPT_URL': f"{base}{YANDEX_PATH}",
+        'HUMAN_SIMULATION_ENABLED': "false",
+        'STREAM_RESPONSES': "true" if args.stream else "false",
+        'BOT_WORKERS': "1",
+        'BOT_ROLE': "single",
+        'UPDATE_MODE': "polling" if args.polling else "webhook",
+    })
+    if not args.keep_limits:
+        os.environ['MAX_REQUESTS_PER_MINUTE'] = str(10 ** 9)
+        os.environ['GLOBAL_RATE_LIMIT'] = str(10 ** 9)
+        os.environ.setdefault('USER_RATE_LIMIT', str(10 ** 6))
+
+async def run_benchmark(args, fake_port):
+    bot_port = free_port()
+    configure_bot_environment(args, fake_port, bot_port)
+    rss_before_import = rss_bytes()
+
+    import bot  # noqa: E402 - окружение должно быть готово до загрузки конфигурации
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+
+    app = await bot.init_app()
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", bot_port).start()
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    rss_start = rss_bytes()
+    rng = random.Random(args.seed)
+
+    target = f"http://127.0.0.1:{fake_port}/__updates" if args.polling else f"http://127.0.0.1:{bot_port}/"
+    load = await replay_updates(args, target, rng)
+    accepted = load['statuses'].get(200, 0)
+    fake_stats = await wait_for_answers(f"http://127.0.0.1:{fake_port}/__stats", accepted, args.drain)
+    finished = time.monotonic()
+    rss_end = rss_bytes()
+    await monitor.stop()
+
+    answer_times = []
+    last_answer = None
+    for chat_id, answered_at in fake_stats['first_answer'].items():
+        sent = load['sent_at'].get(int(chat_id))
+        if sent is not None:
+            answer_times.append(answered_at - sent)
+            last_answer = answered_at if last_answer is None else max(last_answer, answered_at)
+    first_sent = min(load['sent_at'].values()) if load['sent_at'] else finished
+
+    bot_stats = {
+        'dispatcher': bot.update_dispatcher.get_stats() if bot.update_dispatcher is not None else None,
+        'poller': bot.update_poller.get_stats() if args.polling else None,
+        'yandex_limiter': bot.yandex_limiter.get_stats(),
+        'yandex_resilience': bot.yandex_resilience.get_stats(),
+        'outbound': bot.outbound.get_stats(),
+        'output_guard': bot.output_guard.get_stats(),
+    }
+    await runner.cleanup()
+
+    answered = len(answer_times)
+    return {
+        'version': git_revision(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'config': vars(args),
+        'webhook': {
+            'sent': int(args.rate * args.duration),
+            'statuses': {str(status): count for status, count in sorted(load['statuses'].items())},
+            'connection_errors': load['errors'],
+            'ack_ms': percentiles(load['acks']),
+        },
+        'answers': {
+            'answered': answered,
+            'unanswered': accepted - answered,
+            'time_to_answer_ms': percentiles(answer_times),
+        },
+        'throughput': {
+            'offered_rps': args.rate,
+            'accepted_rps': round(accepted / load['send_duration'], 2) if load['send_duration'] else None,
+            'answers_per_sec': round(answered / (last_answer - first_sent), 2)
+            if last_answer and last_answer > first_sent else None,
+        },
+        'memory': {
+            'rss_import_mb': round((rss_start - rss_before_import) / 2 ** 20, 1),
+            'rss_start_mb': round(rss_start / 2 ** 20, 1),
+            'rss_end_mb': round(rss_end / 2 ** 20, 1),
+            'rss_peak_mb': round(max(monitor.rss + [rss_end]) / 2 ** 20, 1),
+            'rss_growth_mb': round((rss_end - rss_start) / 2 ** 20, 1),
+        },
+        'event_loop_lag_ms': percentiles(monitor.lags),
+        'telegram_api_calls': fake_stats['methods'],
+        'llm_server': fake_stats['llm'],
+        'bot': bot_stats,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота с локальными заглушками")
+    parser.add_argument("--rate", type=float, default=10.0, help="обновлений в секунду")
+    parser.add_argument("--duration", type=float, default=20.0, help="длительность отправки (сек)")
+    parser.add_argument("--poisson", action="store_true", help="пуассоновский поток вместо равномерного")
+    parser.add_argument("--faq-share", type=float, default=0.2, help="доля частых вопросов (без LLM)")
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы (STREAM_RESPONSES)")
+    parser.add_argument("--polling", action="store_true", help="прием обновлений через getUpdates вместо вебхука")
+    parser.add_argument("--llm-latency-ms", type=float, default=1500.0, help="медиана задержки YandexGPT")
+    parser.add_argument("--llm-latency-sigma", type=float, default=0.4, help="разброс задержки (логнормальный)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--llm-429-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--telegram-latency-ms", type=float, default=30.0, help="медиана задержки Bot API")
+    parser.add_argument("--max-connections", type=int, default=200, help="соединений генератора к вебхуку")
+    parser.add_argument("--drain", type=float, default=60.0, help="сколько ждать оставшиеся ответы (сек)")
+    parser.add_argument("--keep-limits", action="store_true", help="не снимать лимиты запросов бота")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл для результатов в JSON (по умолчанию - только вывод)")
+    return parser.parse_args()
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Заглушка не запустилась на порту {port}")
+
+def main():
+    args = parse_args()
+    fake_port = free_port()
+    options = {
+        'seed': args.seed,
+        'telegram_latency_ms': args.telegram_latency_ms,
+        'llm_latency_ms': args.llm_latency_ms,
+        'llm_latency_sigma': args.llm_latency_sigma,
+        'llm_error_rate': args.llm_error_rate,
+        'llm_429_rate': args.llm_429_rate,
+    }
+    # Время ответов заглушка отмечает по time.monotonic: на Linux часы общие для процессов
+    fake = multiprocessing.get_context("spawn").Process(target=run_fake_services, args=(fake_port, options),
+                                                         daemon=True)
+    fake.start()
+    try:
+        wait_for_port(fake_port)
+        results = asyncio.run(run_benchmark(args, fake_port))
+    finally:
+        fake.terminate()
+        fake.join(timeout=5)
+
+    summary = (f"\nОтправлено {results['webhook']['sent']} обновлений ({args.rate:g}/с), "
+               f"статусы {results['webhook']['statuses']}, ответов {results['answers']['answered']}\n"
+               f"Подтверждение вебхука, мс: {results['webhook']['ack_ms']}\n"
+               f"Время до ответа, мс: {results['answers']['time_to_answer_ms']}\n"
+               f"Ответов в секунду: {results['throughput']['answers_per_sec']}\n"
+               f"Задержка event loop, мс: {results['event_loop_lag_ms']}\n"
+               f"Память: {results['memory']}")
+    print(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты записаны в {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# benchmarks/bench_logging.py
+"""Стоимость логирования для обработчика: синхронные обработчики против LogPipeline.
+
+Нагрузка повторяет логи бота на одно обновление: прием вебхука, действие пользователя,
+а каждое пятое обновление - событие безопасности (превышение лимита), которое раньше
+писалось дважды: в logs/security.log и через корневой логгер. Измеряется время вызовов
+логирования в потоке обработчика (то, на что останавливается event loop) и полное время
+до записи всех строк. Режим --slow-disk добавляет задержку на каждый flush консоли,
+как при медленном диске или переполненном pipe у сборщика логов. --rate задает темп
+обновлений (между ними поток обработчика простаивает, как event loop в ожидании сети);
+--rate 0 - без пауз, худший случай для фонового потока, который делит GIL с обработчиком.
+
+Запуск: python benchmarks/bench_logging.py [--updates 20000] [--rate 2000] [--slow-disk 0.0005]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import logging.handlers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_pipeline import LogPipeline, LOGGING_CONFIG, log_extra  # noqa: E402
+
+class SlowStream:
+    """Файл, у которого каждый flush занимает delay секунд"""
+
+    def __init__(self, path, delay):
+        self.file = open(path, "w", encoding="utf-8")
+        self.delay = delay
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+        if self.delay:
+            time.sleep(self.delay)
+
+    def close(self):
+        self.file.close()
+
+def reset_logging():
+    for name in (None, 'security'):
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+def legacy_setup(directory, console):
+    """Как до LogPipeline: basicConfig и RotatingFileHandler у логгера security"""
+    reset_logging()
+    handler = logging.StreamHandler(console)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - STAGING - %(message)s'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    security_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(directory, "security.log"), maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8')
+    security_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logging.getLogger('security').addHandler(security_handler)
+
+def legacy_update(logger, security_logger, update_id, user_id, security_event):
+    logger.info(f"Получен вебхук #{update_id}")
+    logger.info(f"User {user_id}: message_received - Text length: {update_id % 300} chars")
+    if security_event:
+        log_message = (f"[SECURITY] {time.strftime('%Y-%m-%d %H:%M:%S')} - RATE_LIMIT_EXCEEDED - "
+                       f"User: {user_id} - Details: Attempts: 7")
+        security_logger.warning(log_message)  # файл + корневой логгер
+        logger.warning(log_message)  # и еще раз через корневой логгер
+
+WEBHOOK_RECEIVED = {'event': 'webhook_received'}
+
+def pipeline_update(logger, security_logger, update_id, user_id, security_event):
+    logger.info("Получен вебхук #%s", update_id, extra=WEBHOOK_RECEIVED)
+    logger.info("User %s: %s - %s", user_id, "message_received", f"Text length: {update_id % 300} chars",
+                extra=log_extra('user_action', user_id=user_id, action="message_received"))
+    if security_event:
+        security_logger.warning("[SECURITY] %s - User: %s - Details: %s", "RATE_LIMIT_EXCEEDED", user_id,
+                                "Attempts: 7", extra=log_extra('security_event', security_event="RATE_LIMIT_EXCEEDED",
+                                                               user_id=user_id))
+
+def run(name, log_update, updates, rate, finish):
+    logger = logging.getLogger('bot')
+    security_logger = logging.getLogger('security')
+    timings = []
+    started = time.perf_counter()
+    for update_id in range(updates):
+        if rate and update_id % 20 == 0:
+            # Обновления приходят пачками по 20 в заданном темпе
+            delay = started + update_id / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        call_started = time.perf_counter()
+        log_update(logger, security_logger, update_id, 10_000 + update_id % 500, update_id % 5 == 0)
+        timings.append(time.perf_counter() - call_started)
+    last_call = time.perf_counter()
+    finish()
+    finished = time.perf_counter()
+
+    timings.sort()
+    mean = sum(timings) / updates * 1e6
+    p50 = timings[len(timings) // 2] * 1e6
+    p99 = timings[int(len(timings) * 0.99)] * 1e6
+    print(f"{name:<10} в обработчике: {mean:7.1f} мкс/обновление "
+          f"(p50 {p50:6.1f}, p99 {p99:7.1f}, max {timings[-1] * 1e3:6.1f} мс)   "
+          f"всего {updates / (finished - started):7.0f} обновлений/с, "
+          f"дозапись после последнего {(finished - last_call) * 1e3:7.1f} мс")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест логирования")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=2000, help="обновлений в секунду (0 - без пауз)")
+    parser.add_argument("--slow-disk", type=float, default=0.0, help="задержка flush консоли (сек)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Обновлений: {args.updates}, темп: {args.rate:g}/с, задержка flush: {args.slow_disk * 1000:.2f} мс\n")
+
+        console = SlowStream(os.path.join(directory, "legacy.log"), args.slow_disk)
+        legacy_setup(directory, console)
+        run("legacy", legacy_update, args.updates, args.rate, lambda: None)
+        reset_logging()
+        console.close()
+
+        # Без прореживания: сравнение той же работы
+        for title, rates in (("pipeline", {}), ("sampled", LOGGING_CONFIG['SAMPLE_RATES'])):
+            stderr = sys.stderr
+            sys.stderr = console = SlowStream(os.path.join(directory, f"{title}.log"), args.slow_disk)
+            pipeline = LogPipeline(dict(LOGGING_CONFIG, FILE=None, SAMPLE_RATES=rates,
+                                        QUEUE_SIZE=args.updates * 4))
+            pipeline.add_file(os.path.join(directory, f"{title}-security.log"), prefix='security')
+            pipeline.start(environment="STAGING")
+            try:
+                run(title, pipeline_update, args.updates, args.rate, lambda: pipeline.flush(timeout=600))
+            finally:
+                pipeline.stop()
+                reset_logging()
+                sys.stderr = stderr
+                console.close()
+            stats = pipeline.get_stats()
+            print(f"{'':<10} пачек записи: {stats['batches']}, максимум в пачке {stats['max_batch']}, "
+                  f"прорежено {stats['sampled_out']}, отброшено {stats['dropped']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# benchmarks/bench_message_coalescer.py
+"""Сравнение объединения сообщений: глобальный processing_lock с пересозданием задач против MessageCoalescer.
+
+Моделируются одновременные чаты: часть пользователей пишет одним сообщением,
+часть - сериями. Обработка пачки имитируется задержкой, как у вызова LLM.
+
+Запуск: python benchmarks/bench_message_coalescer.py
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_coalescer import MessageCoalescer  # noqa: E402
+
+USERS = 2000
+SERIAL_SHARE = 0.3  # доля пользователей, пишущих сериями
+PROCESSING_TIME = 0.05  # имитация обработки пачки (сек)
+
+class LegacyCoalescer:
+    """Реализация handle_message/process_user_messages до MessageCoalescer"""
+
+    def __init__(self, process_batch, window=1.0):
+        self.process_batch = process_batch
+        self.window = window
+        self.queues = {}
+        self.tasks = {}
+        self.lock = asyncio.Lock()
+        self.tasks_created = 0
+
+    async def add(self, user_id, text):
+        async with self.lock:
+            self.queues.setdefault(user_id, []).append(text)
+            if user_id in self.tasks:
+                self.tasks[user_id].cancel()
+            self.tasks[user_id] = asyncio.create_task(self._process(user_id))
+            self.tasks_created += 1
+
+    async def _process(self, user_id):
+        try:
+            await asyncio.sleep(self.window)
+            async with self.lock:
+                messages = self.queues.get(user_id) or []
+                self.queues[user_id] = []
+                self.tasks.pop(user_id, None)
+            if messages:
+                await self.process_batch(user_id, None, None, messages, len(messages))
+        except asyncio.CancelledError:
+            pass
+
+def make_script(seed):
+    """Для каждого пользователя - моменты отправки сообщений"""
+    rng = random.Random(seed)
+    script = []
+    for user_id in range(USERS):
+        start = rng.uniform(0, 2.0)
+        # Пользователь уже "известен": первая серия прогревает статистику окна
+        count = rng.randint(2, 4) if rng.random() < SERIAL_SHARE else 1
+        moment = start
+        for _ in range(count):
+            script.append((moment, user_id))
+            moment += rng.uniform(0.2, 0.7)
+    script.sort()
+    return script
+
+async def run(name, make_coalescer, add, rounds=4):
+    latencies = []
+    batches = 0
+    last_message = {}
+
+    async def process_batch(user_id, chat_id, context, messages, count):
+        nonlocal batches
+        batches += 1
+        latencies.append(time.monotonic() - last_message[user_id])
+        await asyncio.sleep(PROCESSING_TIME)
+
+    coalescer = make_coalescer(process_batch)
+    add_time = 0.0
+    messages = 0
+    for round_index in range(rounds):
+        latencies.clear()
+        script = make_script(round_index)
+        begin = time.monotonic()
+        for moment, user_id in script:
+            delay = begin + moment - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            last_message[user_id] = time.monotonic()
+            start = time.perf_counter()
+            await add(coalescer, user_id, f"сообщение {moment:.3f}")
+            add_time += time.perf_counter() - start
+            messages += 1
+        await asyncio.sleep(3.0)
+
+    latencies.sort()
+    print(f"  {name:<20} добавление {add_time * 1e6 / messages:6.1f} мкс/сообщение, "
+          f"пачек {batches}, ожидание после последнего сообщения: "
+          f"p50 {latencies[len(latencies) // 2]:.2f} с, p99 {latencies[int(len(latencies) * 0.99)]:.2f} с")
+    return coalescer
+
+async def main():
+    print(f"{USERS} пользователей, {int(SERIAL_SHARE * 100)}% пишут сериями (последний раунд после прогрева):")
+
+    async def legacy_add(coalescer, user_id, text):
+        await coalescer.add(user_id, text)
+
+    legacy = await run("processing_lock", LegacyCoalescer, legacy_add)
+    print(f"  {'':<20} создано задач: {legacy.tasks_created}")
+
+    async def coalescer_add(coalescer, user_id, text):
+        coalescer.add(user_id, user_id, None, text)
+
+    coalescer = await run("MessageCoalescer", MessageCoalescer, coalescer_add)
+    print(f"  {'':<20} создано задач: {coalescer.stats['waiters']}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
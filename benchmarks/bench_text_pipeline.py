@@ -0,0 +1,139 @@
+# benchmarks/bench_text_pipeline.py
+"""Сравнение постобработки ответа: последовательные str.replace и re.sub против TextPipeline.
+
+Ответы собираются из типичных фрагментов ответов модели (списки, нумерованные пункты,
+подзаголовки, **жирный** от модели) и имеют длину около 300 токенов. Кроме скорости
+проверяется, что результат - корректный MarkdownV2: все спецсимволы экранированы,
+а маркеры жирного шрифта парные.
+
+Запуск: python benchmarks/bench_text_pipeline.py
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_pipeline import TextPipeline  # noqa: E402
+
+REPLIES = 2000
+ROUNDS = 3
+TARGET_CHARS = 900  # ~300 токенов русского текста
+
+TERM_MAPPING = {
+    "покраска": "нанесение ЛКП",
+    "царапина": "нарушение целостности ЛКП",
+    "скол": " локальное повреждение ЛКП",
+    "полировка": "восстановление глянца ЛКП",
+    "покрытие": "защитное керамическое покрытие",
+    "чистка": "профессиональная химчистка"
+}
+
+FRAGMENTS = [
+    "Здравствуйте! Спасибо за обращение в Detail Lab.",
+    "Керамическое покрытие защищает кузов от реагентов и ультрафиолета 2-3 года.",
+    "1. Мойка и подготовка: удаляем битум и металлические вкрапления.",
+    "2. Полировка кузова - убираем мелкие царапины и голограммы.",
+    "3. Нанесение покрытия (2 слоя) и сушка ИК-лампами.",
+    "- Стоимость: от 25 000 ₽ в зависимости от класса авто.",
+    "- Срок работ: 2-3 дня.",
+    "• Химчистка салона занимает один день.",
+    "Стоимость: уточняйте у мастера после осмотра.",
+    "Сколько стоит убрать скол на капоте? Зависит от глубины повреждения.",
+    "Уточните у администратора, сколько времени займет химчистка потолка.",
+    "**Важно:** после нанесения не мойте автомобиль 14 дней!",
+    "Если царапина глубокая, потребуется покраска элемента.",
+    "Подробнее на сайте https://detail-lab.example/ceramic или по телефону +7 (999) 123-45-67.",
+    "Чистка дисков и шин входит в комплекс [бесплатно].",
+    "Гарантия на работы_покрытие - 12 месяцев; скидка 10% при записи онлайн.",
+]
+
+def legacy_escape(text):
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+
+def legacy_enhance(text):
+    for common, professional in TERM_MAPPING.items():
+        text = text.replace(common, professional)
+    return text
+
+def legacy_format(text):
+    text = legacy_escape(text)
+    text = re.sub(r'(\d+\.\s+)([^:\n]+:)', r'\1**\2**', text)
+    text = re.sub(r'(\d+\.\s+)([^\n]+)', r'\1**\2**', text)
+    text = re.sub(r'([А-Яа-яA-Za-z]+:)', r'**\1**', text)
+    text = re.sub(r'^(\s*[-•*])\s+', r'• ', text, flags=re.MULTILINE)
+    return text
+
+def legacy_postprocess(text):
+    return legacy_format(legacy_enhance(text))
+
+SPECIAL = set('_*[]()~`>#+-=|{}.!\\')
+
+def is_valid_markdown_v2(text):
+    """Упрощенная проверка MarkdownV2 для разметки, которую ставит бот (только жирный шрифт)"""
+    bold_open = False
+    bold_empty = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == '\\':
+            if i + 1 >= len(text) or text[i + 1] not in SPECIAL:
+                return False
+            bold_empty = False
+            i += 2
+            continue
+        if char == '*':
+            if bold_open and bold_empty:
+                return False  # пустой жирный фрагмент
+            bold_open = not bold_open
+            bold_empty = True
+        elif char in SPECIAL:
+            return False
+        else:
+            bold_empty = False
+        i += 1
+    return not bold_open
+
+def make_replies(seed):
+    rng = random.Random(seed)
+    replies = []
+    for _ in range(REPLIES):
+        lines = []
+        while sum(len(line) + 1 for line in lines) < TARGET_CHARS:
+            lines.append(rng.choice(FRAGMENTS))
+        replies.append('\n'.join(lines))
+    return replies
+
+def measure(name, func, replies):
+    best = float('inf')
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        for reply in replies:
+            func(reply)
+        best = min(best, time.perf_counter() - started)
+    outputs = [func(reply) for reply in replies]
+    invalid = sum(not is_valid_markdown_v2(output) for output in outputs)
+    damaged = sum('локальное повреждение ЛКПько' in output or 'химпрофессиональная' in output
+                  for output in outputs)
+    print(f"{name:<12} {best / len(replies) * 1e6:8.1f} мкс/ответ   "
+          f"невалидный MarkdownV2: {invalid}/{len(replies)}   искаженные слова: {damaged}")
+    return outputs
+
+def main():
+    replies = make_replies(42)
+    avg_chars = sum(map(len, replies)) / len(replies)
+    print(f"Ответов: {REPLIES}, средняя длина {avg_chars:.0f} символов\n")
+
+    measure("legacy", legacy_postprocess, replies)
+    # В боте у замены "скол" нет ведущего пробела - сравниваем с тем же словарем
+    pipeline = TextPipeline(dict(TERM_MAPPING, скол="локальное повреждение ЛКП"))
+    outputs = measure("pipeline", pipeline.process, replies)
+
+    print("\nПример результата TextPipeline:\n")
+    print('\n'.join(outputs[0].split('\n')[:8]))
+
+if __name__ == "__main__":
+    main()
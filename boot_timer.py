@@ -0,0 +1,82 @@
+# boot_timer.py
+# Импортируется первым: только стандартная библиотека, без тяжелых зависимостей
+import os
+import time
+
+def process_age():
+    """Сколько секунд назад запущен процесс (по /proc, только Linux); None - неизвестно"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Имя процесса в скобках может содержать пробелы - поля считаем после ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+class _StepTimer:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timer.steps[self.name] = time.perf_counter() - self.start
+        return False
+
+class BootTimer:
+    """Время запуска процесса по этапам.
+
+    Этапы (mark) идут друг за другом: длительность этапа - от конца предыдущего.
+    Шаги (step) выполняются одновременно с другими (сетевые вызовы при инициализации),
+    для них записывается собственная длительность. Отсчет - от старта процесса,
+    если его время известно, иначе от импорта модуля.
+    """
+
+    def __init__(self):
+        self.created = time.perf_counter()
+        age = process_age()
+        self.origin = self.created - age if age is not None else self.created
+        self.last = self.created
+        self.phases = {'interpreter': age} if age is not None else {}
+        self.steps = {}
+        self.attrs = {}
+        self.ready_at = None
+
+    def mark(self, phase):
+        """Этап phase закончился сейчас"""
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def step(self, name):
+        """Контекстный менеджер шага, выполняемого параллельно с другими"""
+        return _StepTimer(self, name)
+
+    def ready(self, **attrs):
+        """Процесс готов обрабатывать обновления"""
+        self.mark('ready')
+        self.ready_at = self.last
+        self.attrs.update(attrs)
+
+    def elapsed(self):
+        return (self.ready_at or time.perf_counter()) - self.origin
+
+    def report(self):
+        return {
+            'ready': self.ready_at is not None,
+            'total_ms': round(self.elapsed() * 1000, 1),
+            'phases_ms': {name: round(value * 1000, 1) for name, value in self.phases.items()},
+            'steps_ms': {name: round(value * 1000, 1) for name, value in self.steps.items()},
+            **self.attrs,
+        }
+
+# Глобальный экземпляр
+boot_timer = BootTimer()
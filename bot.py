@@ -1,29 +1,55 @@
 # ==================== КОНФИГУРАЦИЯ И ИНИЦИАЛИЗАЦИЯ ====================
 
+# Первым: отсчет времени импортов для отчета о запуске
+from boot_timer import boot_timer
 import os
 import json
+import hmac
 import httpx
 import logging
 import asyncio
 import random
 import time
 import re
-from aiohttp import web
+import signal
+from collections import deque
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import Application, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 from security import security, secure_handler
+from response_cache import response_cache, normalize_question, make_fingerprint
+from intent_router import IntentRouter
+from update_dispatcher import UpdateDispatcher, get_chat_key
+from update_poller import UpdatePoller
+from message_coalescer import MessageCoalescer
+from outbound_scheduler import outbound
+from typing_status import typing_status
+from conversation_memory import conversation_memory, estimate_tokens
+from concurrency_limiter import AdaptiveConcurrencyLimiter, ConcurrencyLimitExceeded
+from llm_resilience import LLMResilience, CircuitOpenError
+from text_pipeline import TextPipeline, escape_markdown_v2, truncate_markdown_v2
+from output_guard import OutputGuard
+from metrics import (registry as metrics_registry, METRICS_CONFIG, WEBHOOK_SECONDS,
+                     WEBHOOK_REQUESTS, UPDATE_DECODE_SECONDS, SECURITY_REJECTIONS, LLM_SECONDS, LLM_REQUESTS,
+                     POSTPROCESS_SECONDS, TYPING_SIMULATION_SECONDS, STARTUP_SECONDS)
+from tracing import tracer, current_trace
+from profiling import profiling, ProfilerBusy
+from log_pipeline import log_pipeline, log_extra
+
+boot_timer.mark('imports')
 
 # Определяем окружение
 environment = os.getenv('ENVIRONMENT', 'staging')
 print(f"🚀 Запуск в окружении: {environment.upper()}")
 
-# Настройка логов с указанием окружения
-logging.basicConfig(
-    level=logging.INFO,
-    format=f'%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - {environment.upper()} - %(message)s'
-)
+# Логи в формате JSON через очередь: запись на диск выполняет фоновый поток
+log_pipeline.start(environment=environment.upper())
 logger = logging.getLogger(__name__)
 
+# extra без выделения словаря на каждый вебхук
+WEBHOOK_RECEIVED = {'event': 'webhook_received'}
+
 # Загрузка конфигурации
 def load_config():
     """Загрузка и проверка конфигурации"""
@@ -37,6 +63,21 @@ def load_config():
         'MAX_TEXT_LENGTH': int(os.getenv("MAX_TEXT_LENGTH", "4000")),
         'BLOCK_DURATION': int(os.getenv("BLOCK_DURATION", "3600")),
         'WARNING_THRESHOLD': int(os.getenv("WARNING_THRESHOLD", "5")),
+        'PORT': int(os.getenv("PORT", "10000")),
+        'WORKERS': int(os.getenv("BOT_WORKERS", "1")),  # больше 1 - запуск через супервизор
+        'ROLE': os.getenv("BOT_ROLE", "single"),  # single | worker
+        'WORKER_ID': int(os.getenv("BOT_WORKER_ID", "0")),
+        'SET_WEBHOOK': os.getenv("BOT_SET_WEBHOOK", "1") == "1",
+        'WEBHOOK_FORCE_SET': os.getenv("WEBHOOK_FORCE_SET", "0") == "1",  # setWebhook даже при совпадении
+        # Прием обновлений: webhook | polling (getUpdates) | auto (getUpdates, пока вебхук недоступен)
+        'UPDATE_MODE': os.getenv("UPDATE_MODE", "webhook"),
+        'WEBHOOK_CHECK_INTERVAL': float(os.getenv("WEBHOOK_CHECK_INTERVAL", "60")),  # проверка вебхука в auto (сек)
+        # Быстрый старт: порт открывается до инициализации бота, обновления ждут в буфере
+        'FAST_BOOT': os.getenv("FAST_BOOT", "0") == "1",
+        'BOOT_BUFFER_SIZE': int(os.getenv("BOOT_BUFFER_SIZE", "500")),
+        'BOOT_RETRIES': max(1, int(os.getenv("BOOT_RETRIES", "3"))),
+        'TELEGRAM_API_BASE_URL': os.getenv("TELEGRAM_API_BASE_URL"),  # локальный Bot API или заглушка
+        'ADMIN_TOKEN': os.getenv("ADMIN_TOKEN"),  # без него /admin/* не подключаются
         'ENVIRONMENT': environment
     }
     
@@ -48,9 +89,16 @@ def load_config():
         logger.critical(f"Отсутствуют обязательные переменные окружения: {missing_vars}")
         exit(1)
     
+    if config['UPDATE_MODE'] not in ('webhook', 'polling', 'auto'):
+        logger.critical(f"Неизвестный UPDATE_MODE: {config['UPDATE_MODE']} (webhook, polling или auto)")
+        exit(1)
+    # Воркер получает обновления от супервизора, который принимает вебхук
+    if config['ROLE'] == 'worker':
+        config['UPDATE_MODE'] = 'webhook'
+    
     # Маскируем чувствительные данные в логах
     masked_config = config.copy()
-    for key in ['BOT_TOKEN', 'YANDEX_API_KEY', 'WEBHOOK_SECRET']:
+    for key in ['BOT_TOKEN', 'YANDEX_API_KEY', 'WEBHOOK_SECRET', 'ADMIN_TOKEN']:
         if masked_config[key]:
             masked_config[key] = masked_config[key][:10] + '...'
     
@@ -59,6 +107,7 @@ def load_config():
 
 # Загружаем конфиг
 CONFIG = load_config()
+boot_timer.mark('config')
 
 # Конфигурация салона (вынесено в отдельный блок)
 SALON_CONFIG = {
@@ -115,15 +164,40 @@ FAQ_CARDS = {
     }
 }
 
+# Локальный маршрутизатор частых вопросов (индексы строятся один раз при старте)
+intent_router = IntentRouter(SALON_CONFIG, FAQ_CARDS)
+
 # Константы API
-YANDEX_GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+# Адрес переопределяется для нагрузочного тестирования с локальной заглушкой
+YANDEX_GPT_URL = os.getenv("YANDEX_GPT_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
 MODEL_CONFIG = {
     "temperature": 0.3,
     "max_tokens": 300
 }
 
+# Настройки HTTP-клиента YandexGPT (пул соединений живет все время работы приложения)
+YANDEX_HTTP_CONFIG = {
+    "http2": os.getenv("YANDEX_HTTP2", "true").lower() == "true",
+    "max_connections": int(os.getenv("YANDEX_MAX_CONNECTIONS", "20")),
+    "max_keepalive_connections": int(os.getenv("YANDEX_MAX_KEEPALIVE_CONNECTIONS", "10")),
+    "keepalive_expiry": float(os.getenv("YANDEX_KEEPALIVE_EXPIRY", "120")),
+    "connect_timeout": float(os.getenv("YANDEX_CONNECT_TIMEOUT", "5.0")),
+    "read_timeout": float(os.getenv("YANDEX_READ_TIMEOUT", "30.0")),
+    "write_timeout": float(os.getenv("YANDEX_WRITE_TIMEOUT", "10.0")),
+    "pool_timeout": float(os.getenv("YANDEX_POOL_TIMEOUT", "5.0")),
+    "latency_window": 512,  # сколько последних запросов учитывать в p50/p99
+}
+
+# Настройки потоковой выдачи ответов (первое предложение отправляется сразу, дальше - правки сообщения)
+STREAMING_CONFIG = {
+    "enabled": os.getenv("STREAM_RESPONSES", "false").lower() == "true",
+    "edit_interval": float(os.getenv("STREAM_EDIT_INTERVAL", "1.2")),  # не чаще одной правки за интервал (сек)
+    "min_delta_chars": int(os.getenv("STREAM_MIN_DELTA_CHARS", "40")),  # минимальный прирост текста для правки
+}
+
 # Настройки симуляции человека
 HUMAN_SIMULATION = {
+    "enabled": os.getenv("HUMAN_SIMULATION_ENABLED", "true").lower() == "true",  # False - без искусственных задержек
     "min_typing_delay": 2,  # минимальная задержка перед ответом (сек)
     "max_typing_delay": 8,  # максимальная задержка перед ответом (сек)
     "chars_per_second": 10,  # скорость "печатания" (символов в секунду)
@@ -131,120 +205,115 @@ HUMAN_SIMULATION = {
     "error_probability": 0.05,  # вероятность "ошибки" и перепечатывания (5%)
 }
 
+# Профессиональная терминология в ответах (заменяются только целые слова)
+PROFESSIONAL_TERMS = {
+    "покраска": "нанесение ЛКП",
+    "царапина": "нарушение целостности ЛКП",
+    "скол": "локальное повреждение ЛКП",
+    "полировка": "восстановление глянца ЛКП",
+    "покрытие": "защитное керамическое покрытие",
+    "чистка": "профессиональная химчистка"
+}
+
+# Постобработка ответов модели: правила компилируются один раз при запуске
+reply_pipeline = TextPipeline(PROFESSIONAL_TERMS)
+
+# Проверка ответов модели на утечку секретов и запрещенные темы (собирается один раз при запуске)
+output_guard = OutputGuard(
+    {
+        'BOT_TOKEN': CONFIG['BOT_TOKEN'],
+        'YANDEX_API_KEY': CONFIG['YANDEX_API_KEY'],
+        'WEBHOOK_SECRET': CONFIG['WEBHOOK_SECRET'],
+    },
+    escape=escape_markdown_v2,
+)
+
+# Ответы вместо отклоненных проверкой
+UNSAFE_REPLY = "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте другой вопрос."
+BANNED_REPLY = "🚫 Этот вопрос требует консультации специалиста. Пожалуйста, обратитесь к администратору по телефону."
+
 # Глобальная переменная для бота
 bot_app = None
+# Бот инициализирован и принимает обновления в диспетчер
+bot_ready = False
+# Обновления, принятые при быстром старте до готовности бота: (данные, трасса)
+boot_buffer = None
+
+# Диспетчер обновлений: вебхук только ставит обновление в очередь и сразу отвечает Telegram
+update_dispatcher = None
 
-# Глобальные переменные для обработки сообщений
-user_message_queues = {}
-user_processing_tasks = {}
-processing_lock = asyncio.Lock()
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
 def escape_markdown_text(text: str) -> str:
     """Экранирует специальные символы MarkdownV2"""
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+    return escape_markdown_v2(text)
 
-def log_user_action(user_id, action, details):
-    """Логирует действия пользователя"""
-    logger.info(f"User {user_id}: {action} - {details}")
+MARKDOWN_ESCAPE_PATTERN = re.compile(r'\\([_*\[\]()~`>#+\-=|{}.!\\])')
 
-def contains_banned_content(text):
-    """Проверяет, содержит ли текст запрещенный контент"""
-    text_lower = text.lower()
-    medical_phrases = ["лечебн", "медицинск", "вылеч"]
-    legal_phrases = ["юридическ", "адвокат", "суд"]
+def unescape_markdown_text(text: str) -> str:
+    """Убирает экранирование MarkdownV2 (для текста, который снова пойдет в модель)"""
+    return MARKDOWN_ESCAPE_PATTERN.sub(r'\1', text)
 
-    # Проверяем медицинские фразы в неподходящем контексте
-    if any(phrase in text_lower for phrase in medical_phrases) and "авто" not in text_lower:
-        return True
-        
-    # Проверяем юридические фразы
-    if any(phrase in text_lower for phrase in legal_phrases):
-        return True
-        
-    return False
+# Конец предложения: знак препинания перед пробелом или перевод строки
+SENTENCE_END_PATTERN = re.compile(r'[.!?…](?=\s)|\n')
 
-def check_response_safety(text):
-    """Проверяет ответ LLM на утечку конфиденциальной информации"""
-    if not text:
-        return True
-        
-    # Проверяем на утечку потенциальных секретов
-    secret_patterns = [
-        r'[A-Za-z0-9]{32,}',  # Длинные строки, похожие на хэши/токены
-        r'password.*:.+',      # Упоминание паролей
-        r'token.*:.+',         # Упоминание токенов
-        r'api[_-]?key.*:.+',   # Упоминание API-ключей
-        r'secret.*:.+',        # Упоминание секретов
-    ]
-    
-    for pattern in secret_patterns:
-        if re.search(pattern, text, re.IGNORECASE):
-            logger.warning(f"Обнаружена потенциальная утечка в ответе LLM: {pattern}")
-            return False
-            
-    # Проверяем на наличие конфиденциальных данных из конфига
-    sensitive_data = [
-        CONFIG['BOT_TOKEN'],
-        CONFIG['YANDEX_API_KEY'],
-        CONFIG['WEBHOOK_SECRET'],
-        SALON_CONFIG['contacts'],
-    ]
-    
-    for data in sensitive_data:
-        if data and data in text:
-            logger.warning("Обнаружена утечка конфиденциальных данных в ответе LLM")
-            return False
-            
-    return True
+def cut_to_last_sentence(text: str) -> str:
+    """Обрезает частичный ответ до последнего завершенного предложения"""
+    last_end = -1
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        last_end = match.end()
+    return text[:last_end].rstrip() if last_end > 0 else ""
+
+def log_user_action(user_id, action, details):
+    """Логирует действия пользователя"""
+    logger.info("User %s: %s - %s", user_id, action, details,
+                extra=log_extra('user_action', user_id=user_id, action=action))
+
+def apply_output_guard(user_id, reply, verdict=None):
+    """Проверяет ответ (или использует готовый вердикт) и подменяет отклоненный ответ"""
+    if verdict is None:
+        verdict = output_guard.check(reply)
+    if verdict.allowed:
+        return reply
+    if verdict.category == 'leak':
+        log_user_action(user_id, "response_safety_check", f"Failed safety check: {verdict.reason}")
+        return escape_markdown_text(UNSAFE_REPLY)
+    log_user_action(user_id, "banned_content", f"Response contained banned content: {verdict.reason}")
+    return escape_markdown_text(BANNED_REPLY)
 
-async def process_user_messages(user_id, chat_id, context):
+async def process_user_messages(user_id, chat_id, context, messages, message_count=None):
     """Обрабатывает все сообщения пользователя за раз"""
+    # Для лимитов учитываем все полученные сообщения, включая объединенные в буфере
+    message_count = message_count or len(messages)
+    tracer.annotate(user_id=user_id, messages=message_count)
     try:
-        # Ждем 1 секунду для получения возможных дополнительных сообщений
-        await asyncio.sleep(1.0)
-        
-        async with processing_lock:
-            if user_id not in user_message_queues or not user_message_queues[user_id]:
-                return
-            
-            # Получаем все сообщения из очереди
-            messages = user_message_queues[user_id].copy()
-            user_message_queues[user_id] = []
-            
-            # Удаляем задачу обработки
-            if user_id in user_processing_tasks:
-                del user_processing_tasks[user_id]
-        
         # Проверяем лимиты без добавления запросов
-        current_count = security.get_current_request_count(user_id)
+        current_count = await security.get_current_request_count(user_id)
         max_requests = security.config['USER_RATE_LIMIT']
         
-        if current_count + len(messages) > max_requests:
+        if current_count + message_count > max_requests:
             # Превышение лимита - добавляем предупреждение
-            warning_exceeded = security.add_warning(user_id, "RATE_LIMIT_EXCEEDED")
+            warning_exceeded = await security.add_warning(user_id, "RATE_LIMIT_EXCEEDED")
             
             if warning_exceeded:
                 await security.block_user(user_id)
-                await context.bot.send_message(chat_id, "⛔ Вы заблокированы за спам.")
+                await outbound.send_message(context.bot, chat_id, "⛔ Вы заблокированы за спам.")
             else:
-                warning_count = security.get_warning_count(user_id)
+                warning_count = await security.get_warning_count(user_id)
                 max_warnings = security.config['WARNING_THRESHOLD']
-                await context.bot.send_message(
+                await outbound.send_message(
+                    context.bot,
                     chat_id,
                     f"⚠️ Слишком много сообщений. Предупреждение {warning_count}/{max_warnings}."
                 )
             
             # Добавляем запросы в историю (по одному на каждое сообщение)
-            for _ in range(len(messages)):
-                security.user_activity[user_id].append(time.time())
+            await security.record_requests(user_id, message_count)
             return
         
         # Добавляем запросы в историю (по одному на каждое сообщение)
-        for _ in range(len(messages)):
-            security.user_activity[user_id].append(time.time())
+        await security.record_requests(user_id, message_count)
         
         # Объединяем сообщения в один текст (исключаем дубликаты)
         unique_messages = []
@@ -254,101 +323,351 @@ async def process_user_messages(user_id, chat_id, context):
         
         combined_text = " ".join(unique_messages)
         
-        # Генерируем ответ
-        reply = await YandexGPTClient.generate_response(combined_text)
-        
-        # Проверяем безопасность ответа
-        if not check_response_safety(reply):
-            logger.warning(f"Ответ LLM содержит потенциально опасный контент: {reply[:100]}...")
-            reply = "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте другой вопрос."
-            log_user_action(user_id, "response_safety_check", "Failed safety check")
-        
-        # Ограничиваем длину ответа
-        if len(reply) > CONFIG['MAX_TEXT_LENGTH']:
-            reply = reply[:CONFIG['MAX_TEXT_LENGTH']] + "..."
-        
-        # Симуляция человеческого печатания
-        await context.bot.send_chat_action(chat_id=chat_id, action="typing")
-        typing_time = await simulate_typing_with_errors(chat_id, context, reply)
-        logger.info(f"Симуляция печатания заняла {typing_time:.2f} секунд")
+        # Частые вопросы (цены, адрес, режим работы, FAQ) отвечаем из конфигурации без обращения к LLM
+        intent = intent_router.classify(combined_text)
+        if intent is not None:
+            tracer.annotate(intent=intent.intent)
+            conversation_memory.add_exchange(user_id, combined_text, intent.answer)
+            reply = finalize_reply(user_id, escape_markdown_text(intent.answer))
+            await outbound.send_message(context.bot, chat_id, reply, parse_mode='MarkdownV2')
+            log_user_action(user_id, "intent_answer", f"Intent: {intent.intent}, confidence: {intent.confidence:.2f}")
+            return
         
-        # Добавляем случайные опечатки для естественности
-        reply = await simulate_human_typing_mistakes(reply)
+        # Потоковый режим: отвечаем по мере генерации, без симуляции печатания
+        if STREAMING_CONFIG['enabled']:
+            await send_streaming_reply(user_id, chat_id, context, combined_text)
+            return
         
-        # Фильтрация нежелательных фраз
-        if contains_banned_content(reply):
-            reply = "🚫 Этот вопрос требует консультации специалиста. Пожалуйста, обратитесь к администратору по телефону."
-            log_user_action(user_id, "banned_content", "Response contained banned content")
+        # Статус "печатает" показываем параллельно с генерацией, а не после нее
+        generation_start = time.monotonic()
+        typing_status.register(context.bot, chat_id)
+        try:
+            # Генерируем ответ
+            reply = await YandexGPTClient.generate_response(combined_text, user_id=user_id)
+            generation_time = time.monotonic() - generation_start
+            
+            # Проверяем ответ на утечки и запрещенные темы до симуляции опечаток
+            reply = apply_output_guard(user_id, reply)
+            
+            # Ограничиваем длину ответа
+            reply = truncate_markdown_v2(reply, CONFIG['MAX_TEXT_LENGTH'])
+            
+            if HUMAN_SIMULATION['enabled']:
+                # Симуляция человеческого печатания: досыпаем только остаток сверх времени генерации
+                simulation_started = time.perf_counter()
+                typing_time, extra_delay = await simulate_typing_with_errors(chat_id, context, reply, generation_time)
+                TYPING_SIMULATION_SECONDS.observe(time.perf_counter() - simulation_started)
+                tracer.record('typing_simulation', simulation_started)
+                logger.info("Генерация заняла %.2f сек, симуляция печатания %.2f сек, дополнительная пауза %.2f сек",
+                            generation_time, typing_time, extra_delay)
+                
+                # Добавляем случайные опечатки для естественности
+                reply = await simulate_human_typing_mistakes(reply)
+        finally:
+            typing_status.unregister(chat_id)
         
-        # Добавляем профессиональное завершение к ответам
-        if not any(phrase in reply.lower() for phrase in ["звоните", "телефон", "контакт", "адрес"]):
-            reply += f"\n\n📞 Для записи на диагностику звоните: {escape_markdown_text(SALON_CONFIG['contacts'])}"
+        reply = finalize_reply(user_id, reply, guarded=True)
         
         # Отправляем ответ с MarkdownV2
-        await context.bot.send_message(chat_id, reply, parse_mode='MarkdownV2')
-        logger.info(f"Отправлен ответ пользователю {user_id}, длина: {len(reply)} символов")
+        await outbound.send_message(context.bot, chat_id, reply, parse_mode='MarkdownV2')
+        logger.info("Отправлен ответ пользователю %s, длина: %d символов", user_id, len(reply))
         log_user_action(user_id, "response_sent", f"Response length: {len(reply)} chars")
         
     except asyncio.CancelledError:
         # Задача была отменена, это нормально
         pass
     except Exception as e:
-        logger.error(f"Ошибка в process_user_messages: {e}")
+        logger.error("Ошибка в process_user_messages: %s", e)
+
+def finalize_reply(user_id, reply, guarded=False):
+    """Финальные проверки и оформление готового ответа перед отправкой"""
+    # Фильтрация утечек и нежелательных тем, если ответ еще не проверялся
+    if not guarded:
+        reply = apply_output_guard(user_id, reply)
+    
+    # Добавляем профессиональное завершение к ответам
+    if not any(phrase in reply.lower() for phrase in ["звоните", "телефон", "контакт", "адрес"]):
+        reply += f"\n\n📞 Для записи на диагностику звоните: {escape_markdown_text(SALON_CONFIG['contacts'])}"
+    
+    return reply
+
+async def send_streaming_reply(user_id, chat_id, context, combined_text):
+    """Отправляет ответ YandexGPT по мере генерации с ограниченной частотой правок сообщения"""
+    message = None
+    shown_text = ""
+    last_edit = 0.0
+    raw_text = ""
+    request_start = time.perf_counter()
+    stream_guard = output_guard.stream()
+    
+    headers, payload = YandexGPTClient.build_request(combined_text, stream=True, user_id=user_id)
+    cache_key, cached = YandexGPTClient.get_cached_response(combined_text, payload)
+    if cached is not None:
+        conversation_memory.add_exchange(user_id, combined_text, unescape_markdown_text(cached))
+        reply = finalize_reply(user_id, cached)
+        await outbound.send_message(context.bot, chat_id, reply, parse_mode='MarkdownV2')
+        log_user_action(user_id, "response_sent", f"Cached response length: {len(reply)} chars")
+        return
+    
+    # Статус "печатает" держится до первого отправленного предложения
+    typing_status.register(context.bot, chat_id)
+    
+    try:
+        async for raw_text in YandexGPTClient.stream_response(combined_text, headers, payload):
+            # Частичный ответ с подозрением на утечку или запрещенную тему не показываем вовсе
+            if not stream_guard.feed(raw_text):
+                break
+            
+            visible = cut_to_last_sentence(raw_text)
+            if not visible or len(visible) - len(shown_text) < (1 if message is None else STREAMING_CONFIG['min_delta_chars']):
+                continue
+            if message is not None and time.monotonic() - last_edit < STREAMING_CONFIG['edit_interval']:
+                continue
+            
+            partial = truncate_markdown_v2(YandexGPTClient.postprocess(visible), CONFIG['MAX_TEXT_LENGTH'])
+            if message is None:
+                message = await outbound.send_message(context.bot, chat_id, partial, parse_mode='MarkdownV2')
+                typing_status.unregister(chat_id)
+                logger.info("Первое предложение отправлено пользователю %s через %.2f сек",
+                            user_id, time.perf_counter() - request_start)
+            else:
+                await outbound.edit_message_text(context.bot, partial, chat_id=chat_id,
+                                                 message_id=message.message_id, parse_mode='MarkdownV2')
+            shown_text = visible
+            last_edit = time.monotonic()
+        
+        observe_llm('stream', 'ok', request_start)
+        verdict = stream_guard.finish(raw_text)
+        if verdict.allowed:
+            reply = YandexGPTClient.postprocess(raw_text.strip())
+            response_cache.put(cache_key, reply)
+            conversation_memory.add_exchange(user_id, combined_text, raw_text.strip())
+        else:
+            reply = apply_output_guard(user_id, raw_text, verdict)
+    except ConcurrencyLimitExceeded as e:
+        observe_llm('stream', 'busy', request_start)
+        logger.warning("Потоковый запрос к YandexGPT не дождался очереди: %s", e)
+        reply = escape_markdown_text(BUSY_REPLY)
+    except CircuitOpenError:
+        observe_llm('stream', 'circuit_open', request_start)
+        logger.warning("YandexGPT недоступен (предохранитель разомкнут), отвечаем локально")
+        reply = build_fallback_reply(combined_text)
+    except httpx.HTTPError as e:
+        observe_llm('stream', 'error', request_start)
+        logger.error("Ошибка HTTP при потоковом запросе к YandexGPT: %s", e)
+        if message is None and yandex_resilience.is_retryable(e):
+            reply = build_fallback_reply(combined_text)
+        else:
+            reply = escape_markdown_text("Извините, произошла ошибка соединения. Пожалуйста, попробуйте позже.")
+    except Exception as e:
+        observe_llm('stream', 'error', request_start)
+        logger.error("Неожиданная ошибка потоковой генерации YandexGPT: %s", e)
+        reply = escape_markdown_text("Извините, произошла техническая ошибка. Пожалуйста, попробуйте позже.")
+    
+    # Ограничиваем длину ответа
+    reply = truncate_markdown_v2(reply, CONFIG['MAX_TEXT_LENGTH'])
+    # Ответ модели уже проверен потоковой проверкой, остальные ответы - наши тексты
+    reply = finalize_reply(user_id, reply, guarded=True)
+    
+    if message is None:
+        typing_status.unregister(chat_id)
+        await outbound.send_message(context.bot, chat_id, reply, parse_mode='MarkdownV2')
+    else:
+        await outbound.edit_message_text(context.bot, reply, chat_id=chat_id,
+                                         message_id=message.message_id, parse_mode='MarkdownV2')
+    logger.info("Потоковый ответ отправлен пользователю %s, длина: %d символов, время: %.2f сек",
+                user_id, len(reply), time.perf_counter() - request_start)
+    log_user_action(user_id, "response_sent", f"Streamed response length: {len(reply)} chars")
 
 async def cleanup_message_queues():
-    """Очищает старые очереди сообщений"""
+    """Очищает состояние неактивных пользователей и пишет статистику"""
     while True:
         await asyncio.sleep(300)  # Каждые 5 минут
-        current_time = time.time()
-        async with processing_lock:
-            for user_id in list(user_message_queues.keys()):
-                # Если очередь пуста более 10 минут, удаляем ее
-                if not user_message_queues[user_id]:
-                    del user_message_queues[user_id]
-            for user_id in list(user_processing_tasks.keys()):
-                # Если задача завершена, удаляем ее
-                if user_processing_tasks[user_id].done():
-                    del user_processing_tasks[user_id]
+        evicted = message_coalescer.evict_idle()
+        
+        logger.info(f"Буфер сообщений: удалено неактивных {evicted}, статистика {message_coalescer.get_stats()}")
+        logger.info(f"Статистика пула YandexGPT: {YandexGPTClient.get_pool_stats()}")
+        logger.info(f"Лимит параллельных запросов YandexGPT: {yandex_limiter.get_stats()}")
+        logger.info(f"Устойчивость запросов YandexGPT: {yandex_resilience.get_stats()}")
+        logger.info(f"Статистика кэша ответов: {response_cache.get_stats()}")
+        logger.info(f"Статистика локальных ответов: {intent_router.get_stats()}")
+        logger.info(f"Проверка ответов модели: {output_guard.get_stats()}")
+        logger.info(f"Планировщик сроков безопасности: {security.scheduler.get_stats()}")
+        logger.info(f"Хранилище состояния безопасности: {security.storage.get_stats()}")
+        logger.info(f"Статус печатания: {typing_status.get_stats()}")
+        logger.info(f"История диалогов: удалено неактивных {conversation_memory.evict_idle()}, "
+                    f"статистика {conversation_memory.get_stats()}")
+        logger.info(f"Исходящие сообщения: удалено неактивных чатов {outbound.evict_idle()}, "
+                    f"статистика {outbound.get_stats()}")
+        if update_dispatcher is not None:
+            logger.info(f"Диспетчер обновлений: {update_dispatcher.get_stats()}")
+        logger.info(f"Конвейер логов: {log_pipeline.get_stats()}")
+        logger.info(f"Трассировка: потерянных трасс {tracer.evict_stale()}, статистика {tracer.get_stats()}")
+
+# Объединение серий сообщений пользователя (без общей блокировки на всех пользователей)
+message_coalescer = MessageCoalescer(process_user_messages)
 
 # ==================== YANDEX GPT КЛИЕНТ ====================
 
+# Адаптивный лимит одновременных запросов к YandexGPT с очередью ожидания
+yandex_limiter = AdaptiveConcurrencyLimiter("yandex_gpt")
+
+# Повторы, дублирующие запросы и предохранитель для YandexGPT
+yandex_resilience = LLMResilience("yandex_gpt")
+
+BUSY_REPLY = "Извините, сейчас очень много обращений. Пожалуйста, повторите вопрос через минуту."
+
+# Метрики запросов к LLM по режиму и результату (метки создаются один раз)
+_LLM_SECONDS = {mode: LLM_SECONDS.labels(mode) for mode in ('complete', 'stream')}
+_LLM_RESULTS = {mode: {outcome: LLM_REQUESTS.labels(mode, outcome)
+                       for outcome in ('ok', 'error', 'busy', 'circuit_open')}
+                for mode in ('complete', 'stream')}
+
+def observe_llm(mode, outcome, started):
+    """Метрики и этап трассы запроса к LLM; время учитывается только у выполненных запросов"""
+    finished = time.perf_counter()
+    if outcome in ('ok', 'error'):
+        _LLM_SECONDS[mode].observe(finished - started)
+    _LLM_RESULTS[mode][outcome].inc()
+    tracer.record('llm', started, finished, mode=mode, outcome=outcome)
+
+def build_fallback_reply(user_message: str) -> str:
+    """Локальный ответ из конфигурации салона, когда YandexGPT недоступен"""
+    return escape_markdown_text(intent_router.fallback_answer(user_message))
+
 class YandexGPTClient:
     """Клиент для работы с Yandex GPT API"""
     
+    # Общий HTTP-клиент с пулом keep-alive соединений (создается в initialize_bot)
+    _http_client = None
+    _pool_stats = {
+        "requests": 0,
+        "errors": 0,
+        "tcp_connects": 0,
+        "tls_handshakes": 0,
+        "connect_time_total": 0.0,
+        "tls_time_total": 0.0,
+        "http2_requests": 0,
+    }
+    _latencies = deque(maxlen=YANDEX_HTTP_CONFIG["latency_window"])
+    
+    @classmethod
+    def _create_http_client(cls):
+        """Создает долгоживущий HTTP-клиент с лимитами пула и таймаутами по фазам"""
+        use_http2 = YANDEX_HTTP_CONFIG["http2"]
+        if use_http2:
+            try:
+                import h2  # noqa: F401 - нужен httpx для HTTP/2
+            except ImportError:
+                logger.warning("Пакет h2 не установлен, HTTP/2 для YandexGPT отключен")
+                use_http2 = False
+        
+        limits = httpx.Limits(
+            max_connections=YANDEX_HTTP_CONFIG["max_connections"],
+            max_keepalive_connections=YANDEX_HTTP_CONFIG["max_keepalive_connections"],
+            keepalive_expiry=YANDEX_HTTP_CONFIG["keepalive_expiry"]
+        )
+        timeout = httpx.Timeout(
+            connect=YANDEX_HTTP_CONFIG["connect_timeout"],
+            read=YANDEX_HTTP_CONFIG["read_timeout"],
+            write=YANDEX_HTTP_CONFIG["write_timeout"],
+            pool=YANDEX_HTTP_CONFIG["pool_timeout"]
+        )
+        return httpx.AsyncClient(http2=use_http2, limits=limits, timeout=timeout)
+    
+    @classmethod
+    async def startup(cls):
+        """Открывает общий HTTP-клиент (вызывается при инициализации бота)"""
+        if cls._http_client is None or cls._http_client.is_closed:
+            cls._http_client = cls._create_http_client()
+            logger.info(f"HTTP-клиент YandexGPT создан: http2={YANDEX_HTTP_CONFIG['http2']}, "
+                        f"max_connections={YANDEX_HTTP_CONFIG['max_connections']}")
+    
+    @classmethod
+    async def shutdown(cls):
+        """Закрывает общий HTTP-клиент и его соединения"""
+        if cls._http_client is not None:
+            logger.info(f"Закрытие HTTP-клиента YandexGPT, статистика пула: {cls.get_pool_stats()}")
+            await cls._http_client.aclose()
+            cls._http_client = None
+    
+    @classmethod
+    def get_http_client(cls):
+        """Возвращает общий HTTP-клиент, создавая его при первом обращении"""
+        if cls._http_client is None or cls._http_client.is_closed:
+            cls._http_client = cls._create_http_client()
+        return cls._http_client
+    
+    @classmethod
+    def _make_trace(cls):
+        """Создает trace-колбэк httpcore для подсчета новых соединений и TLS-рукопожатий"""
+        started = {}
+        
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.started":
+                started["tcp"] = time.perf_counter()
+            elif event_name == "connection.connect_tcp.complete":
+                cls._pool_stats["tcp_connects"] += 1
+                cls._pool_stats["connect_time_total"] += time.perf_counter() - started.pop("tcp", time.perf_counter())
+            elif event_name == "connection.start_tls.started":
+                started["tls"] = time.perf_counter()
+            elif event_name == "connection.start_tls.complete":
+                cls._pool_stats["tls_handshakes"] += 1
+                cls._pool_stats["tls_time_total"] += time.perf_counter() - started.pop("tls", time.perf_counter())
+        
+        return trace
+    
+    @classmethod
+    async def _post(cls, url, headers, payload):
+        """POST-запрос через общий клиент с учетом статистики пула и задержек"""
+        client = cls.get_http_client()
+        async with yandex_limiter.slot() as slot:
+            start_time = time.perf_counter()
+            cls._pool_stats["requests"] += 1
+            try:
+                response = await client.post(url, headers=headers, json=payload,
+                                             extensions={"trace": cls._make_trace()})
+            except httpx.HTTPError:
+                cls._pool_stats["errors"] += 1
+                raise
+            slot.set_status(response.status_code)
+        cls._latencies.append(time.perf_counter() - start_time)
+        if response.http_version == "HTTP/2":
+            cls._pool_stats["http2_requests"] += 1
+        return response
+    
+    @classmethod
+    def get_pool_stats(cls):
+        """Статистика пула соединений и задержек запросов к YandexGPT"""
+        stats = dict(cls._pool_stats)
+        stats["reused_connections"] = max(0, stats["requests"] - stats["errors"] - stats["tcp_connects"])
+        stats["avg_handshake_ms"] = round(
+            (stats["connect_time_total"] + stats["tls_time_total"]) * 1000 / stats["tcp_connects"], 1
+        ) if stats["tcp_connects"] else 0.0
+        
+        latencies = sorted(cls._latencies)
+        if latencies:
+            stats["latency_p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 1)
+            stats["latency_p99_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 1)
+        
+        # Текущее состояние пула (атрибуты httpcore не входят в публичный API, поэтому аккуратно)
+        pool = getattr(getattr(cls._http_client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is not None:
+            stats["pool_connections"] = len(connections)
+            stats["pool_idle_connections"] = sum(1 for conn in connections if conn.is_idle())
+        
+        return stats
+    
     @staticmethod
     def enhance_professional_terms(text: str) -> str:
         """Улучшение профессиональной терминологии в ответах"""
-        term_mapping = {
-            "покраска": "нанесение ЛКП",
-            "царапина": "нарушение целостности ЛКП",
-            "скол": " локальное повреждение ЛКП",
-            "полировка": "восстановление глянца ЛКП",
-            "покрытие": "защитное керамическое покрытие",
-            "чистка": "профессиональная химчистка"
-        }
-        
-        for common, professional in term_mapping.items():
-            text = text.replace(common, professional)
-        
-        return text
+        return reply_pipeline.terms.rewrite(text)
     
     @staticmethod
     def format_with_markdown(text: str) -> str:
-        """Преобразует текст в Markdown-формат для лучшего отображения"""
-        # Сначала экранируем весь текст
-        text = escape_markdown_text(text)
-        
-        # Затем добавляем форматирование
-        text = re.sub(r'(\d+\.\s+)([^:\n]+:)', r'\1**\2**', text)
-        text = re.sub(r'(\d+\.\s+)([^\n]+)', r'\1**\2**', text)
-        
-        # Добавляем жирный шрифт к подзаголовкам
-        text = re.sub(r'([А-Яа-яA-Za-z]+:)', r'**\1**', text)
-        
-        # Улучшаем форматирование списков
-        text = re.sub(r'^(\s*[-•*])\s+', r'• ', text, flags=re.MULTILINE)
-        
-        return text
+        """Преобразует текст в MarkdownV2-разметку для лучшего отображения"""
+        return reply_pipeline.formatter.format(text)
     
     @staticmethod
     def create_system_prompt():
@@ -398,8 +717,8 @@ class YandexGPTClient:
 """
     
     @staticmethod
-    async def generate_response(user_message: str) -> str:
-        """Генерация ответа через YandexGPT API"""
+    def build_request(user_message: str, stream: bool = False, user_id=None):
+        """Формирует заголовки и тело запроса к YandexGPT (с историей диалога пользователя)"""
         headers = {
             "Authorization": f"Bearer {CONFIG['YANDEX_API_KEY']}",
             "x-folder-id": CONFIG['YANDEX_FOLDER_ID'],
@@ -409,10 +728,15 @@ class YandexGPTClient:
         # Формирование системного промпта
         system_prompt = YandexGPTClient.create_system_prompt()
         
+        # Недавние реплики диалога в пределах бюджета токенов
+        history = conversation_memory.history(
+            user_id, estimate_tokens(system_prompt) + estimate_tokens(user_message)
+        )
+        
         payload = {
             "modelUri": f"gpt://{CONFIG['YANDEX_FOLDER_ID']}/yandexgpt",
             "completionOptions": {
-                "stream": False,
+                "stream": stream,
                 "temperature": MODEL_CONFIG["temperature"],
                 "maxTokens": MODEL_CONFIG["max_tokens"]
             },
@@ -421,38 +745,161 @@ class YandexGPTClient:
                     "role": "system",
                     "text": system_prompt
                 },
+                *history,
                 {
                     "role": "user",
                     "text": user_message
                 }
             ]
         }
+        return headers, payload
+    
+    @staticmethod
+    def postprocess(text: str) -> str:
+        """Улучшает профессиональные термины и добавляет Markdown-разметку"""
+        started = time.perf_counter()
+        text = reply_pipeline.process(text)
+        POSTPROCESS_SECONDS.observe(time.perf_counter() - started)
+        tracer.record('postprocess', started)
+        return text
+    
+    @staticmethod
+    def get_cached_response(user_message: str, payload):
+        """Ищет готовый ответ в кэше; возвращает (ключ кэша, ответ или None)"""
+        # Ответ с учетом истории диалога зависит не только от вопроса - кэш не используем
+        if len(payload['messages']) > 2:
+            return "", None
+        
+        # Кэш сбрасывается при любом изменении конфигурации салона, промпта или модели
+        response_cache.ensure_fingerprint(make_fingerprint(
+            payload['messages'][0]['text'], SALON_CONFIG, payload['modelUri'], MODEL_CONFIG
+        ))
+        cache_key = normalize_question(user_message)
+        return cache_key, response_cache.get(cache_key)
+    
+    @classmethod
+    async def _complete(cls, headers, payload):
+        """Одна попытка запроса к YandexGPT: сырой текст ответа"""
+        response = await cls._post(YANDEX_GPT_URL, headers, payload)
+        response.raise_for_status()
+        data = response.json()
+        return data['result']['alternatives'][0]['message']['text'].strip()
+    
+    @staticmethod
+    async def generate_response(user_message: str, user_id=None) -> str:
+        """Генерация ответа через YandexGPT API"""
+        headers, payload = YandexGPTClient.build_request(user_message, user_id=user_id)
+        
+        cache_key, cached = YandexGPTClient.get_cached_response(user_message, payload)
+        if cached is not None:
+            logger.info("Ответ YandexGPT взят из кэша")
+            conversation_memory.add_exchange(user_id, user_message, unescape_markdown_text(cached))
+            return cached
 
+        llm_started = time.perf_counter()
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(YANDEX_GPT_URL, headers=headers, json=payload)
-                response.raise_for_status()
-                data = response.json()
-                result = data['result']['alternatives'][0]['message']['text'].strip()
-                
-                # Улучшаем профессиональные термины и добавляем Markdown-разметку
-                result = YandexGPTClient.enhance_professional_terms(result)
-                result = YandexGPTClient.format_with_markdown(result)
-                
-                return result
+            result = await yandex_resilience.call(lambda: YandexGPTClient._complete(headers, payload))
+            observe_llm('complete', 'ok', llm_started)
+            # Проверка до записи в историю: отклоненный ответ не должен вернуться в модель
+            verdict = output_guard.check(result)
+            if not verdict.allowed:
+                # Отклоненный ответ не кэшируется: иначе он уйдет другим пользователям без проверки
+                return apply_output_guard(user_id, result, verdict)
+            conversation_memory.add_exchange(user_id, user_message, result)
+            
+            # Улучшаем профессиональные термины и добавляем Markdown-разметку
+            result = YandexGPTClient.postprocess(result)
+            
+            # Кэшируем только успешные и разрешенные проверкой ответы
+            response_cache.put(cache_key, result)
+            return result
                 
+        except ConcurrencyLimitExceeded as e:
+            observe_llm('complete', 'busy', llm_started)
+            logger.warning("Запрос к YandexGPT не дождался очереди: %s", e)
+            return escape_markdown_text(BUSY_REPLY)
+        except CircuitOpenError:
+            observe_llm('complete', 'circuit_open', llm_started)
+            # Сервис недавно не отвечал - не заставляем пользователя ждать таймаутов
+            logger.warning("YandexGPT недоступен (предохранитель разомкнут), отвечаем локально")
+            return build_fallback_reply(user_message)
         except httpx.HTTPError as e:
-            logger.error(f"Ошибка HTTP при запросе к YandexGPT: {str(e)}")
-            return "Извините, произошла ошибка соединения. Пожалуйста, попробуйте позже."
+            observe_llm('complete', 'error', llm_started)
+            logger.error("Ошибка HTTP при запросе к YandexGPT: %s", e)
+            if yandex_resilience.is_retryable(e):
+                return build_fallback_reply(user_message)
+            return escape_markdown_text("Извините, произошла ошибка соединения. Пожалуйста, попробуйте позже.")
         except Exception as e:
-            logger.error(f"Неожиданная ошибка в YandexGPT: {str(e)}")
-            return "Извините, произошла техническая ошибка. Пожалуйста, попробуйте позже."
+            observe_llm('complete', 'error', llm_started)
+            logger.error("Неожиданная ошибка в YandexGPT: %s", e)
+            return escape_markdown_text("Извините, произошла техническая ошибка. Пожалуйста, попробуйте позже.")
+    
+    @classmethod
+    async def _stream_once(cls, headers, payload):
+        """Один потоковый запрос: отдает накопленный сырой текст ответа по мере поступления.
+        
+        Yandex присылает JSON-объекты построчно, в каждом - весь текст, сгенерированный к этому моменту.
+        """
+        client = cls.get_http_client()
+        text = ""
+        async with yandex_limiter.slot() as slot:
+            start_time = time.perf_counter()
+            cls._pool_stats["requests"] += 1
+            try:
+                async with client.stream("POST", YANDEX_GPT_URL, headers=headers, json=payload,
+                                         extensions={"trace": cls._make_trace()}) as response:
+                    slot.set_status(response.status_code)
+                    response.raise_for_status()
+                    if response.http_version == "HTTP/2":
+                        cls._pool_stats["http2_requests"] += 1
+                    
+                    async for line in response.aiter_lines():
+                        line = line.strip()
+                        if not line:
+                            continue
+                        chunk = json.loads(line)['result']['alternatives'][0]['message']['text']
+                        # Поддерживаем и накопительный, и дельта-формат чанков
+                        text = chunk if chunk.startswith(text) else text + chunk
+                        yield text
+            except httpx.HTTPError:
+                cls._pool_stats["errors"] += 1
+                raise
+            finally:
+                cls._latencies.append(time.perf_counter() - start_time)
+    
+    @classmethod
+    async def stream_response(cls, user_message: str, headers, payload):
+        """Потоковая генерация с предохранителем: сбой до первого фрагмента повторяется,
+        после начала выдачи ошибки HTTP пробрасываются вызывающему коду.
+        """
+        for attempt in range(yandex_resilience.config['MAX_RETRIES'] + 1):
+            yandex_resilience.ensure_allowed()
+            start_time = time.monotonic()
+            started = False
+            settled = False
+            try:
+                async for text in cls._stream_once(headers, payload):
+                    started = True
+                    yield text
+            except httpx.HTTPError as e:
+                settled = True
+                delay = yandex_resilience.retry_delay(e, attempt, can_retry=not started)
+                if delay is None:
+                    raise
+                logger.warning("Повтор потокового запроса к YandexGPT через %.2f сек: %s", delay, e)
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if not settled and not started:
+                    # Генератор закрыт до ответа сервиса - пробная попытка предохранителя не состоялась
+                    yandex_resilience.breaker.cancel_trial()
+            yandex_resilience.record_success(time.monotonic() - start_time)
+            return
 
 # ==================== СИМУЛЯЦИЯ ЧЕЛОВЕЧЕСКОГО ПОВЕДЕНИЯ ====================
 
-async def simulate_typing(chat_id, context, text_length):
-    """Симуляция печатания человека с учетом длины текста"""
-    # Расчет времени печатания на основе длины текста
+def calculate_typing_time(text_length):
+    """Расчет времени печатания человека с учетом длины текста"""
     base_typing_time = text_length / HUMAN_SIMULATION['chars_per_second']
     
     # Добавление вариативности
@@ -460,16 +907,13 @@ async def simulate_typing(chat_id, context, text_length):
     typing_time = base_typing_time + random.uniform(-variation, variation)
     
     # Ограничение минимального и максимального времени
-    typing_time = max(HUMAN_SIMULATION['min_typing_delay'], 
-                     min(typing_time, HUMAN_SIMULATION['max_typing_delay']))
-    
-    # Симуляция печатания с обновлением статуса
-    start_time = time.time()
-    while time.time() - start_time < typing_time:
-        await context.bot.send_chat_action(chat_id=chat_id, action="typing")
-        await asyncio.sleep(4.5)  # Обновляем статус каждые 4.5 секунд (Telegram скрывает через 5)
-    
-    return typing_time
+    return max(HUMAN_SIMULATION['min_typing_delay'], 
+               min(typing_time, HUMAN_SIMULATION['max_typing_delay']))
+
+async def human_pause(min_delay, max_delay):
+    """Короткая "человеческая" пауза перед ответом (отключается вместе с симуляцией)"""
+    if HUMAN_SIMULATION['enabled']:
+        await asyncio.sleep(random.uniform(min_delay, max_delay))
 
 async def simulate_human_typing_mistakes(text):
     """Добавление случайных опечаток для естественности"""
@@ -508,24 +952,24 @@ async def simulate_human_typing_mistakes(text):
     
     return " ".join(words)
 
-async def simulate_typing_with_errors(chat_id, context, text):
-    """Полная симуляция печатания с возможными ошибками и исправлениями"""
-    # Первая попытка "печатания"
-    typing_time = await simulate_typing(chat_id, context, len(text))
+async def simulate_typing_with_errors(chat_id, context, text, elapsed=0.0):
+    """Симуляция печатания с возможной "ошибкой" и исправлением.
+    
+    Статус "печатает" поддерживает typing_status, здесь только выдерживается оставшаяся
+    часть "человеческой" задержки: время, уже потраченное на генерацию (elapsed), вычитается.
+    Возвращает (целевое время печатания, фактическая дополнительная пауза).
+    """
+    typing_time = calculate_typing_time(len(text))
     
     # Случайная "ошибка" и перепечатывание
     if random.random() < HUMAN_SIMULATION['error_probability']:
-        await asyncio.sleep(0.5)
-        await context.bot.send_chat_action(chat_id=chat_id, action="typing")
-        await asyncio.sleep(1.5)
-        
-        # "Исправление" ошибки
-        await context.bot.send_chat_action(chat_id=chat_id, action="typing")
-        await asyncio.sleep(1.0)
-        
         typing_time += 3.0  # Добавляем время на исправление
     
-    return typing_time
+    remaining = max(0.0, typing_time - elapsed)
+    if remaining:
+        await asyncio.sleep(remaining)
+    
+    return typing_time, remaining
 
 # ==================== TELEGRAM HANDLERS ====================
 
@@ -537,8 +981,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log_user_action(user_id, "start", "User initiated /start command")
         
         # Симуляция печатания
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        await asyncio.sleep(random.uniform(1.5, 3.0))
+        typing_status.register(context.bot, update.effective_chat.id, duration=3.0)
+        await human_pause(1.5, 3.0)
         
         # Создаем приветственное сообщение с правильным экранированием
         welcome_msg = escape_markdown_text(
@@ -559,14 +1003,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(welcome_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
-        logger.info(f"Отправлено приветственное сообщение пользователю {user_id}")
+        await outbound.reply_text(update.message, welcome_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
+        logger.info("Отправлено приветственное сообщение пользователю %s", user_id)
         log_user_action(user_id, "start_success", "Welcome message sent")
         
     except Exception as e:
         logger.error(f"Ошибка в обработчике start: {e}")
         error_msg = escape_markdown_text("Добро пожаловать! Чем могу помочь?")
-        await update.message.reply_text(error_msg, parse_mode='MarkdownV2')
+        await outbound.reply_text(update.message, error_msg, parse_mode='MarkdownV2')
         log_user_action(update.effective_user.id, "start_error", f"Error: {str(e)}")
 
 @secure_handler
@@ -577,8 +1021,8 @@ async def handle_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log_user_action(user_id, "services", "User requested services list")
         
         # Симуляция печатания
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        await asyncio.sleep(random.uniform(2.0, 4.0))
+        typing_status.register(context.bot, update.effective_chat.id, duration=3.0)
+        await human_pause(2.0, 4.0)
         
         services_text = "\n".join([f"• {service}: {price}" for service, price in SALON_CONFIG['services'].items()])
         
@@ -594,14 +1038,14 @@ async def handle_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(services_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
-        logger.info(f"Отправлен список услуг пользователю {user_id}")
+        await outbound.reply_text(update.message, services_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
+        logger.info("Отправлен список услуг пользователю %s", user_id)
         log_user_action(user_id, "services_success", "Services list sent")
         
     except Exception as e:
         logger.error(f"Ошибка в обработчике services: {e}")
         error_msg = escape_markdown_text("Извините, произошла ошибка при загрузке услуг.")
-        await update.message.reply_text(error_msg, parse_mode='MarkdownV2')
+        await outbound.reply_text(update.message, error_msg, parse_mode='MarkdownV2')
         log_user_action(update.effective_user.id, "services_error", f"Error: {str(e)}")
 
 @secure_handler
@@ -627,18 +1071,19 @@ async def handle_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Если не найдете ответ — просто напишите свой вопрос!"
         )
         
-        await update.message.reply_text(
+        await outbound.reply_text(
+            update.message,
             faq_text,
             parse_mode='MarkdownV2',
             reply_markup=reply_markup
         )
-        logger.info(f"Показано меню FAQ пользователю {user_id}")
+        logger.info("Показано меню FAQ пользователю %s", user_id)
         log_user_action(user_id, "faq_success", "FAQ menu shown")
         
     except Exception as e:
         logger.error(f"Ошибка в обработчике FAQ: {e}")
         error_msg = escape_markdown_text("Извините, произошла ошибка при загрузке меню.")
-        await update.message.reply_text(error_msg, parse_mode='MarkdownV2')
+        await outbound.reply_text(update.message, error_msg, parse_mode='MarkdownV2')
         log_user_action(update.effective_user.id, "faq_error", f"Error: {str(e)}")
 
 @secure_handler
@@ -652,8 +1097,8 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "📎 Я обрабатываю только текстовые сообщения. "
             "Опишите вашу проблему текстом, и я с радостью помогу!"
         )
-        await update.message.reply_text(error_msg, parse_mode='MarkdownV2')
-        logger.info(f"Получен медиа-файл от пользователя {user_id}")
+        await outbound.reply_text(update.message, error_msg, parse_mode='MarkdownV2')
+        logger.info("Получен медиа-файл от пользователя %s", user_id)
         log_user_action(user_id, "media_response", "Media response sent")
         
     except Exception as e:
@@ -684,12 +1129,13 @@ async def handle_faq_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
                 
                 answer_text = escape_markdown_text(f"{answer}\n\nЕсть дополнительные вопросы? Звоните: {SALON_CONFIG['contacts']}")
                 
-                await query.edit_message_text(
+                await outbound.edit_query_message(
+                    query,
                     text=answer_text,
                     parse_mode='MarkdownV2',
                     reply_markup=reply_markup
                 )
-                logger.info(f"Показан ответ на вопрос {faq_key} пользователю {user_id}")
+                logger.info("Показан ответ на вопрос %s пользователю %s", faq_key, user_id)
                 log_user_action(user_id, "faq_answer_shown", f"FAQ answer shown: {faq_key}")
         
         elif callback_data == "back_to_faq":
@@ -709,7 +1155,8 @@ async def handle_faq_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
                 "Если не найдете ответ — просто напишите свой вопрос!"
             )
             
-            await query.edit_message_text(
+            await outbound.edit_query_message(
+                query,
                 faq_text,
                 parse_mode='MarkdownV2',
                 reply_markup=reply_markup
@@ -737,7 +1184,8 @@ async def handle_faq_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await query.edit_message_text(
+            await outbound.edit_query_message(
+                query,
                 welcome_msg,
                 parse_mode='MarkdownV2',
                 reply_markup=reply_markup
@@ -746,7 +1194,7 @@ async def handle_faq_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     except Exception as e:
         logger.error(f"Ошибка обработки callback: {e}")
         error_msg = escape_markdown_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте еще раз.")
-        await query.edit_message_text(error_msg, parse_mode='MarkdownV2')
+        await outbound.edit_query_message(query, error_msg, parse_mode='MarkdownV2')
         log_user_action(user_id, "callback_error", f"Error: {str(e)}")
 
 @secure_handler
@@ -774,7 +1222,8 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Если не найдете ответ — просто напишите свой вопрос!"
             )
             
-            await query.edit_message_text(
+            await outbound.edit_query_message(
+                query,
                 faq_text,
                 parse_mode='MarkdownV2',
                 reply_markup=reply_markup
@@ -797,7 +1246,7 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await query.edit_message_text(services_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
+            await outbound.edit_query_message(query, services_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
             
         elif query.data == "show_contacts":
             log_user_action(user_id, "main_menu", "Selected Contacts from main menu")
@@ -818,12 +1267,12 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await query.edit_message_text(contacts_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
+            await outbound.edit_query_message(query, contacts_msg, parse_mode='MarkdownV2', reply_markup=reply_markup)
             
     except Exception as e:
         logger.error(f"Ошибка обработки главного меню: {e}")
         error_msg = escape_markdown_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте еще раз.")
-        await query.edit_message_text(error_msg, parse_mode='MarkdownV2')
+        await outbound.edit_query_message(query, error_msg, parse_mode='MarkdownV2')
         log_user_action(user_id, "main_menu_error", f"Error: {str(e)}")
 
 @secure_handler
@@ -839,28 +1288,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
         
-        async with processing_lock:
-            # Инициализируем очередь для пользователя, если нужно
-            if user_id not in user_message_queues:
-                user_message_queues[user_id] = []
-            
-            # Добавляем сообщение в очередь
-            user_message_queues[user_id].append(context.safe_text)
-            
-            # Если уже есть задача обработки, отменяем ее
-            if user_id in user_processing_tasks:
-                try:
-                    user_processing_tasks[user_id].cancel()
-                except:
-                    pass
-            
-            # Создаем новую задачу обработки
-            user_processing_tasks[user_id] = asyncio.create_task(
-                process_user_messages(user_id, chat_id, context)
-            )
+        # Сообщение попадает в буфер пользователя, пачка уйдет в process_user_messages по окончании серии
+        message_coalescer.add(user_id, chat_id, context, context.safe_text)
         
     except Exception as e:
-        logger.error(f"Ошибка обработки сообщения: {e}")
+        logger.error("Ошибка обработки сообщения: %s", e)
         # Короткая задержка перед отправкой ошибки
         await asyncio.sleep(1.5)
         error_msg = (
@@ -870,111 +1302,542 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         # Экранируем сообщение об ошибке
         escaped_error_msg = escape_markdown_text(error_msg)
-        await update.message.reply_text(escaped_error_msg, parse_mode='MarkdownV2')
+        await outbound.reply_text(update.message, escaped_error_msg, parse_mode='MarkdownV2')
         log_user_action(update.effective_user.id, "message_error", f"Error: {str(e)}")
 
 # ==================== WEBHOOK HANDLERS ====================
 
+# Результаты вебхуков для /metrics
+_WEBHOOK_RESULTS = {status: WEBHOOK_REQUESTS.labels(status) for status in
+                    ('ok', 'buffered', 'forbidden', 'rate_limited', 'overloaded', 'invalid', 'not_ready', 'error')}
+_WEBHOOK_GLOBAL_LIMIT = SECURITY_REJECTIONS.labels('webhook_global_limit')
+
 async def handle_webhook(request):
     """Обработчик вебхука от Telegram с проверкой секретного токена"""
+    started = time.perf_counter()
+    status = 'error'
+    trace = None
     try:
         # Проверка секретного токена
         expected_token = CONFIG['WEBHOOK_SECRET']
         received_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
         
-        if expected_token != received_token:
-            logger.warning(f"Invalid webhook secret token: {received_token}")
+        if not hmac.compare_digest(received_token, expected_token):
+            logger.warning("Invalid webhook secret token: %s", received_token)
+            status = 'forbidden'
             return web.Response(text="Invalid token", status=403)
         
         data = await request.json()
         update_id = data.get('update_id', 'unknown')
-        logger.info(f"Получен вебхук #{update_id}")
+        logger.info("Получен вебхук #%s", update_id, extra=WEBHOOK_RECEIVED)
+        # Трасса обновления: от приема вебхука до отправки ответа
+        trace = tracer.start(data.get('update_id'), started)
         
         # Проверка безопасности на уровне вебхука
-        if not security.check_global_limit(max_requests=CONFIG['MAX_REQUESTS_PER_MINUTE'], period=60):
+        if not await security.check_global_limit(max_requests=CONFIG['MAX_REQUESTS_PER_MINUTE'], period=60):
+            _WEBHOOK_GLOBAL_LIMIT.inc()
+            status = 'rate_limited'
             return web.Response(text="Rate limit exceeded", status=429)
         
-        if bot_app is None:
-            logger.error("Бот не инициализирован при обработке вебхука")
-            return web.Response(text="Bot not initialized", status=500)
-        
-        update = Update.de_json(data, bot_app.bot)
-        await bot_app.process_update(update)
-        
+        if not bot_ready:
+            if boot_buffer is None:
+                logger.error("Бот не инициализирован при обработке вебхука")
+                status = 'not_ready'
+                return web.Response(text="Bot not initialized", status=500)
+            # Быстрый старт: обновление дождется окончания инициализации
+            if len(boot_buffer) >= CONFIG['BOOT_BUFFER_SIZE']:
+                status = 'overloaded'
+                return web.Response(text="Bot is starting", status=429)
+            boot_buffer.append((data, trace))
+            status = 'buffered'
+            return web.Response(text="OK")
+        
+        # Обработка идет в фоне; при переполнении очереди Telegram повторит доставку позже
+        if not dispatch_update(data, trace):
+            logger.warning("Очередь обновлений переполнена, вебхук #%s отклонен", update_id)
+            status = 'overloaded'
+            return web.Response(text="Too many pending updates", status=429)
+        
+        status = 'ok'
         return web.Response(text="OK")
         
     except json.JSONDecodeError:
         logger.error("Неверный JSON в вебхуке")
+        status = 'invalid'
         return web.Response(text="Invalid JSON", status=400)
     except Exception as e:
-        logger.error(f"Ошибка обработки вебхука: {e}")
+        logger.error("Ошибка обработки вебхука: %s", e)
         return web.Response(text="OK")  # Всегда возвращаем OK для Telegram
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started)
+        _WEBHOOK_RESULTS[status].inc()
+        if trace is not None:
+            if status in ('ok', 'buffered'):
+                trace.add_span('webhook', started, status=status)
+            else:
+                tracer.discard(trace.update_id)
+
+def dispatch_update(data, trace=None):
+    """Декодирует обновление и ставит его в очередь диспетчера; False - очередь переполнена"""
+    decode_started = time.perf_counter()
+    update = Update.de_json(data, bot_app.bot)
+    UPDATE_DECODE_SECONDS.observe(time.perf_counter() - decode_started)
+    if trace is not None:
+        trace.add_span('decode', decode_started)
+    return update_dispatcher.submit(get_chat_key(update), update)
+
+def drain_boot_buffer():
+    """Передает диспетчеру обновления, принятые до готовности бота, в порядке получения"""
+    global boot_buffer
+    drained = 0
+    while boot_buffer:
+        data, trace = boot_buffer.popleft()
+        try:
+            accepted = dispatch_update(data, trace)
+        except Exception as e:
+            logger.error("Ошибка обработки отложенного обновления: %s", e)
+            accepted = False
+        if accepted:
+            drained += 1
+        else:
+            # Telegram уже получил OK - повторной доставки не будет
+            logger.warning("Отложенное обновление #%s отброшено", data.get('update_id'))
+            if trace is not None:
+                tracer.discard(trace.update_id)
+    boot_buffer = None
+    return drained
+
+async def process_traced_update(update):
+    """Обработка обновления из очереди диспетчера в контексте его трассы"""
+    trace = tracer.take(update.update_id)
+    if trace is None:
+        return await bot_app.process_update(update)
+    
+    # Ожидание в очереди диспетчера - от ответа на вебхук до начала обработки
+    trace.add_span('dispatch_wait', trace.cursor)
+    token = current_trace.set(trace)
+    try:
+        with trace.span('handler'):
+            await bot_app.process_update(update)
+    finally:
+        current_trace.reset(token)
+        # Текстовые сообщения ждут в буфере - трассу завершит обработка пачки
+        if not trace.deferred:
+            tracer.finish(trace)
 
 async def handle_health(request):
     """Проверка здоровья сервиса"""
     return web.Response(text="✅ Bot is alive and healthy")
 
+async def handle_worker_stats(request):
+    """Нагрузка воркера для отчета супервизора (доступно только на 127.0.0.1)"""
+    return web.json_response({
+        'worker_id': CONFIG['WORKER_ID'],
+        'pid': os.getpid(),
+        'dispatcher': update_dispatcher.get_stats() if update_dispatcher is not None else None,
+        'poller': update_poller.get_stats() if update_poller is not None else None,
+        'coalescer': message_coalescer.get_stats(),
+        'yandex_pool': YandexGPTClient.get_pool_stats(),
+        'yandex_limiter': yandex_limiter.get_stats(),
+        'yandex_resilience': yandex_resilience.get_stats(),
+        'response_cache': response_cache.get_stats(),
+        'security_storage': security.storage.get_stats(),
+        'outbound': outbound.get_stats(),
+        'typing': typing_status.get_stats(),
+        'conversation_memory': conversation_memory.get_stats(),
+        'output_guard': output_guard.get_stats(),
+        'tracing': tracer.get_stats(),
+        'profiling': profiling.get_stats(),
+        'logging': log_pipeline.get_stats(),
+        'startup': boot_timer.report(),
+    })
+
+def check_metrics_token(request):
+    """Если задан METRICS_TOKEN, /metrics отдается только с ним"""
+    token = METRICS_CONFIG['TOKEN']
+    if not token:
+        return True
+    header = request.headers.get('Authorization', '')
+    received = header[7:] if header.startswith('Bearer ') else request.headers.get('X-Admin-Token', '')
+    return hmac.compare_digest(received, token)
+
+async def handle_metrics(request):
+    """Метрики процесса в текстовом формате Prometheus"""
+    if not check_metrics_token(request):
+        return web.Response(text="Forbidden", status=403)
+    return web.Response(body=metrics_registry.render().encode(),
+                        headers={'Content-Type': metrics_registry.CONTENT_TYPE})
+
+# ==================== ДИАГНОСТИКА ====================
+
+def check_admin_token(request):
+    token = CONFIG['ADMIN_TOKEN']
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+def _query_number(request, name, default):
+    try:
+        return float(request.query.get(name, default))
+    except ValueError:
+        return default
+
+async def handle_admin_traces(request):
+    """Последние медленные трассы обновлений: GET /admin/traces?limit=20&min_ms=10000"""
+    if not check_admin_token(request):
+        return web.Response(text="Forbidden", status=403)
+    limit = int(_query_number(request, 'limit', 20))
+    min_ms = request.query.get('min_ms')
+    min_duration = _query_number(request, 'min_ms', 0) / 1000 if min_ms else None
+    return web.json_response({'stats': tracer.get_stats(),
+                              'traces': tracer.get_slow(limit, min_duration)})
+
+async def handle_admin_startup(request):
+    """Отчет о запуске процесса по этапам: GET /admin/startup"""
+    if not check_admin_token(request):
+        return web.Response(text="Forbidden", status=403)
+    return web.json_response(boot_timer.report())
+
+async def handle_admin_profile(request):
+    """Статистический профиль event loop: POST /admin/profile?seconds=10&interval=0.005"""
+    if not check_admin_token(request):
+        return web.Response(text="Forbidden", status=403)
+    try:
+        report = await profiling.cpu_profile(_query_number(request, 'seconds', 10),
+                                             _query_number(request, 'interval', 0))
+    except ProfilerBusy as e:
+        return web.Response(text=str(e), status=409)
+    if request.query.get('format') == 'collapsed':
+        return web.Response(text=report['collapsed'])
+    return web.json_response(report)
+
+async def handle_admin_tracemalloc(request):
+    """Рост памяти по строкам кода за время замера: POST /admin/tracemalloc?seconds=30"""
+    if not check_admin_token(request):
+        return web.Response(text="Forbidden", status=403)
+    try:
+        report = await profiling.memory_diff(_query_number(request, 'seconds', 30),
+                                             int(_query_number(request, 'limit', 0)) or None)
+    except ProfilerBusy as e:
+        return web.Response(text=str(e), status=409)
+    return web.json_response(report)
+
+def register_state_gauges():
+    """Текущая глубина очередей и размер состояния вычисляются при чтении /metrics"""
+    gauges = (
+        ("dispatcher_pending_updates", "Обновления в очереди пула обработки",
+         lambda: update_dispatcher.get_stats()['pending'] if update_dispatcher is not None else None),
+        ("coalescer_pending_messages", "Сообщения, ожидающие склейки",
+         lambda: message_coalescer.get_stats()['pending_messages']),
+        ("coalescer_active_users", "Пользователи с состоянием склейки",
+         lambda: message_coalescer.get_stats()['users']),
+        ("outbound_pending", "Вызовы Bot API в очереди", lambda: outbound.get_stats()['pending']),
+        ("outbound_in_flight", "Выполняющиеся вызовы Bot API", lambda: outbound.get_stats()['in_flight']),
+        ("llm_concurrency_limit", "Текущий лимит параллельных запросов к LLM",
+         lambda: yandex_limiter.get_stats()['limit']),
+        ("llm_in_flight", "Выполняющиеся запросы к LLM", lambda: yandex_limiter.get_stats()['in_flight']),
+        ("llm_queue_length", "Запросы к LLM в ожидании слота", lambda: yandex_limiter.get_stats()['queue_length']),
+        ("typing_active_chats", "Чаты со статусом \"печатает\"", lambda: typing_status.get_stats()['active_chats']),
+        ("blocked_users", "Заблокированные пользователи", lambda: security.storage.get_stats()['blocked_users']),
+        ("conversation_users", "Пользователи с историей диалога",
+         lambda: conversation_memory.get_stats()['users']),
+    )
+    for name, documentation, function in gauges:
+        metrics_registry.gauge(name, documentation).set_function(function)
+
+register_state_gauges()
+
 # ==================== ИНИЦИАЛИЗАЦИЯ И ЗАПУСК ====================
 
+# Типы обновлений, которые бот получает от Telegram
+WEBHOOK_ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Задача фоновой инициализации при быстром старте
+boot_task = None
+# Прием обновлений через getUpdates и проверка вебхука в режиме auto
+update_poller = None
+webhook_watch_task = None
+
+def build_application():
+    """Application с обработчиками (без обращений к сети)"""
+    builder = Application.builder().token(CONFIG['BOT_TOKEN'])
+    if CONFIG['TELEGRAM_API_BASE_URL']:
+        builder = builder.base_url(CONFIG['TELEGRAM_API_BASE_URL'])
+    application = builder.build()
+    
+    # Регистрация обработчиков
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("services", handle_services))
+    application.add_handler(CommandHandler("uslugi", handle_services))  # Русская версия
+    application.add_handler(CommandHandler("faq", handle_faq))  # Добавляем команду /faq
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    
+    # Обработчик медиа-файлов
+    application.add_handler(MessageHandler(
+        filters.AUDIO | filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.VOICE, 
+        handle_media
+    ))
+    
+    # Обработчики callback-запросов
+    application.add_handler(CallbackQueryHandler(handle_faq_callback, pattern="^faq_"))
+    application.add_handler(CallbackQueryHandler(handle_faq_callback, pattern="^back_to_"))
+    application.add_handler(CallbackQueryHandler(handle_main_menu, pattern="^show_"))
+    return application
+
+async def ensure_webhook():
+    """Устанавливает вебхук, только если Telegram знает другой адрес или другие типы обновлений.
+
+    Секретный токен getWebhookInfo не возвращает: после смены WEBHOOK_SECRET вебхук
+    переустанавливается, когда Telegram сообщает об ошибке 403, или принудительно (WEBHOOK_FORCE_SET=1).
+    """
+    if not CONFIG['WEBHOOK_FORCE_SET']:
+        info = await bot_app.bot.get_webhook_info()
+        if (info.url == CONFIG['WEBHOOK_URL']
+                and set(info.allowed_updates or ()) == set(WEBHOOK_ALLOWED_UPDATES)
+                and '403' not in (info.last_error_message or '')):
+            logger.info("Вебхук уже установлен: %s, ожидают доставки %s", info.url, info.pending_update_count)
+            return False
+    await bot_app.bot.set_webhook(
+        CONFIG['WEBHOOK_URL'],
+        allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+        secret_token=CONFIG['WEBHOOK_SECRET']
+    )
+    logger.info(f"Вебхук установлен: {CONFIG['WEBHOOK_URL']}")
+    return True
+
+async def setup_ingestion():
+    """Вебхук или getUpdates по UPDATE_MODE; возвращает причину перехода на getUpdates или None"""
+    mode = CONFIG['UPDATE_MODE']
+    if mode == 'polling':
+        reason = "UPDATE_MODE=polling"
+    elif mode == 'auto' and not CONFIG['WEBHOOK_URL']:
+        reason = "WEBHOOK_URL не задан"
+    else:
+        if not CONFIG['SET_WEBHOOK']:
+            return None
+        try:
+            await ensure_webhook()
+            return None
+        except TelegramError as e:
+            if mode != 'auto':
+                raise
+            reason = f"вебхук не установлен: {e}"
+    # Пока вебхук установлен, Telegram отвечает на getUpdates ошибкой 409
+    await bot_app.bot.delete_webhook()
+    return reason
+
+def start_polling(reason):
+    update_poller.start()
+    logger.info("Прием обновлений через getUpdates: %s", reason)
+
+def webhook_failing(info, since):
+    """Telegram не может доставить вебхук: адреса нет или с момента since были ошибки при непустой очереди"""
+    if not info.url:
+        return True
+    if not info.pending_update_count or info.last_error_date is None:
+        return False
+    return info.last_error_date.timestamp() > since
+
+async def webhook_reachable():
+    """Публичный адрес вебхука снова отвечает (проверка /health через внешний адрес)"""
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=10)) as session:
+            async with session.get(CONFIG['WEBHOOK_URL'].rstrip('/') + "/health") as response:
+                return response.status == 200
+    except (ClientError, asyncio.TimeoutError):
+        return False
+
+async def watch_webhook():
+    """Режим auto: переход на getUpdates, когда вебхук недоступен, и возврат, когда он снова отвечает"""
+    interval = CONFIG['WEBHOOK_CHECK_INTERVAL']
+    # Ошибки доставки до последнего переключения относятся к прошлому вебхуку
+    switched_at = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if update_poller.running:
+                # Возврат пробуется не чаще раза в 5 проверок, чтобы не переключаться туда и обратно
+                if (time.time() - switched_at >= 5 * interval and CONFIG['WEBHOOK_URL']
+                        and await webhook_reachable()):
+                    # Опрос останавливается первым: после setWebhook getUpdates получит 409
+                    await update_poller.stop()
+                    switched_at = time.time()
+                    try:
+                        await ensure_webhook()
+                    except TelegramError as e:
+                        start_polling(f"вебхук не установлен: {e}")
+                        continue
+                    logger.info("Вебхук снова доступен, прием обновлений через вебхук")
+                continue
+            info = await bot_app.bot.get_webhook_info()
+            if webhook_failing(info, max(switched_at, time.time() - 2 * interval)):
+                await bot_app.bot.delete_webhook()
+                switched_at = time.time()
+                start_polling(f"Telegram не может доставить вебхук ({info.pending_update_count} в очереди): "
+                              f"{info.last_error_message or 'адрес не установлен'}")
+        except Exception as e:
+            logger.error("Ошибка проверки вебхука: %s", e)
+
+async def _boot_step(name, step, before_retry=None):
+    """Шаг инициализации с повторами: при ошибке повторяется только он, остальные шаги не трогаются.
+
+    step - фабрика корутины (повтор создает новую), before_retry - подготовка к повтору.
+    """
+    for attempt in range(1, CONFIG['BOOT_RETRIES'] + 1):
+        try:
+            with boot_timer.step(name):
+                if attempt > 1 and before_retry is not None:
+                    await before_retry()
+                return await step()
+        except Exception as e:
+            if attempt == CONFIG['BOOT_RETRIES']:
+                raise
+            logger.warning("Шаг запуска %s не удался (попытка %s): %s", name, attempt, e)
+            await asyncio.sleep(2 ** attempt)
+
+async def connect_bot():
+    """Сетевая часть инициализации: шаги независимы и выполняются одновременно.
+
+    Возвращает причину приема обновлений через getUpdates или None (вебхук).
+    """
+    results = await asyncio.gather(
+        # После неудачного getMe Bot уже помечен инициализированным и сам запрос не повторит
+        _boot_step('telegram_initialize', bot_app.initialize, before_retry=bot_app.bot.get_me),
+        # В многопроцессном режиме вебхук устанавливает только один воркер
+        _boot_step('webhook', setup_ingestion),
+        # HTTP-клиент YandexGPT создается, пока запросы к Bot API ждут ответа
+        _boot_step('yandex_client', YandexGPTClient.startup),
+        # Ошибка одного шага не прерывает остальные: все завершаются до выхода из connect_bot
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results[1]
+
+def mark_ready():
+    """Бот готов: сначала в диспетчер уходят отложенные обновления, затем вебхук передает их сразу"""
+    global bot_ready
+    # Без await между выгрузкой буфера и флагом - новые вебхуки не обгонят отложенные
+    drained = drain_boot_buffer() if boot_buffer is not None else 0
+    bot_ready = True
+    boot_timer.ready(mode='fast' if CONFIG['FAST_BOOT'] else 'standard', buffered_updates=drained)
+    for phase, seconds in {**boot_timer.phases, **boot_timer.steps}.items():
+        STARTUP_SECONDS.labels(phase).set(seconds)
+    STARTUP_SECONDS.labels('total').set(boot_timer.elapsed())
+    report = boot_timer.report()
+    logger.info("Бот готов через %s мс после запуска процесса: %s", report['total_ms'], report['phases_ms'],
+                extra=log_extra('startup_report', **report))
+
 async def initialize_bot():
     """Инициализация бота один раз при старте"""
-    global bot_app
+    global bot_app, update_dispatcher, update_poller, webhook_watch_task
     
     try:
         logger.info("Инициализация бота...")
-        bot_app = Application.builder().token(CONFIG['BOT_TOKEN']).build()
-        
-        # Регистрация обработчиков
-        bot_app.add_handler(CommandHandler("start", start))
-        bot_app.add_handler(CommandHandler("services", handle_services))
-        bot_app.add_handler(CommandHandler("uslugi", handle_services))  # Русская версия
-        bot_app.add_handler(CommandHandler("faq", handle_faq))  # Добавляем команду /faq
-        bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        
-        # Обработчик медиа-файлов
-        bot_app.add_handler(MessageHandler(
-            filters.AUDIO | filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.VOICE, 
-            handle_media
-        ))
+        bot_app = build_application()
+        
+        # Фоновый планировщик сроков блокировок и предупреждений
+        security.start_background_tasks()
         
-        # Обработчики callback-запросов
-        bot_app.add_handler(CallbackQueryHandler(handle_faq_callback, pattern="^faq_"))
-        bot_app.add_handler(CallbackQueryHandler(handle_faq_callback, pattern="^back_to_"))
-        bot_app.add_handler(CallbackQueryHandler(handle_main_menu, pattern="^show_"))
+        # Пул обработки обновлений: параллельно между чатами, по порядку внутри чата
+        update_dispatcher = UpdateDispatcher(process_traced_update)
+        update_dispatcher.start()
+        # Альтернативный прием обновлений в тот же диспетчер
+        update_poller = UpdatePoller(bot_app.bot, update_dispatcher, WEBHOOK_ALLOWED_UPDATES)
         
         # Запускаем очистку очередей
         asyncio.create_task(cleanup_message_queues())
-        
-        # Инициализация и установка вебхука с секретным токеном
-        await bot_app.initialize()
-        await bot_app.bot.set_webhook(
-            CONFIG['WEBHOOK_URL'],
-            allowed_updates=["message", "callback_query"],
-            secret_token=CONFIG['WEBHOOK_SECRET']
-        )
-        
-        logger.info(f"Вебхук установлен: {CONFIG['WEBHOOK_URL']}")
+        boot_timer.mark('setup')
+        
+        # Инициализация (getMe), вебхук с секретным токеном и общий HTTP-клиент YandexGPT
+        polling_reason = await connect_bot()
+        boot_timer.mark('connect')
+        
+        mark_ready()
+        # Опрос начинается, когда бот готов обрабатывать обновления
+        if polling_reason:
+            start_polling(polling_reason)
+        if CONFIG['UPDATE_MODE'] == 'auto':
+            webhook_watch_task = asyncio.create_task(watch_webhook())
         logger.info("Бот успешно инициализирован")
         
     except Exception as e:
         logger.critical(f"Ошибка инициализации бота: {e}")
         raise
 
-async def init_app():
-    """Инициализация aiohttp приложения"""
-    await initialize_bot()
-    
+async def boot_in_background():
+    """Быстрый старт: инициализация после открытия порта; при неудаче процесс завершается"""
+    try:
+        await initialize_bot()
+    except Exception:
+        # Обновления в буфере не будут обработаны - перезапуск платформой лучше зависшего процесса
+        logger.critical("Процесс завершается, потеряно принятых обновлений: %s",
+                        len(boot_buffer) if boot_buffer is not None else 0)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+def on_listening(message):
+    """Вызывается aiohttp после открытия порта (вместо печати адреса)"""
+    global boot_task
+    boot_timer.mark('listener')
+    logger.info("Порт открыт: %s", message.splitlines()[0].strip("= "))
+    if CONFIG['FAST_BOOT'] and boot_task is None:
+        boot_task = asyncio.get_event_loop().create_task(boot_in_background())
+
+async def shutdown_app(app):
+    """Освобождение ресурсов при остановке aiohttp приложения"""
+    for task in (boot_task, webhook_watch_task):
+        if task is not None and not task.done():
+            task.cancel()
+    # Опрос останавливается до диспетчера и подтверждает принятые обновления
+    if update_poller is not None:
+        await update_poller.stop()
+    if update_dispatcher is not None:
+        await update_dispatcher.stop()
+    await typing_status.stop()
+    # Ответы, уже поставленные в очередь, успевают уйти до остановки
+    await outbound.stop()
+    await YandexGPTClient.shutdown()
+    await security.stop_background_tasks()
+    # Записи об остановке успевают попасть на диск
+    log_pipeline.flush()
+
+def create_app():
+    """aiohttp приложение с маршрутами (бот инициализируется отдельно)"""
     app = web.Application()
     app.router.add_post("/", handle_webhook)
     app.router.add_get("/health", handle_health)
     app.router.add_get("/", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    # Диагностика доступна на публичном порту - только с явно заданным ADMIN_TOKEN
+    if CONFIG['ADMIN_TOKEN']:
+        app.router.add_get("/admin/traces", handle_admin_traces)
+        app.router.add_get("/admin/startup", handle_admin_startup)
+        app.router.add_post("/admin/profile", handle_admin_profile)
+        app.router.add_post("/admin/tracemalloc", handle_admin_tracemalloc)
+    else:
+        logger.info("ADMIN_TOKEN не задан: /admin/* отключены")
+    if CONFIG['ROLE'] == 'worker':
+        app.router.add_get("/stats", handle_worker_stats)
+        metrics_registry.set_const_labels(worker=CONFIG['WORKER_ID'])
+    app.on_cleanup.append(shutdown_app)
     
     return app
 
+async def init_app():
+    """Инициализация aiohttp приложения"""
+    await initialize_bot()
+    return create_app()
+
 def main():
     """Основная функция запуска"""
+    global boot_buffer
     logger.info("🚀 Запуск бота с YandexGPT...")
     
+    # Несколько процессов: этот процесс становится фронтом и запускает воркеры
+    if CONFIG['WORKERS'] > 1 and CONFIG['ROLE'] != 'worker':
+        from supervisor import run_supervisor
+        return run_supervisor(CONFIG['WORKERS'])
+    
+    boot_timer.mark('module')
     try:
         # Настройка event loop для совместимости
         if os.name == 'nt':  # Windows
@@ -983,8 +1846,17 @@ def main():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-        app = loop.run_until_complete(init_app())
-        web.run_app(app, host="0.0.0.0", port=10000)
+        if CONFIG['FAST_BOOT']:
+            # Порт открывается сразу: после сна инстанса платформа и Telegram не ждут
+            # инициализации, вебхуки копятся в буфере до готовности бота
+            boot_buffer = deque()
+            app = create_app()
+        else:
+            app = loop.run_until_complete(init_app())
+        # Тот же loop, в котором запущены фоновые задачи из init_app
+        # Воркер принимает обновления только от супервизора
+        host = "127.0.0.1" if CONFIG['ROLE'] == 'worker' else "0.0.0.0"
+        web.run_app(app, host=host, port=CONFIG['PORT'], loop=loop, print=on_listening)
         
     except Exception as e:
         logger.critical(f"Критическая ошибка при запуске: {e}")
@@ -993,4 +1865,4 @@ def main():
     return 0
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())
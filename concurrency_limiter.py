@@ -0,0 +1,206 @@
+# concurrency_limiter.py
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Настройки адаптивного ограничения параллельных запросов к LLM
+CONCURRENCY_CONFIG = {
+    'INITIAL_LIMIT': float(os.getenv("LLM_INITIAL_CONCURRENCY", "4")),
+    'MIN_LIMIT': float(os.getenv("LLM_MIN_CONCURRENCY", "1")),
+    'MAX_LIMIT': float(os.getenv("LLM_MAX_CONCURRENCY", "20")),
+    'BACKOFF': 0.7,  # во сколько раз уменьшается лимит при перегрузке
+    'DECREASE_COOLDOWN': 1.0,  # не чаще одного уменьшения в секунду (сек)
+    'LATENCY_TOLERANCE': float(os.getenv("LLM_LATENCY_TOLERANCE", "2.5")),  # медленнее базовой во столько раз - перегрузка
+    'BASELINE_SMOOTHING': 0.05,
+    'MAX_QUEUE': int(os.getenv("LLM_MAX_QUEUE", "200")),
+    'QUEUE_TIMEOUT': float(os.getenv("LLM_QUEUE_TIMEOUT", "10")),  # максимальное ожидание в очереди (сек)
+    'LATENCY_WINDOW': 512,
+}
+
+class ConcurrencyLimitExceeded(Exception):
+    """Запрос не дождался свободного слота (очередь переполнена или не успеть к сроку)"""
+
+class _Slot:
+    """Разрешение на один запрос; результат запроса корректирует лимит"""
+    __slots__ = ('limiter', 'started_at', 'saturated', 'outcome')
+
+    def __init__(self, limiter, saturated):
+        self.limiter = limiter
+        self.started_at = time.monotonic()
+        self.saturated = saturated  # запрос занял последний свободный слот
+        self.outcome = None
+
+    def set_status(self, status_code):
+        """429 и 5xx - признак перегрузки, остальные ответы - нормальная работа сервиса"""
+        self.outcome = 'overload' if status_code == 429 or status_code >= 500 else 'success'
+
+    def finish(self, exc_type=None):
+        if exc_type is asyncio.CancelledError:
+            outcome = 'ignore'
+        elif exc_type is not None:
+            # Ответ получен - решает его статус; таймауты и обрывы соединения - перегрузка
+            outcome = self.outcome or 'overload'
+        else:
+            outcome = self.outcome or 'success'
+        self.limiter.release(self, outcome)
+
+class AdaptiveConcurrencyLimiter:
+    """Адаптивный лимит одновременных запросов (AIMD) с очередью ожидания по срокам.
+
+    Пока сервис отвечает быстро и лимит реально используется, лимит растет на 1 за каждые
+    limit успешных запросов. Ответы 429/5xx, ошибки соединения и задержка выше базовой
+    в LATENCY_TOLERANCE раз уменьшают лимит в BACKOFF раз. Запросы сверх лимита ждут в очереди
+    FIFO; запрос, который заведомо не успеет к своему сроку, отклоняется сразу.
+    """
+
+    def __init__(self, name="llm", initial_limit=None, min_limit=None, max_limit=None):
+        self.config = CONCURRENCY_CONFIG
+        self.name = name
+        self.min_limit = min_limit or self.config['MIN_LIMIT']
+        self.max_limit = max_limit or self.config['MAX_LIMIT']
+        self.limit = min(self.max_limit, max(self.min_limit, initial_limit or self.config['INITIAL_LIMIT']))
+        self.in_flight = 0
+        self.waiters = deque()  # futures в порядке очереди
+        self.baseline = None  # сглаженная задержка "здорового" запроса (сек)
+        self.last_decrease = 0.0
+        self.waits = deque(maxlen=self.config['LATENCY_WINDOW'])
+        self.stats = {'acquired': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0,
+                      'increases': 0, 'decreases': 0, 'overloads': 0, 'slow': 0}
+
+    def slot(self, timeout=None):
+        """Асинхронный контекст одного запроса: async with limiter.slot() as slot"""
+        return _SlotAcquirer(self, timeout)
+
+    def _has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+    def _expected_wait(self, position):
+        """Оценка ожидания для позиции в очереди: слоты освобождаются в среднем раз в baseline/limit"""
+        if self.baseline is None:
+            return 0.0
+        return position * self.baseline / max(1, int(self.limit))
+
+    async def acquire(self, timeout=None):
+        timeout = self.config['QUEUE_TIMEOUT'] if timeout is None else timeout
+        if self._has_capacity() and not self.waiters:
+            return self._grant(0.0)
+
+        if len(self.waiters) >= self.config['MAX_QUEUE']:
+            self.stats['rejected'] += 1
+            raise ConcurrencyLimitExceeded(f"Очередь запросов {self.name} переполнена ({len(self.waiters)})")
+        # Не занимаем очередь, если к сроку слот заведомо не освободится
+        if self._expected_wait(len(self.waiters) + 1) > timeout:
+            self.stats['rejected'] += 1
+            raise ConcurrencyLimitExceeded(f"Ожидание слота {self.name} превысит {timeout:.1f} сек")
+
+        self.stats['queued'] += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот выдан в момент истечения срока - возвращаем его
+                self.in_flight -= 1
+                self._wake()
+            self.stats['timeouts'] += 1
+            raise ConcurrencyLimitExceeded(f"Слот {self.name} не освободился за {timeout:.1f} сек")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.in_flight -= 1
+                self._wake()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+                self.waiters.remove(waiter)
+        return self._grant(time.monotonic() - queued_at, reserved=True)
+
+    def _grant(self, waited, reserved=False):
+        if not reserved:
+            self.in_flight += 1
+        self.stats['acquired'] += 1
+        self.waits.append(waited)
+        return _Slot(self, saturated=self.in_flight >= int(self.limit))
+
+    def _wake(self):
+        """Передает освободившиеся слоты ожидающим по порядку очереди"""
+        while self.waiters and self._has_capacity():
+            waiter = self.waiters.popleft()
+            if waiter.done():
+                continue  # запрос уже ушел по таймауту
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def release(self, slot, outcome):
+        self.in_flight -= 1
+        now = time.monotonic()
+        latency = now - slot.started_at
+
+        if outcome == 'success':
+            if self.baseline is not None and latency > self.baseline * self.config['LATENCY_TOLERANCE']:
+                self.stats['slow'] += 1
+                self._decrease(now)
+            elif slot.saturated and self.limit < self.max_limit:
+                # Растем, только если лимит действительно ограничивал нагрузку
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.stats['increases'] += 1
+            # Базовая задержка медленно подстраивается и под устойчивое замедление сервиса
+            alpha = self.config['BASELINE_SMOOTHING']
+            self.baseline = latency if self.baseline is None else (1 - alpha) * self.baseline + alpha * latency
+        elif outcome == 'overload':
+            self.stats['overloads'] += 1
+            self._decrease(now)
+
+        self._wake()
+
+    def _decrease(self, now):
+        # Одна волна ошибок от запросов, запущенных при старом лимите, уменьшает его один раз
+        if now - self.last_decrease < self.config['DECREASE_COOLDOWN']:
+            return
+        self.last_decrease = now
+        new_limit = max(self.min_limit, self.limit * self.config['BACKOFF'])
+        if new_limit < self.limit:
+            self.limit = new_limit
+            self.stats['decreases'] += 1
+            logger.warning(f"Лимит параллельных запросов {self.name} снижен до {self.limit:.1f}")
+
+    def get_stats(self):
+        waits = sorted(self.waits)
+
+        def percentile(fraction):
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(len(waits) * fraction))] * 1000, 1)
+
+        stats = dict(self.stats)
+        stats.update({
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'queue_length': len(self.waiters),
+            'baseline_latency_ms': round(self.baseline * 1000, 1) if self.baseline is not None else None,
+            'wait_p50_ms': percentile(0.5),
+            'wait_p99_ms': percentile(0.99),
+        })
+        return stats
+
+class _SlotAcquirer:
+    __slots__ = ('limiter', 'timeout', 'slot')
+
+    def __init__(self, limiter, timeout):
+        self.limiter = limiter
+        self.timeout = timeout
+        self.slot = None
+
+    async def __aenter__(self):
+        self.slot = await self.limiter.acquire(self.timeout)
+        return self.slot
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.slot.finish(exc_type)
+        return False
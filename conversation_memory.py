@@ -0,0 +1,137 @@
+# conversation_memory.py
+import os
+import sys
+import math
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Настройки истории диалога
+MEMORY_CONFIG = {
+    'ENABLED': os.getenv("CONVERSATION_MEMORY_ENABLED", "true").lower() == "true",
+    'MAX_TURNS': int(os.getenv("CONVERSATION_MAX_TURNS", "8")),  # реплик на пользователя (вопросы и ответы)
+    'INPUT_TOKEN_BUDGET': int(os.getenv("CONVERSATION_INPUT_TOKENS", "2000")),  # потолок входа: промпт + история + вопрос
+    'TURN_MAX_CHARS': int(os.getenv("CONVERSATION_TURN_MAX_CHARS", "800")),  # длинные реплики храним обрезанными
+    'IDLE_TTL': int(os.getenv("CONVERSATION_IDLE_TTL", "1800")),  # через сколько секунд забывать диалог
+    'CHARS_PER_TOKEN': 3.0,  # грубая оценка для русского текста
+}
+
+def estimate_tokens(text):
+    """Оценка числа токенов без обращения к токенизатору"""
+    return math.ceil(len(text) / MEMORY_CONFIG['CHARS_PER_TOKEN']) + 1 if text else 0
+
+class _Turn:
+    """Одна реплика диалога; число токенов считается один раз при сохранении"""
+    __slots__ = ('role', 'text', 'tokens')
+
+    def __init__(self, role, text):
+        self.role = role
+        self.text = text
+        self.tokens = estimate_tokens(text)
+
+class _Conversation:
+    __slots__ = ('turns', 'last_active')
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)  # кольцевой буфер: старые реплики вытесняются сами
+        self.last_active = 0.0
+
+class ConversationMemory:
+    """История диалогов пользователей с ограничением по токенам.
+
+    Для каждого пользователя хранится не больше MAX_TURNS последних реплик. В запрос попадают
+    самые новые реплики, пока их сумма вместе с системным промптом и текущим вопросом
+    укладывается в INPUT_TOKEN_BUDGET, поэтому размер промпта не растет с длиной диалога.
+    """
+
+    def __init__(self):
+        self.config = MEMORY_CONFIG
+        self.conversations = {}
+        self.stats = {'prompts': 0, 'prompts_with_history': 0, 'history_tokens_total': 0,
+                      'history_tokens_max': 0, 'trimmed_turns': 0, 'expired': 0}
+
+    def history(self, user_id, reserved_tokens=0, now=None):
+        """Сообщения истории для запроса (по порядку), укладывающиеся в бюджет токенов"""
+        if not self.config['ENABLED'] or user_id is None:
+            return []
+        now = now if now is not None else time.monotonic()
+        self.stats['prompts'] += 1
+
+        conversation = self.conversations.get(user_id)
+        if conversation is None:
+            return []
+        if now - conversation.last_active > self.config['IDLE_TTL']:
+            del self.conversations[user_id]
+            self.stats['expired'] += 1
+            return []
+
+        budget = self.config['INPUT_TOKEN_BUDGET'] - reserved_tokens
+        selected = []
+        used = 0
+        for turn in reversed(conversation.turns):
+            if used + turn.tokens > budget:
+                break
+            selected.append(turn)
+            used += turn.tokens
+
+        # История начинается с вопроса пользователя, а не с ответа без вопроса
+        while selected and selected[-1].role != 'user':
+            used -= selected.pop().tokens
+
+        self.stats['trimmed_turns'] += len(conversation.turns) - len(selected)
+        if selected:
+            self.stats['prompts_with_history'] += 1
+            self.stats['history_tokens_total'] += used
+            self.stats['history_tokens_max'] = max(self.stats['history_tokens_max'], used)
+        return [{'role': turn.role, 'text': turn.text} for turn in reversed(selected)]
+
+    def add_exchange(self, user_id, question, answer, now=None):
+        """Сохраняет вопрос пользователя и ответ ассистента"""
+        if not self.config['ENABLED'] or user_id is None:
+            return
+        conversation = self.conversations.get(user_id)
+        if conversation is None:
+            conversation = self.conversations[user_id] = _Conversation(self.config['MAX_TURNS'])
+
+        limit = self.config['TURN_MAX_CHARS']
+        conversation.turns.append(_Turn('user', question[:limit]))
+        conversation.turns.append(_Turn('assistant', answer[:limit]))
+        conversation.last_active = now if now is not None else time.monotonic()
+
+    def forget(self, user_id):
+        self.conversations.pop(user_id, None)
+
+    def evict_idle(self, now=None):
+        """Удаляет диалоги без активности дольше IDLE_TTL"""
+        now = now if now is not None else time.monotonic()
+        idle = [user_id for user_id, conversation in self.conversations.items()
+                if now - conversation.last_active > self.config['IDLE_TTL']]
+        for user_id in idle:
+            del self.conversations[user_id]
+        self.stats['expired'] += len(idle)
+        return len(idle)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        users = len(self.conversations)
+        turns = 0
+        memory = 0
+        for conversation in self.conversations.values():
+            turns += len(conversation.turns)
+            memory += sys.getsizeof(conversation) + sys.getsizeof(conversation.turns)
+            memory += sum(sys.getsizeof(turn) + sys.getsizeof(turn.text) for turn in conversation.turns)
+        with_history = stats.pop('prompts_with_history')
+        history_tokens = stats.pop('history_tokens_total')
+        stats.update({
+            'users': users,
+            'turns': turns,
+            'bytes_per_user': memory // users if users else 0,
+            'prompts_with_history': with_history,
+            'avg_history_tokens': round(history_tokens / with_history, 1) if with_history else 0.0,
+        })
+        return stats
+
+# Глобальный экземпляр
+conversation_memory = ConversationMemory()
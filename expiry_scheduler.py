@@ -0,0 +1,145 @@
+# expiry_scheduler.py
+import time
+import heapq
+import asyncio
+import inspect
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    """Единый планировщик истечения сроков (разблокировки, предупреждения, неактивные пользователи).
+
+    Сроки хранятся в min-heap, одна фоновая задача спит до ближайшего срока и обрабатывает
+    все наступившие записи пачкой. Перепланирование не удаляет старую запись из кучи:
+    актуальный срок хранится в словаре, а устаревшие записи пропускаются при извлечении.
+    """
+
+    def __init__(self, max_batch=1000):
+        self.max_batch = max_batch
+        self.heap = []  # (deadline, seq, kind, key)
+        self.deadlines = {}  # (kind, key): актуальный срок
+        self.handlers = {}
+        self._seq = itertools.count()
+        self._task = None
+        self._wakeup = None
+        self._awaiting = []  # (kind, key, awaitable) асинхронных обработчиков
+        self.stats = {'scheduled': 0, 'processed': 0, 'stale_skipped': 0, 'handler_errors': 0}
+
+    def register(self, kind, handler):
+        """Регистрирует обработчик истечения срока: handler(key, now).
+
+        Обработчик может быть корутиной - ее дожидается фоновая задача после пачки.
+        """
+        self.handlers[kind] = handler
+
+    def schedule(self, kind, key, deadline):
+        """Назначает (или переносит) срок для ключа. O(log n)"""
+        self.deadlines[(kind, key)] = deadline
+        heapq.heappush(self.heap, (deadline, next(self._seq), kind, key))
+        self.stats['scheduled'] += 1
+
+        # Будим фоновую задачу, только если новый срок стал ближайшим
+        if self.heap[0][0] == deadline and self._wakeup is not None:
+            self._wakeup.set()
+        self._ensure_running()
+
+        # Не даем куче разрастаться из-за устаревших записей
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.deadlines):
+            self._compact()
+
+    def cancel(self, kind, key):
+        """Отменяет срок для ключа"""
+        self.deadlines.pop((kind, key), None)
+
+    def is_scheduled(self, kind, key):
+        return (kind, key) in self.deadlines
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if self.deadlines.get((entry[2], entry[3])) == entry[0]]
+        heapq.heapify(self.heap)
+
+    def run_due(self, now=None):
+        """Обрабатывает наступившие сроки (не больше max_batch за вызов), возвращает количество"""
+        now = now if now is not None else time.time()
+        processed = 0
+        while self.heap and self.heap[0][0] <= now and processed < self.max_batch:
+            deadline, _, kind, key = heapq.heappop(self.heap)
+            if self.deadlines.get((kind, key)) != deadline:
+                self.stats['stale_skipped'] += 1
+                continue
+            del self.deadlines[(kind, key)]
+
+            try:
+                result = self.handlers[kind](key, now)
+                if inspect.isawaitable(result):
+                    self._awaiting.append((kind, key, result))
+            except Exception as e:
+                self.stats['handler_errors'] += 1
+                logger.error(f"Ошибка обработчика истечения срока {kind} для {key}: {e}")
+            processed += 1
+
+        self.stats['processed'] += processed
+        return processed
+
+    async def _await_handlers(self):
+        """Дожидается асинхронных обработчиков последней пачки"""
+        batch, self._awaiting = self._awaiting, []
+        results = await asyncio.gather(*(awaitable for _, _, awaitable in batch), return_exceptions=True)
+        for (kind, key, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                self.stats['handler_errors'] += 1
+                logger.error(f"Ошибка обработчика истечения срока {kind} для {key}: {result}")
+
+    def _ensure_running(self):
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop срок будет обработан после start()
+            return
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    def start(self):
+        """Запускает фоновую задачу (нужен работающий event loop)"""
+        self._ensure_running()
+
+    async def stop(self):
+        """Останавливает фоновую задачу"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, _, awaitable in self._awaiting:
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()
+        self._awaiting = []
+
+    async def _run(self):
+        while True:
+            processed = self.run_due()
+            if self._awaiting:
+                await self._await_handlers()
+            if processed >= self.max_batch:
+                # Большая пачка - отдаем управление другим задачам и продолжаем
+                await asyncio.sleep(0)
+                continue
+
+            self._wakeup.clear()
+            timeout = max(0.0, self.heap[0][0] - time.time()) if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['pending'] = len(self.deadlines)
+        stats['heap_size'] = len(self.heap)
+        return stats
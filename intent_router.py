@@ -0,0 +1,237 @@
+# intent_router.py
+import os
+import re
+import html
+import time
+import logging
+from collections import defaultdict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Настройки локального маршрутизатора интентов
+INTENT_ROUTER_CONFIG = {
+    'ENABLED': os.getenv("INTENT_ROUTER_ENABLED", "true").lower() == "true",
+    'MIN_CONFIDENCE': float(os.getenv("INTENT_MIN_CONFIDENCE", "0.75")),
+    'MAX_TOKENS': int(os.getenv("INTENT_MAX_TOKENS", "12")),  # длинные вопросы всегда уходят в LLM
+    'MAX_PRICE_CANDIDATES': 3,  # сколько услуг можно перечислить в ответе о цене
+}
+
+IntentMatch = namedtuple('IntentMatch', ['intent', 'confidence', 'answer'])
+
+_TOKEN_PATTERN = re.compile(r'[a-zа-яё0-9]+')
+_VOWELS = set('аеёиоуыэюяьй')
+
+# Слова, не несущие смысла для классификации
+STOP_WORDS = {
+    'а', 'и', 'в', 'во', 'на', 'у', 'к', 'о', 'об', 'с', 'со', 'по', 'за', 'для', 'до', 'от', 'из',
+    'вас', 'вы', 'ваш', 'ваша', 'ваши', 'мне', 'меня', 'мой', 'моя', 'я', 'нас', 'мы', 'это', 'этот',
+    'что', 'как', 'какой', 'какая', 'какие', 'такое', 'ли', 'же', 'бы', 'не', 'ну', 'там', 'тут',
+    'подскажите', 'скажите', 'пожалуйста', 'здравствуйте', 'привет', 'добрый', 'день', 'вечер',
+    'утро', 'можно', 'есть', 'хочу', 'узнать', 'интересует', 'нужно', 'надо', 'вот',
+}
+
+# Ключевые слова интентов (достаточно одного совпадения)
+INTENT_KEYWORDS = {
+    'address': ['адрес', 'где', 'находитесь', 'расположены', 'доехать', 'добраться', 'проехать', 'локация'],
+    'working_hours': ['график', 'режим', 'открыты', 'закрываетесь', 'выходные', 'часы', 'работаете'],
+    'phone': ['телефон', 'номер', 'позвонить', 'звонить', 'контакты', 'связаться'],
+    'social': ['вк', 'вконтакте', 'инстаграм', 'instagram', 'телеграм', 'telegram', 'соцсети'],
+    'services': ['услуги', 'прайс', 'перечень', 'делаете'],
+}
+
+# Слова, указывающие на вопрос о цене
+PRICE_WORDS = ['сколько', 'стоит', 'стоимость', 'цена', 'цены', 'почем', 'руб', 'рублей', 'прайс']
+
+# Общие слова из названий услуг: одного такого совпадения мало ("ремонт двигателя" - не "ремонт сколов")
+GENERIC_SERVICE_WORDS = ['ремонт', 'услуга', 'услуги', 'работа', 'работы', 'локальный', 'локальная']
+
+def stem(word):
+    """Упрощенный стемминг: усечение длинных слов и отбрасывание окончаний коротких"""
+    word = word.replace('ё', 'е')
+    if len(word) > 5:
+        return word[:5]
+    if len(word) > 3 and word[-1] in _VOWELS:
+        return word[:-1]
+    return word
+
+def extract_stems(text):
+    """Токенизация и стемминг без стоп-слов"""
+    text = html.unescape(text).lower()
+    return [stem(token) for token in _TOKEN_PATTERN.findall(text) if token not in STOP_WORDS]
+
+class IntentRouter:
+    """Локальная классификация частых вопросов по заранее построенным индексам"""
+
+    def __init__(self, salon_config, faq_cards):
+        self.config = INTENT_ROUTER_CONFIG
+        self.stats = {
+            'routed': defaultdict(int),
+            'fallthrough': 0,
+            'fallbacks': 0,
+            'classify_calls': 0,
+            'classify_time_total': 0.0,
+        }
+        self.build(salon_config, faq_cards)
+
+    def build(self, salon_config, faq_cards):
+        """Строит индексы по услугам, FAQ и контактам (повторно - при изменении конфигурации)"""
+        self.salon_config = salon_config
+        self.faq_cards = faq_cards
+
+        self.intent_stems = {
+            intent: {stem(word) for word in words}
+            for intent, words in INTENT_KEYWORDS.items()
+        }
+        self.price_stems = {stem(word) for word in PRICE_WORDS}
+        self.generic_stems = {stem(word) for word in GENERIC_SERVICE_WORDS}
+
+        # Индекс услуг: стем -> множество услуг, в названии которых он встречается
+        self.service_stems = {}
+        self.service_index = defaultdict(set)
+        for service in salon_config['services']:
+            stems = set(extract_stems(service))
+            self.service_stems[service] = stems
+            for service_stem in stems:
+                self.service_index[service_stem].add(service)
+
+        # Индекс FAQ: по тексту вопроса и ключу карточки
+        self.faq_stems = {}
+        self.faq_index = defaultdict(set)
+        for key, card in faq_cards.items():
+            stems = set(extract_stems(card['question'])) | set(extract_stems(key.replace('_', ' ')))
+            self.faq_stems[key] = stems
+            for faq_stem in stems:
+                self.faq_index[faq_stem].add(key)
+
+    def classify(self, text):
+        """Возвращает IntentMatch при уверенной классификации, иначе None"""
+        if not self.config['ENABLED'] or not text:
+            return None
+
+        start_time = time.perf_counter()
+        match = self._classify(text)
+        self.stats['classify_calls'] += 1
+        self.stats['classify_time_total'] += time.perf_counter() - start_time
+
+        if match is None or match.confidence < self.config['MIN_CONFIDENCE']:
+            self.stats['fallthrough'] += 1
+            return None
+
+        self.stats['routed'][match.intent] += 1
+        return match
+
+    def _classify(self, text):
+        stems = extract_stems(text)
+        if not stems or len(stems) > self.config['MAX_TOKENS']:
+            return None
+        query = set(stems)
+
+        # Вопрос о цене конкретной услуги
+        price_hits = query & self.price_stems
+        content = query - self.price_stems
+        if price_hits and content:
+            services, score, matched = self._match_services(content)
+            if services:
+                # Покрытие считается только по словам вопроса без слов о цене: каждое должно найтись в услуге
+                coverage = len(matched) / len(content)
+                return IntentMatch('price', min(score, coverage), self._price_answer(services))
+
+        # Контакты, адрес, режим работы, соцсети, список услуг
+        contact_intents = [intent for intent, intent_stems in self.intent_stems.items() if query & intent_stems]
+        if contact_intents:
+            covered = set(price_hits)
+            for intent in contact_intents:
+                covered |= query & self.intent_stems[intent]
+            intent = contact_intents[0] if len(contact_intents) == 1 else 'contacts'
+            return IntentMatch(intent, len(covered) / len(query), self._contact_answer(contact_intents))
+
+        # Карточки FAQ
+        candidates = defaultdict(set)
+        for query_stem in query:
+            for key in self.faq_index.get(query_stem, ()):
+                candidates[key].add(query_stem)
+        if candidates:
+            key, matched = max(candidates.items(), key=lambda item: len(item[1]))
+            score = min(1.0, len(matched) / min(2, len(self.faq_stems[key])))
+            # Одно слово, встречающееся только в этой карточке (например, "PDR"), тоже надежный признак
+            if len(matched) == 1 and len(self.faq_index[next(iter(matched))]) == 1:
+                score = max(score, 0.8)
+            return IntentMatch(f'faq_{key}', min(score, len(matched) / len(query)),
+                               self.faq_cards[key]['answer'])
+
+        return None
+
+    def fallback_answer(self, text):
+        """Ответ без LLM, когда модель недоступна: лучшее совпадение любой уверенности или контакты"""
+        self.stats['fallbacks'] += 1
+        match = self._classify(text) if text else None
+        if match is not None:
+            return match.answer
+        return (
+            "Сейчас я не могу подробно ответить на ваш вопрос, но мастер с радостью проконсультирует вас.\n\n"
+            + self._contact_answer(['phone', 'working_hours', 'address'])
+        )
+
+    def _match_services(self, query):
+        """Находит услуги с наибольшим совпадением названия с вопросом"""
+        scores = defaultdict(set)
+        for query_stem in query:
+            for service in self.service_index.get(query_stem, ()):
+                scores[service].add(query_stem)
+        # Совпадение только по общим словам не указывает на конкретную услугу
+        scores = {service: matched for service, matched in scores.items() if matched - self.generic_stems}
+        if not scores:
+            return [], 0.0, set()
+
+        best = max(len(matched) for matched in scores.values())
+        services = [service for service, matched in scores.items() if len(matched) == best]
+        if len(services) > self.config['MAX_PRICE_CANDIDATES']:
+            return [], 0.0, set()
+
+        matched = set().union(*(scores[service] for service in services))
+        # Уверенность тем выше, чем большую часть названия услуги покрывает вопрос
+        score = max(best / len(self.service_stems[service]) for service in services)
+        return services, min(1.0, 0.5 + score), matched
+
+    def _price_answer(self, services):
+        lines = [f"• {service.rstrip(':')}: {self.salon_config['services'][service]}" for service in services]
+        return (
+            "💰 Стоимость:\n\n" + "\n".join(lines) + "\n\n"
+            "Цены ориентировочные, точную стоимость определим на бесплатной диагностике."
+        )
+
+    def _contact_answer(self, intents):
+        salon = self.salon_config
+        lines = []
+        for intent in intents:
+            if intent == 'address':
+                lines.append(f"🏢 Адрес: {salon['address']}")
+            elif intent == 'working_hours':
+                lines.append(f"🕒 Режим работы: {salon['working_hours']}")
+            elif intent == 'phone':
+                lines.append(f"📞 Телефон: {salon['contacts']}")
+            elif intent == 'social':
+                lines.append("🌐 Соцсети:\n" + "\n".join(
+                    f"{name}: {link}" for name, link in salon['social_media'].items()
+                ))
+            elif intent == 'services':
+                lines.append("🛠️ Наши услуги и цены:\n\n" + "\n".join(
+                    f"• {service}: {price}" for service, price in salon['services'].items()
+                ))
+        return "\n".join(lines)
+
+    def get_stats(self):
+        """Доля ответов по интентам и время классификации"""
+        calls = self.stats['classify_calls']
+        routed_total = sum(self.stats['routed'].values())
+        return {
+            'classify_calls': calls,
+            'routed': dict(self.stats['routed']),
+            'routed_rate': round(routed_total / calls, 3) if calls else 0.0,
+            'intent_rates': {
+                intent: round(count / calls, 3) for intent, count in self.stats['routed'].items()
+            } if calls else {},
+            'fallthrough': self.stats['fallthrough'],
+            'fallbacks': self.stats['fallbacks'],
+            'avg_classify_us': round(self.stats['classify_time_total'] * 1e6 / calls, 1) if calls else 0.0,
+        }
@@ -0,0 +1,197 @@
+# llm_resilience.py
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Настройки повторов, дублирующих запросов и предохранителя для LLM
+RESILIENCE_CONFIG = {
+    'MAX_RETRIES': int(os.getenv("LLM_MAX_RETRIES", "2")),
+    'BASE_DELAY': float(os.getenv("LLM_RETRY_BASE_DELAY", "0.3")),  # первая пауза перед повтором (сек)
+    'MAX_DELAY': float(os.getenv("LLM_RETRY_MAX_DELAY", "3.0")),
+    'RETRY_STATUSES': {429, 500, 502, 503, 504},
+    'HEDGING': os.getenv("LLM_HEDGING", "false").lower() == "true",
+    'HEDGE_PERCENTILE': 0.95,  # второй запрос уходит, если первый медленнее p95
+    'HEDGE_MIN_DELAY': float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0")),
+    'HEDGE_MIN_SAMPLES': 20,
+    'BREAKER_FAILURES': int(os.getenv("LLM_BREAKER_FAILURES", "5")),  # подряд неудачных попыток до размыкания
+    'BREAKER_OPEN_SECONDS': float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30")),
+    'LATENCY_WINDOW': 512,
+}
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут: сервис недавно не отвечал, запрос не отправляется"""
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open после серии сбоев -> half_open (одна пробная попытка) -> closed"""
+
+    def __init__(self, name, failure_threshold=None, open_seconds=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or RESILIENCE_CONFIG['BREAKER_FAILURES']
+        self.open_seconds = open_seconds or RESILIENCE_CONFIG['BREAKER_OPEN_SECONDS']
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.stats = {'opened': 0, 'short_circuited': 0, 'trials': 0}
+
+    def allow(self):
+        """Можно ли отправить запрос сейчас"""
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self.trial_in_flight:
+            self.trial_in_flight = True
+            self.stats['trials'] += 1
+            return True
+        self.stats['short_circuited'] += 1
+        return False
+
+    def cancel_trial(self):
+        """Пробная попытка завершилась без ответа сервиса (ошибка запроса или отмена)"""
+        self.trial_in_flight = False
+
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info(f"Предохранитель {self.name} замкнут: сервис снова отвечает")
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.stats['opened'] += 1
+            logger.error(f"Предохранитель {self.name} разомкнут на {self.open_seconds:.0f} сек "
+                         f"после {self.failures} сбоев подряд")
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['state'] = self.state
+        stats['consecutive_failures'] = self.failures
+        return stats
+
+class LLMResilience:
+    """Повторы с экспоненциальной паузой и джиттером, дублирующий запрос для медленного хвоста
+    и предохранитель для вызовов LLM.
+
+    Запрос к модели не меняет состояния, поэтому его можно безопасно повторять и дублировать.
+    Повторяются только сбои сети, таймауты и ответы 429/5xx; при разомкнутом предохранителе
+    вызов сразу завершается CircuitOpenError, и вызывающий код отвечает локально.
+    """
+
+    def __init__(self, name="llm"):
+        self.config = RESILIENCE_CONFIG
+        self.breaker = CircuitBreaker(name)
+        self.latencies = deque(maxlen=self.config['LATENCY_WINDOW'])
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0, 'hedges': 0, 'hedge_wins': 0}
+
+    def is_retryable(self, error):
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in self.config['RETRY_STATUSES']
+        return isinstance(error, httpx.TransportError)  # таймауты и ошибки соединения
+
+    def backoff(self, attempt, error=None):
+        """Пауза перед повтором: полный джиттер, но не меньше Retry-After от сервиса"""
+        delay = random.uniform(0, min(self.config['MAX_DELAY'], self.config['BASE_DELAY'] * 2 ** attempt))
+        if isinstance(error, httpx.HTTPStatusError):
+            retry_after = error.response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, min(float(retry_after), self.config['MAX_DELAY']))
+        return delay
+
+    def ensure_allowed(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Предохранитель {self.breaker.name} разомкнут")
+
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.breaker.record_success()
+
+    def retry_delay(self, error, attempt_number, can_retry=True):
+        """Учитывает неудачную попытку; возвращает паузу перед повтором или None, если повторять нельзя"""
+        if not self.is_retryable(error):
+            # Ошибка запроса, а не сервиса: предохранитель не трогаем
+            self.breaker.cancel_trial()
+            return None
+        self.breaker.record_failure()
+        if not can_retry or attempt_number >= self.config['MAX_RETRIES']:
+            self.stats['failures'] += 1
+            return None
+        self.stats['retries'] += 1
+        return self.backoff(attempt_number, error)
+
+    def hedge_delay(self):
+        """Через сколько секунд отправлять дублирующий запрос (None - не отправлять)"""
+        if not self.config['HEDGING'] or len(self.latencies) < self.config['HEDGE_MIN_SAMPLES']:
+            return None
+        ordered = sorted(self.latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * self.config['HEDGE_PERCENTILE']))]
+        return max(self.config['HEDGE_MIN_DELAY'], p95)
+
+    async def call(self, attempt):
+        """Выполняет attempt() (фабрику корутины) с повторами, дублированием и предохранителем"""
+        self.stats['calls'] += 1
+        for attempt_number in range(self.config['MAX_RETRIES'] + 1):
+            self.ensure_allowed()
+            start_time = time.monotonic()
+            try:
+                result = await self._hedged(attempt)
+            except asyncio.CancelledError:
+                self.breaker.cancel_trial()
+                raise
+            except Exception as e:
+                delay = self.retry_delay(e, attempt_number)
+                if delay is None:
+                    raise
+                logger.warning(f"Повтор запроса к LLM через {delay:.2f} сек "
+                               f"(попытка {attempt_number + 2}): {type(e).__name__}: {e}")
+                await asyncio.sleep(delay)
+                continue
+            self.record_success(time.monotonic() - start_time)
+            return result
+
+    async def _hedged(self, attempt):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await attempt()
+
+        primary = asyncio.create_task(attempt())
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        # Первый запрос застрял в медленном хвосте - отправляем второй, берем первый успешный ответ
+        self.stats['hedges'] += 1
+        hedge = asyncio.create_task(attempt())
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.stats['hedge_wins'] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['breaker'] = self.breaker.get_stats()
+        stats['hedge_delay'] = self.hedge_delay()
+        return stats
@@ -0,0 +1,325 @@
+# log_pipeline.py
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+from tracing import current_trace
+
+def _parse_rates(value):
+    """"webhook_received=0.1,user_action=0.5" -> {'webhook_received': 0.1, 'user_action': 0.5}"""
+    rates = {}
+    for item in value.split(','):
+        event, _, rate = item.partition('=')
+        if event.strip() and rate.strip():
+            rates[event.strip()] = float(rate)
+    return rates
+
+# Настройки конвейера логов
+LOGGING_CONFIG = {
+    'FORMAT': os.getenv("LOG_FORMAT", "json"),  # json | text (вывод в консоль)
+    'LEVEL': os.getenv("LOG_LEVEL", "INFO"),
+    'FILE': os.getenv("LOG_FILE"),  # если задан, все записи дублируются в файл (JSON)
+    'FILE_MAX_BYTES': int(os.getenv("LOG_FILE_MAX_BYTES", str(10 * 1024 * 1024))),
+    'FILE_BACKUP_COUNT': int(os.getenv("LOG_FILE_BACKUP_COUNT", "5")),
+    'QUEUE_SIZE': int(os.getenv("LOG_QUEUE_SIZE", "10000")),  # записей в очереди; сверх - отбрасываются
+    'BATCH_SIZE': int(os.getenv("LOG_BATCH_SIZE", "512")),  # записей за одну запись в файл
+    # Доля сохраняемых информационных событий по типу (предупреждения и ошибки не прореживаются)
+    'SAMPLE_RATES': _parse_rates(os.getenv("LOG_SAMPLE_RATES", "webhook_received=0.1")),
+    'STOP_TIMEOUT': 5.0,
+}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(environment)s - %(message)s'
+
+# Служебные поля LogRecord - все остальные атрибуты пришли из extra
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'event', 'fields', 'update_id', 'sampled', 'environment'
+}
+
+def log_extra(event, **fields):
+    """extra для структурной записи: тип события и поля JSON"""
+    return {'event': event, 'fields': fields}
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON"""
+
+    def __init__(self, environment=None):
+        super().__init__()
+        self.environment = environment
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'src': f"{record.filename}:{record.lineno}",
+        }
+        if self.environment:
+            entry['env'] = self.environment
+        event = getattr(record, 'event', None)
+        if event is not None:
+            entry['event'] = event
+        update_id = getattr(record, 'update_id', None)
+        if update_id is not None:
+            entry['update_id'] = update_id
+        sampled = getattr(record, 'sampled', None)
+        if sampled is not None:
+            entry['sampled'] = sampled  # запись представляет sampled событий этого типа
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _TextFormatter(logging.Formatter):
+    def __init__(self, environment=None):
+        super().__init__(TEXT_FORMAT)
+        self.environment = environment
+
+    def format(self, record):
+        record.environment = self.environment or ''
+        return super().format(record)
+
+class SamplingFilter(logging.Filter):
+    """Прореживает информационные события по типу (extra event): сохраняется каждое N-е.
+
+    Счетчик вместо случайного числа: доля выдерживается точно, а проверка стоит
+    одного сложения. Доля 0 отключает событие.
+    """
+
+    def __init__(self, rates, stats):
+        super().__init__()
+        self.every = {event: (round(1 / rate) if rate > 0 else 0) for event, rate in rates.items() if rate < 1}
+        self.counters = dict.fromkeys(self.every, 0)
+        self.stats = stats
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        event = getattr(record, 'event', None)
+        every = self.every.get(event)
+        if every is None:
+            return True
+        self.counters[event] += 1
+        if not every or self.counters[event] % every:
+            self.stats['sampled_out'] += 1
+            return False
+        record.sampled = every
+        return True
+
+class _ContextFilter(logging.Filter):
+    """Номер обновления из текущей трассы (contextvars доступны только в потоке вызова)"""
+
+    def filter(self, record):
+        trace = current_trace.get()
+        if trace is not None:
+            record.update_id = trace.update_id
+        return True
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь без форматирования и без ожидания места"""
+
+    def __init__(self, log_queue, stats):
+        super().__init__(log_queue)
+        self.stats = stats
+
+    def prepare(self, record):
+        # Сообщение соберет фоновый поток: в event loop только создание записи
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.stats['enqueued'] += 1
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+class _Output:
+    """Получатель записей: консоль или файл с ротацией, пишет пачку строк одним вызовом"""
+
+    def __init__(self, formatter, level=logging.NOTSET, prefix=None, stream=None, path=None,
+                 max_bytes=0, backup_count=0):
+        self.formatter = formatter
+        self.level = level
+        self.prefix = prefix  # только логгеры с этим префиксом имени
+        self.stream = stream
+        self.file = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Ротацию берем у стандартного обработчика, пишем сами; файл открывается при первой записи
+            self.file = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                             encoding='utf-8', delay=True)
+
+    def accepts(self, record):
+        if record.levelno < self.level:
+            return False
+        return self.prefix is None or record.name == self.prefix or record.name.startswith(self.prefix + '.')
+
+    def write(self, lines):
+        data = ''.join(lines)
+        if self.file is None:
+            self.stream.write(data)
+            self.stream.flush()
+            return
+        handler = self.file
+        if handler.stream is None:
+            handler.stream = handler._open()
+        if handler.maxBytes and handler.stream.tell() + len(data) >= handler.maxBytes:
+            handler.doRollover()
+        handler.stream.write(data)
+        handler.stream.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+_STOP = object()
+
+class LogPipeline:
+    """Логи через очередь: в event loop запись только создается и кладется в очередь.
+
+    Фоновый поток забирает из очереди все накопившееся (до BATCH_SIZE записей),
+    форматирует записи (JSON или текст) и пишет пачку в каждый получатель одним
+    вызовом write. Очередь ограничена: при ее переполнении записи отбрасываются
+    и считаются в статистике, а обработка обновлений не ждет диска.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or LOGGING_CONFIG
+        self.queue = queue.Queue(self.config['QUEUE_SIZE'])
+        self.outputs = []
+        self.handler = None
+        self.thread = None
+        self.environment = None
+        self.formatters = {}  # один форматтер каждого вида: запись форматируется один раз на все получатели
+        self.stats = {'enqueued': 0, 'dropped': 0, 'sampled_out': 0, 'written': 0, 'batches': 0,
+                      'max_batch': 0, 'write_errors': 0}
+
+    def _formatter(self, kind):
+        formatter = self.formatters.get(kind)
+        if formatter is None:
+            formatter = JsonFormatter() if kind == 'json' else _TextFormatter()
+            formatter.environment = self.environment
+            self.formatters[kind] = formatter
+        return formatter
+
+    def start(self, environment=None):
+        """Подключает очередь к корневому логгеру и запускает поток записи"""
+        if self.thread is not None:
+            return
+        self.environment = environment
+        for formatter in self.formatters.values():
+            formatter.environment = environment
+        self.outputs.append(_Output(self._formatter(self.config['FORMAT']), stream=sys.stderr))
+        if self.config['FILE']:
+            self.add_file(self.config['FILE'])
+
+        self.handler = _NonBlockingQueueHandler(self.queue, self.stats)
+        self.handler.addFilter(SamplingFilter(self.config['SAMPLE_RATES'], self.stats))
+        self.handler.addFilter(_ContextFilter())
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.config['LEVEL'])
+
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def add_file(self, path, prefix=None, level=logging.NOTSET, max_bytes=None, backup_count=None):
+        """Файл JSON-строк с ротацией; prefix - только записи логгера с этим именем и его дочерних"""
+        self.outputs.append(_Output(
+            self._formatter('json'), level=level, prefix=prefix, path=path,
+            max_bytes=self.config['FILE_MAX_BYTES'] if max_bytes is None else max_bytes,
+            backup_count=self.config['FILE_BACKUP_COUNT'] if backup_count is None else backup_count,
+        ))
+
+    def _run(self):
+        batch_size = self.config['BATCH_SIZE']
+        while True:
+            record = self.queue.get()
+            stopping = record is _STOP
+            batch = [] if stopping else [record]
+            # Все, что накопилось за время предыдущей записи, уходит одной пачкой
+            while len(batch) < batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    continue
+                batch.append(record)
+            if batch:
+                self._write(batch)
+            if stopping and self.queue.empty():
+                return
+
+    def _write(self, batch):
+        formatted = {}
+        for output in self.outputs:
+            try:
+                cache = formatted.get(output.formatter)
+                if cache is None:
+                    cache = formatted[output.formatter] = [None] * len(batch)
+                lines = []
+                for index, record in enumerate(batch):
+                    if output.accepts(record):
+                        line = cache[index]
+                        if line is None:
+                            line = cache[index] = output.formatter.format(record) + '\n'
+                        lines.append(line)
+                if lines:
+                    output.write(lines)
+            except Exception as e:
+                self.stats['write_errors'] += 1
+                print(f"Ошибка записи логов: {e}", file=sys.stderr)
+        self.stats['written'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+
+    def flush(self, timeout=None):
+        """Ждет записи всего, что уже поставлено в очередь (для остановки приложения)"""
+        target = self.stats['enqueued']
+        deadline = time.monotonic() + (self.config['STOP_TIMEOUT'] if timeout is None else timeout)
+        while self.thread is not None and self.stats['written'] < target and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stop(self):
+        """Дописывает очередь и останавливает поток; дальнейшие записи идут напрямую в консоль"""
+        if self.thread is None:
+            return
+        root = logging.getLogger()
+        root.removeHandler(self.handler)
+        console = logging.StreamHandler(sys.stderr)
+        console.setFormatter(self._formatter(self.config['FORMAT']))
+        root.addHandler(console)
+        try:
+            self.queue.put(_STOP, timeout=self.config['STOP_TIMEOUT'])
+        except queue.Full:
+            pass
+        self.thread.join(timeout=self.config['STOP_TIMEOUT'])
+        self.thread = None
+        for output in self.outputs:
+            output.close()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+# Глобальный экземпляр
+log_pipeline = LogPipeline()
@@ -0,0 +1,191 @@
+# message_coalescer.py
+import os
+import time
+import asyncio
+import logging
+
+from metrics import COALESCE_WAIT_SECONDS, COALESCE_BATCH_MESSAGES
+from tracing import tracer, current_trace
+
+logger = logging.getLogger(__name__)
+
+# Настройки объединения сообщений пользователя в один запрос
+COALESCER_CONFIG = {
+    'MIN_WINDOW': float(os.getenv("COALESCE_MIN_WINDOW", "0.3")),  # окно ожидания для "одиночных" пользователей (сек)
+    'MAX_WINDOW': float(os.getenv("COALESCE_MAX_WINDOW", "2.0")),
+    'DEFAULT_GAP': 1.0,  # предполагаемая пауза между сообщениями, пока нет статистики
+    'GAP_SMOOTHING': 0.3,  # вес нового наблюдения в скользящих средних
+    'MAX_BUFFER_MESSAGES': int(os.getenv("COALESCE_MAX_MESSAGES", "10")),
+    'MAX_BUFFER_CHARS': int(os.getenv("COALESCE_MAX_CHARS", "4000")),
+    'IDLE_TTL': int(os.getenv("COALESCE_IDLE_TTL", "600")),  # через сколько секунд забывать пользователя
+}
+
+class _UserState:
+    """Состояние пользователя: буфер сообщений, срок отправки и статистика пауз"""
+    __slots__ = ('messages', 'chars', 'received', 'deadline', 'waiter', 'chat_id', 'context',
+                 'first_message_at', 'last_message_at', 'gap', 'multi', 'trace')
+
+    def __init__(self):
+        self.messages = []
+        self.chars = 0
+        self.received = 0  # сколько сообщений пришло в текущую пачку (с учетом объединенных)
+        self.deadline = 0.0
+        self.waiter = None
+        self.chat_id = None
+        self.context = None
+        self.first_message_at = None  # первое сообщение текущей пачки
+        self.last_message_at = None
+        self.gap = None  # средняя пауза между сообщениями внутри серии
+        self.multi = 0.3  # средняя доля пачек из нескольких сообщений
+        self.trace = None  # трасса первого сообщения пачки, остальные присоединяются к ней
+
+class MessageCoalescer:
+    """Объединяет серию сообщений пользователя в одну пачку с адаптивным окном ожидания.
+
+    Состояние хранится отдельно для каждого пользователя, глобальной блокировки нет:
+    все изменения синхронные и выполняются в одном event loop. Пока пачка собирается,
+    у пользователя работает одна задача ожидания, которая лишь досыпает до сдвинувшегося
+    срока, а не пересоздается на каждое сообщение. Пачки одного пользователя
+    обрабатываются последовательно.
+    """
+
+    def __init__(self, process_batch):
+        self.config = COALESCER_CONFIG
+        self.process_batch = process_batch  # async (user_id, chat_id, context, messages, message_count)
+        self.users = {}
+        self.stats = {'messages': 0, 'batches': 0, 'merged': 0, 'dropped': 0, 'duplicates': 0, 'waiters': 0}
+
+    def _window(self, state):
+        """Окно ожидания: короткое для тех, кто пишет одним сообщением, длиннее для "серийных" пользователей"""
+        config = self.config
+        expected_gap = state.gap if state.gap is not None else config['DEFAULT_GAP']
+        # Внутри уже начавшейся серии следующее сообщение вероятно
+        multi = 1.0 if len(state.messages) > 1 else state.multi
+        window = config['MIN_WINDOW'] + multi * expected_gap
+        return max(config['MIN_WINDOW'], min(window, config['MAX_WINDOW']))
+
+    def add(self, user_id, chat_id, context, text):
+        """Добавляет сообщение в буфер пользователя и назначает срок отправки пачки"""
+        config = self.config
+        now = time.monotonic()
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = _UserState()
+
+        # Пауза между сообщениями одной серии уточняет окно ожидания
+        if state.last_message_at is not None:
+            gap = now - state.last_message_at
+            if gap <= config['MAX_WINDOW']:
+                alpha = config['GAP_SMOOTHING']
+                state.gap = gap if state.gap is None else (1 - alpha) * state.gap + alpha * gap
+                if not state.messages:
+                    # Серию разрезало слишком коротким окном - в следующий раз ждем дольше
+                    state.multi = (1 - alpha) * state.multi + alpha
+
+        if not state.received:
+            state.first_message_at = now
+        state.last_message_at = now
+        state.chat_id = chat_id
+        state.context = context
+        state.received += 1
+        self.stats['messages'] += 1
+        self._attach_trace(state)
+        self._buffer(state, text)
+
+        state.deadline = now + self._window(state)
+        if state.waiter is None:
+            state.waiter = asyncio.create_task(self._wait_and_flush(user_id, state))
+            self.stats['waiters'] += 1
+
+    @staticmethod
+    def _attach_trace(state):
+        """Трассу пачки завершит ее обработка; трассы следующих сообщений объединяются с первой"""
+        trace = tracer.defer()
+        if trace is None:
+            return
+        if state.trace is None:
+            state.trace = trace
+        else:
+            merged = state.trace.attrs.setdefault('merged_updates', [])
+            merged.append(trace.update_id)
+
+    def _buffer(self, state, text):
+        """Политика буфера: дубликаты пропускаются, лишние сообщения склеиваются, старые вытесняются"""
+        config = self.config
+        if text in state.messages:
+            self.stats['duplicates'] += 1
+            return
+
+        if len(state.messages) >= config['MAX_BUFFER_MESSAGES']:
+            state.messages[-1] = f"{state.messages[-1]} {text}"
+            state.chars += len(text) + 1  # с пробелом-разделителем
+            self.stats['merged'] += 1
+        else:
+            state.messages.append(text)
+            state.chars += len(text)
+
+        while state.chars > config['MAX_BUFFER_CHARS'] and len(state.messages) > 1:
+            state.chars -= len(state.messages.pop(0))
+            self.stats['dropped'] += 1
+
+    async def _wait_and_flush(self, user_id, state):
+        try:
+            while True:
+                # Досыпаем до срока; новые сообщения только сдвигают state.deadline
+                delay = state.deadline - time.monotonic()
+                while delay > 0:
+                    await asyncio.sleep(delay)
+                    delay = state.deadline - time.monotonic()
+
+                messages, message_count = state.messages, state.received
+                state.messages, state.chars, state.received = [], 0, 0
+                trace, state.trace = state.trace, None
+                waited = time.monotonic() - state.first_message_at
+                COALESCE_WAIT_SECONDS.observe(waited)
+                COALESCE_BATCH_MESSAGES.observe(message_count)
+                if trace is not None:
+                    now = time.perf_counter()
+                    trace.add_span('coalesce', now - waited, now, messages=message_count)
+
+                alpha = self.config['GAP_SMOOTHING']
+                state.multi = (1 - alpha) * state.multi + alpha * (1.0 if message_count > 1 else 0.0)
+                self.stats['batches'] += 1
+
+                token = current_trace.set(trace)
+                try:
+                    await self.process_batch(user_id, state.chat_id, state.context, messages, message_count)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки пачки сообщений пользователя {user_id}: {e}")
+                finally:
+                    current_trace.reset(token)
+                    tracer.finish(trace)
+
+                # Сообщения, пришедшие во время обработки, образуют следующую пачку
+                if not state.messages:
+                    break
+        finally:
+            state.waiter = None
+
+    def pending_count(self):
+        """Сколько сообщений ждут отправки"""
+        return sum(len(state.messages) for state in self.users.values())
+
+    def evict_idle(self, now=None):
+        """Забывает пользователей без активности дольше IDLE_TTL"""
+        now = now if now is not None else time.monotonic()
+        idle = [
+            user_id for user_id, state in self.users.items()
+            if state.waiter is None and not state.messages
+            and (state.last_message_at is None or now - state.last_message_at > self.config['IDLE_TTL'])
+        ]
+        for user_id in idle:
+            del self.users[user_id]
+        return len(idle)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['users'] = len(self.users)
+        stats['active_waiters'] = sum(1 for state in self.users.values() if state.waiter is not None)
+        stats['pending_messages'] = self.pending_count()
+        stats['avg_batch_size'] = round(stats['messages'] / stats['batches'], 2) if stats['batches'] else 0.0
+        return stats
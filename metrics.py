@@ -0,0 +1,252 @@
+# metrics.py
+import os
+import math
+import bisect
+
+# Границы корзин гистограмм задержек (сек)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Для долгих этапов: ответ LLM, ожидание пачки, симуляция печатания
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 12.0, 20.0, 30.0, 60.0)
+
+METRICS_CONFIG = {
+    'PREFIX': os.getenv("METRICS_PREFIX", "tgbot"),
+    'TOKEN': os.getenv("METRICS_TOKEN"),  # если задан, /metrics требует Authorization: Bearer <token>
+}
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+class _Metric:
+    """Семейство метрик. Дочерние метрики с метками создаются один раз (обычно при импорте модуля)
+    и хранятся у вызывающего кода, поэтому на запрос не создается ни словарей меток, ни строк."""
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.name = f"{registry.prefix}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+        registry.register(self)
+
+    def labels(self, *values):
+        """Дочерняя метрика для значений меток; вызывать при инициализации, а не на каждый запрос"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _label_text(self, values, const_labels, extra=None):
+        pairs = list(const_labels) + list(zip(self.labelnames, values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+    def render(self, const_labels):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self.children.items():
+            self._render_child(lines, self._label_text(values, const_labels), values, child, const_labels)
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _render_child(self, lines, labels, values, child, const_labels):
+        raise NotImplementedError
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].value += amount
+
+    def _render_child(self, lines, labels, values, child, const_labels):
+        lines.append(f"{self.name}{labels} {_format_value(child.value)}")
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Значение вычисляется при чтении метрик (глубина очередей и т.п.)"""
+        self.function = function
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.children[()].value = value
+
+    def set_function(self, function):
+        self.children[()].function = function
+
+    def _render_child(self, lines, labels, values, child, const_labels):
+        value = child.value
+        if child.function is not None:
+            try:
+                value = child.function()
+            except Exception:
+                return  # недоступное значение просто не публикуем
+            if value is None:
+                return
+        lines.append(f"{self.name}{labels} {_format_value(value)}")
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последняя корзина - +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        # Корзины выделены заранее: наблюдение - поиск корзины и два сложения
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(registry, name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def _render_child(self, lines, labels, values, child, const_labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), child.counts):
+            cumulative += count
+            bucket_labels = self._label_text(values, const_labels, ('le', _format_value(float(bound))))
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+
+class MetricsRegistry:
+    """Реестр метрик процесса и их вывод в текстовом формате Prometheus"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix or METRICS_CONFIG['PREFIX']
+        self.metrics = []
+        self.const_labels = ()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def set_const_labels(self, **labels):
+        """Метки для всех метрик процесса (например, номер воркера)"""
+        self.const_labels = tuple(labels.items())
+
+    def counter(self, name, documentation, labelnames=()):
+        return Counter(self, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return Gauge(self, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return Histogram(self, name, documentation, labelnames, buckets)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(self.const_labels))
+        return "\n".join(lines) + "\n"
+
+def merge_expositions(texts):
+    """Объединяет выводы нескольких процессов: строки одного семейства метрик идут подряд"""
+    families = {}
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# "):
+                parts = line.split(" ", 3)
+                family = families.setdefault(parts[2], {'meta': [], 'samples': []})
+                if len(family['meta']) < 2 and line not in family['meta']:
+                    family['meta'].append(line)
+            elif family is not None:
+                family['samples'].append(line)
+    lines = []
+    for family in families.values():
+        lines.extend(family['meta'])
+        lines.extend(family['samples'])
+    return "\n".join(lines) + "\n"
+
+# Глобальный реестр процесса
+registry = MetricsRegistry()
+
+# ==================== МЕТРИКИ ЭТАПОВ ОБРАБОТКИ ====================
+
+WEBHOOK_SECONDS = registry.histogram("webhook_seconds", "Время обработки вебхука до ответа Telegram")
+WEBHOOK_REQUESTS = registry.counter("webhook_requests_total", "Вебхуки по результату", ("status",))
+UPDATE_DECODE_SECONDS = registry.histogram("update_decode_seconds", "Время Update.de_json")
+SECURITY_CHECK_SECONDS = registry.histogram("security_check_seconds", "Время проверок безопасности сообщения")
+SECURITY_REJECTIONS = registry.counter("security_rejections_total", "Отклоненные проверками безопасности запросы",
+                                       ("reason",))
+SECURITY_BLOCKS = registry.counter("security_blocks_total", "Блокировки пользователей")
+COALESCE_WAIT_SECONDS = registry.histogram("coalesce_wait_seconds",
+                                           "Ожидание пачки: от первого сообщения до начала обработки",
+                                           buckets=SLOW_BUCKETS)
+COALESCE_BATCH_MESSAGES = registry.histogram("coalesce_batch_messages", "Сообщений в пачке",
+                                             buckets=(1, 2, 3, 5, 8, 13))
+LLM_SECONDS = registry.histogram("llm_request_seconds", "Время запроса к LLM с повторами", ("mode",),
+                                 buckets=SLOW_BUCKETS)
+LLM_REQUESTS = registry.counter("llm_requests_total", "Запросы к LLM по результату", ("mode", "outcome"))
+POSTPROCESS_SECONDS = registry.histogram("postprocess_seconds", "Время постобработки ответа LLM")
+TYPING_SIMULATION_SECONDS = registry.histogram("typing_simulation_seconds", "Пауза симуляции печатания",
+                                               buckets=SLOW_BUCKETS)
+TELEGRAM_SEND_SECONDS = registry.histogram("telegram_send_seconds", "Время вызова Bot API", ("kind",))
+TELEGRAM_SENDS = registry.counter("telegram_sends_total", "Вызовы Bot API по результату", ("kind", "outcome"))
+STARTUP_SECONDS = registry.gauge("startup_seconds", "Время запуска процесса по этапам и шагам", ("phase",))
+POLL_SECONDS = registry.histogram("poll_request_seconds", "Время запроса getUpdates с ожиданием long polling",
+                                  buckets=SLOW_BUCKETS)
+POLL_BATCH_UPDATES = registry.histogram("poll_batch_updates", "Обновлений в ответе getUpdates",
+                                        buckets=(0, 1, 5, 10, 25, 50, 100))
+POLL_ERRORS = registry.counter("poll_errors_total", "Ошибки getUpdates", ("reason",))
@@ -0,0 +1,407 @@
+# outbound_scheduler.py
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from datetime import timedelta
+from collections import deque
+from functools import partial
+
+from telegram.error import RetryAfter
+
+from metrics import TELEGRAM_SEND_SECONDS, TELEGRAM_SENDS
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Настройки исходящих запросов к Telegram
+OUTBOUND_CONFIG = {
+    'GLOBAL_RATE': float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),  # сообщений в секунду на бота
+    'GLOBAL_BURST': int(os.getenv("OUTBOUND_GLOBAL_BURST", "30")),
+    'CHAT_RATE': float(os.getenv("OUTBOUND_CHAT_RATE", "1")),  # сообщений в секунду в один чат
+    'CHAT_BURST': int(os.getenv("OUTBOUND_CHAT_BURST", "3")),
+    'MAX_PENDING': int(os.getenv("OUTBOUND_MAX_PENDING", "2000")),
+    'ENQUEUE_TIMEOUT': float(os.getenv("OUTBOUND_ENQUEUE_TIMEOUT", "10")),  # ожидание места в очереди для ответа (сек)
+    'MAX_RETRIES': int(os.getenv("OUTBOUND_MAX_RETRIES", "3")),  # повторов после RetryAfter
+    'ACTION_TTL': 5.0,  # статус "печатает" старше этого уже не нужен (сек)
+    'DRAIN_TIMEOUT': 5.0,
+    'LATENCY_WINDOW': 1024,
+}
+
+# Приоритеты: меньше - раньше
+PRIORITY_ANSWER = 0
+PRIORITY_EDIT = 1
+PRIORITY_ACTION = 2
+
+# Метрики по приоритету запроса (метки создаются один раз)
+_SEND_KINDS = ('message', 'edit', 'action')
+_SEND_SECONDS = [TELEGRAM_SEND_SECONDS.labels(kind) for kind in _SEND_KINDS]
+_SEND_OUTCOMES = [{outcome: TELEGRAM_SENDS.labels(kind, outcome) for outcome in ('ok', 'retry_after', 'error')}
+                  for kind in _SEND_KINDS]
+
+class OutboundQueueFull(Exception):
+    """Очередь исходящих сообщений переполнена дольше ENQUEUE_TIMEOUT"""
+
+class TokenBucket:
+    """Классическое ведро токенов: rate токенов в секунду, не больше capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = now if now is not None else time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        if now < self.updated:
+            return self.updated - now  # пауза после RetryAfter
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def pause(self, until):
+        """Запрещает запросы до момента until (ответ RetryAfter), после него доступен один"""
+        self.tokens = 1.0
+        self.updated = max(self.updated, until)
+
+class _Job:
+    __slots__ = ('priority', 'call', 'future', 'enqueued_at', 'retries', 'merge_key', 'uses_chat_limit')
+
+    def __init__(self, priority, call, merge_key=None, uses_chat_limit=True):
+        self.priority = priority
+        self.call = call  # фабрика корутины: при повторе после RetryAfter создается новая
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.retries = 0
+        self.merge_key = merge_key
+        self.uses_chat_limit = uses_chat_limit
+
+class _ChatState:
+    __slots__ = ('jobs', 'bucket', 'busy', 'version')
+
+    def __init__(self, bucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.busy = False  # запрос этого чата сейчас выполняется
+        self.version = 0  # номер актуальной записи чата в куче
+
+class OutboundScheduler:
+    """Центральная очередь исходящих запросов к Telegram с лимитами на бота и на чат.
+
+    У каждого чата своя очередь, запросы одного чата выполняются строго по одному и по порядку.
+    Чат, ожидающий своего лимита, лежит в куче отложенных по сроку готовности, а готовые
+    чаты - в куче по приоритету головы очереди: когда упираемся в общий лимит, ответы
+    обгоняют правки, правки - статусы "печатает". Статус не ставится в очередь,
+    если у чата уже ждет сообщение, а правки одного сообщения склеиваются в последнюю.
+    RetryAfter приостанавливает чат и общий лимит бота (флуд-контроль Telegram учитывает
+    и суммарную частоту отправки) и возвращает запрос в голову очереди чата.
+    """
+
+    def __init__(self):
+        self.config = OUTBOUND_CONFIG
+        self.global_bucket = TokenBucket(self.config['GLOBAL_RATE'], self.config['GLOBAL_BURST'])
+        self.chats = {}
+        self.ready = []  # (priority, seq, chat_id, version)
+        self.delayed = []  # (ready_at, seq, chat_id, version)
+        self._seq = itertools.count()
+        self.pending = 0
+        self.in_flight = 0
+        self._task = None
+        self._wakeup = None
+        self._space = None
+        self.queue_waits = deque(maxlen=self.config['LATENCY_WINDOW'])
+        self.stats = {'enqueued': 0, 'sent': 0, 'failed': 0, 'retry_after': 0, 'merged_edits': 0,
+                      'skipped_actions': 0, 'expired_actions': 0, 'dropped_actions': 0, 'rejected': 0,
+                      'waited_for_space': 0, 'max_pending_seen': 0}
+
+    # ---------- Публичные методы ----------
+
+    async def send_message(self, bot, chat_id, text, **kwargs):
+        return await self.submit(chat_id, PRIORITY_ANSWER, partial(bot.send_message, chat_id, text, **kwargs))
+
+    async def reply_text(self, message, text, **kwargs):
+        return await self.submit(message.chat_id, PRIORITY_ANSWER, partial(message.reply_text, text, **kwargs))
+
+    async def edit_message_text(self, bot, text, chat_id, message_id, **kwargs):
+        call = partial(bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, **kwargs)
+        return await self.submit(chat_id, PRIORITY_EDIT, call, merge_key=message_id)
+
+    async def edit_query_message(self, query, text, **kwargs):
+        """Правка сообщения с кнопками в ответ на callback"""
+        message = query.message
+        return await self.submit(message.chat_id, PRIORITY_EDIT, partial(query.edit_message_text, text, **kwargs),
+                                 merge_key=message.message_id)
+
+    def send_chat_action(self, bot, chat_id, action="typing"):
+        """Статус чата ставится в очередь без ожидания: он не важнее ответов и может быть пропущен"""
+        self.enqueue(chat_id, PRIORITY_ACTION, partial(bot.send_chat_action, chat_id=chat_id, action=action),
+                     uses_chat_limit=False)
+
+    async def submit(self, chat_id, priority, call, merge_key=None):
+        """Ставит запрос в очередь и дожидается его выполнения; в пиковые моменты ответ ждет места"""
+        self._ensure_running()
+        if self.pending >= self.config['MAX_PENDING'] and not self._drop_action():
+            self.stats['waited_for_space'] += 1
+            deadline = time.monotonic() + self.config['ENQUEUE_TIMEOUT']
+            while self.pending >= self.config['MAX_PENDING']:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    self.stats['rejected'] += 1
+                    raise OutboundQueueFull(f"Очередь исходящих сообщений переполнена ({self.pending})")
+                self._space.clear()
+                try:
+                    await asyncio.wait_for(self._space.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+        job = self.enqueue(chat_id, priority, call, merge_key)
+        # Этап трассы: ожидание лимитов, вызов Bot API и повторы после RetryAfter
+        with tracer.span('telegram_send', kind=_SEND_KINDS[priority]) as span:
+            result = await job.future
+            span.set(retries=job.retries)
+        return result
+
+    def enqueue(self, chat_id, priority, call, merge_key=None, uses_chat_limit=True):
+        """Ставит запрос в очередь чата без ожидания, возвращает задание (или None, если пропущено)"""
+        self._ensure_running()
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = _ChatState(
+                TokenBucket(self.config['CHAT_RATE'], self.config['CHAT_BURST'])
+            )
+
+        if priority == PRIORITY_ACTION:
+            # Статус бесполезен, если у чата уже ждут сообщения или такой же статус
+            if chat.jobs or self.pending >= self.config['MAX_PENDING']:
+                self.stats['skipped_actions'] += 1
+                return None
+        else:
+            # Ожидающий статус больше не нужен - сообщение и так скоро придет
+            self._remove_actions(chat)
+            if merge_key is not None:
+                for job in chat.jobs:
+                    if job.merge_key == merge_key:
+                        # Новая правка того же сообщения заменяет ожидающую
+                        job.call = call
+                        self.stats['merged_edits'] += 1
+                        return job
+
+        job = _Job(priority, call, merge_key, uses_chat_limit)
+        chat.jobs.append(job)
+        self.pending += 1
+        self.stats['enqueued'] += 1
+        self.stats['max_pending_seen'] = max(self.stats['max_pending_seen'], self.pending)
+        if not chat.busy:
+            self._schedule_chat(chat_id, chat, time.monotonic())
+        return job
+
+    async def stop(self, drain_timeout=None):
+        """Дожидается отправки очереди (с таймаутом) и останавливает фоновую задачу"""
+        drain_timeout = self.config['DRAIN_TIMEOUT'] if drain_timeout is None else drain_timeout
+        deadline = time.monotonic() + drain_timeout
+        while (self.pending or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.pending:
+            logger.warning(f"Очередь исходящих сообщений остановлена с неотправленными: {self.pending}")
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def evict_idle(self, now=None):
+        """Удаляет пустые чаты с полным ведром (лимит чата полностью восстановился)"""
+        now = now if now is not None else time.monotonic()
+        idle = [chat_id for chat_id, chat in self.chats.items()
+                if not chat.jobs and not chat.busy and chat.bucket.is_full(now)]
+        for chat_id in idle:
+            del self.chats[chat_id]
+        return len(idle)
+
+    # ---------- Внутреннее устройство ----------
+
+    def _remove_actions(self, chat):
+        if chat.jobs and chat.jobs[0].priority == PRIORITY_ACTION:
+            job = chat.jobs.popleft()
+            self._finish_dropped(job)
+            self.stats['skipped_actions'] += 1
+
+    def _drop_action(self):
+        """Освобождает место в полной очереди за счет ожидающего статуса"""
+        for chat in self.chats.values():
+            if chat.jobs and chat.jobs[0].priority == PRIORITY_ACTION:
+                self._finish_dropped(chat.jobs.popleft())
+                self.stats['dropped_actions'] += 1
+                return True
+        return False
+
+    def _finish_dropped(self, job):
+        self.pending -= 1
+        if not job.future.done():
+            job.future.set_result(None)
+        self._space.set()
+
+    def _schedule_chat(self, chat_id, chat, ready_at):
+        chat.version += 1
+        if ready_at <= time.monotonic():
+            heapq.heappush(self.ready, (chat.jobs[0].priority, next(self._seq), chat_id, chat.version))
+        else:
+            heapq.heappush(self.delayed, (ready_at, next(self._seq), chat_id, chat.version))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _is_current(self, chat_id, version):
+        chat = self.chats.get(chat_id)
+        return chat is not None and chat.version == version and not chat.busy and chat.jobs
+
+    def _ensure_running(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            # Чаты, дождавшиеся своего лимита, переходят в очередь готовых с приоритетом головы
+            while self.delayed and self.delayed[0][0] <= now:
+                _, seq, chat_id, version = heapq.heappop(self.delayed)
+                if self._is_current(chat_id, version):
+                    heapq.heappush(self.ready, (self.chats[chat_id].jobs[0].priority, seq, chat_id, version))
+
+            timeout = None
+            while self.ready:
+                _, _, chat_id, version = self.ready[0]
+                if not self._is_current(chat_id, version):
+                    heapq.heappop(self.ready)  # устаревшая запись
+                    continue
+                chat = self.chats[chat_id]
+                job = chat.jobs[0]
+
+                if job.priority == PRIORITY_ACTION and now - job.enqueued_at > self.config['ACTION_TTL']:
+                    heapq.heappop(self.ready)
+                    chat.jobs.popleft()
+                    self._finish_dropped(job)
+                    self.stats['expired_actions'] += 1
+                    if chat.jobs:
+                        self._schedule_chat(chat_id, chat, now)
+                    continue
+
+                # Сначала лимит чата: он откладывает только этот чат
+                chat_wait = chat.bucket.wait_time(now) if job.uses_chat_limit else 0.0
+                if chat_wait:
+                    heapq.heappop(self.ready)
+                    self._schedule_chat(chat_id, chat, now + chat_wait)
+                    continue
+
+                global_wait = self.global_bucket.wait_time(now)
+                if global_wait:
+                    timeout = global_wait
+                    break
+
+                heapq.heappop(self.ready)
+                chat.jobs.popleft()
+                self.pending -= 1
+                self._space.set()
+                if job.uses_chat_limit:
+                    chat.bucket.take(now)
+                self.global_bucket.take(now)
+                chat.busy = True
+                self.in_flight += 1
+                self.queue_waits.append(now - job.enqueued_at)
+                asyncio.create_task(self._execute(chat_id, chat, job))
+
+            if self.delayed:
+                delay = max(0.0, self.delayed[0][0] - now)
+                timeout = delay if timeout is None else min(timeout, delay)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, chat_id, chat, job):
+        ready_at = time.monotonic()
+        outcomes = _SEND_OUTCOMES[job.priority]
+        try:
+            result = await job.call()
+            _SEND_SECONDS[job.priority].observe(time.monotonic() - ready_at)
+            outcomes['ok'].inc()
+            self.stats['sent'] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        except RetryAfter as e:
+            outcomes['retry_after'].inc()
+            self.stats['retry_after'] += 1
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            ready_at = time.monotonic() + delay
+            chat.bucket.pause(ready_at)
+            # Остальные чаты тоже ждут: иначе они продолжат упираться в тот же лимит бота
+            self.global_bucket.pause(ready_at)
+            if job.retries < self.config['MAX_RETRIES'] and job.priority != PRIORITY_ACTION:
+                # Запрос возвращается в голову очереди чата и уйдет после паузы
+                job.retries += 1
+                chat.jobs.appendleft(job)
+                self.pending += 1
+                logger.warning(f"Telegram RetryAfter {delay:.0f} сек для чата {chat_id}, повтор {job.retries}")
+            else:
+                self.stats['failed'] += 1
+                if job.priority == PRIORITY_ACTION:
+                    job.future.set_result(None)
+                elif not job.future.done():
+                    job.future.set_exception(e)
+        except Exception as e:
+            outcomes['error'].inc()
+            self.stats['failed'] += 1
+            if job.priority == PRIORITY_ACTION:
+                # Статус никто не ждет - ошибку только логируем
+                logger.warning(f"Не удалось отправить статус в чат {chat_id}: {e}")
+                job.future.set_result(None)
+            elif not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            chat.busy = False
+            self.in_flight -= 1
+            if chat.jobs:
+                self._schedule_chat(chat_id, chat, ready_at)
+
+    @staticmethod
+    def _percentile(samples, fraction):
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats.update({
+            'pending': self.pending,
+            'in_flight': self.in_flight,
+            'chats': len(self.chats),
+            'queue_wait_p50_ms': round(self._percentile(self.queue_waits, 0.5) * 1000, 1),
+            'queue_wait_p99_ms': round(self._percentile(self.queue_waits, 0.99) * 1000, 1),
+        })
+        return stats
+
+# Глобальный экземпляр
+outbound = OutboundScheduler()
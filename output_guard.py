@@ -0,0 +1,208 @@
+# output_guard.py
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Признаки утечки секретов в ответе модели: опорное слово и полный шаблон (по тексту в нижнем регистре)
+SECRET_PATTERNS = {
+    'password': ('password', r'password[^\n]*:[^\n]'),  # упоминание паролей
+    'token': ('token', r'token[^\n]*:[^\n]'),  # упоминание токенов
+    'api_key': ('api', r'api(?:\\?[_-])?key[^\n]*:[^\n]'),  # упоминание API-ключей (и в экранированном тексте)
+    'secret': ('secret', r'secret[^\n]*:[^\n]'),  # упоминание секретов
+}
+
+# Длинные строки, похожие на хэши/токены
+LONG_TOKEN_PATTERN = r'[A-Za-z0-9]{32,}'
+
+# Более короткие значения из конфигурации (тестовые заглушки) не ищем - слишком много ложных срабатываний
+MIN_SECRET_LENGTH = 8
+
+# Запрещенные темы: основы слов, совпадающие с началом слова
+BANNED_PHRASES = {
+    'medical': ["лечебн", "медицинск", "вылеч"],
+    'legal': ["юридическ", "адвокат", "суд"],
+}
+
+# Тема не запрещена, если в ответе есть контекст автомобиля ("лечебный состав для авто")
+BANNED_EXCEPTIONS = {
+    'medical': "авто",
+}
+
+class GuardVerdict:
+    """Результат проверки ответа: allowed, категория нарушения ('leak' или 'banned') и причина"""
+    __slots__ = ('allowed', 'category', 'reason', 'position')
+
+    def __init__(self, allowed=True, category=None, reason=None, position=None):
+        self.allowed = allowed
+        self.category = category
+        self.reason = reason
+        self.position = position
+
+    def __bool__(self):
+        return self.allowed
+
+    def __repr__(self):
+        if self.allowed:
+            return "GuardVerdict(allowed)"
+        return f"GuardVerdict({self.category}: {self.reason} @ {self.position})"
+
+ALLOWED = GuardVerdict()
+
+class OutputGuard:
+    """Проверка ответа модели на утечки и запрещенные темы за один проход.
+
+    Опорные слова всех правил - значения секретов из конфигурации (в исходном и экранированном
+    для MarkdownV2 виде), ключевые слова шаблонов секретов, основы запрещенных слов и слова
+    контекста - собраны в одну альтернативу из литералов, которая компилируется при запуске.
+    Она служит префильтром: полный шаблон правила проверяется только в месте, где найдено
+    его опорное слово. Длинные токены ищутся отдельным простым шаблоном. Проверка
+    останавливается на первом нарушении. Все правила не выходят за пределы строки, поэтому
+    потоковая проверка (stream) досматривает только незавершенную строку и новый текст.
+    """
+
+    def __init__(self, sensitive_values=None, secret_patterns=None, banned_phrases=None,
+                 banned_exceptions=None, escape=None):
+        secret_patterns = SECRET_PATTERNS if secret_patterns is None else secret_patterns
+        banned_phrases = BANNED_PHRASES if banned_phrases is None else banned_phrases
+        self.exceptions = BANNED_EXCEPTIONS if banned_exceptions is None else banned_exceptions
+
+        # Опорное слово -> правила (категория, причина, шаблон для проверки на месте или None)
+        self.rules = {}
+
+        def add(anchor, category, reason, verify=None):
+            self.rules.setdefault(anchor.lower(), []).append((category, reason, verify))
+
+        for name, value in (sensitive_values or {}).items():
+            if not value or len(value) < MIN_SECRET_LENGTH:
+                continue
+            for variant in {value, escape(value)} if escape else {value}:
+                add(variant, 'leak', f"config:{name}")
+        for name, (anchor, pattern) in secret_patterns.items():
+            add(anchor, 'leak', f"pattern:{name}", re.compile(pattern))
+        for topic, phrases in banned_phrases.items():
+            for phrase in phrases:
+                add(phrase, 'banned', topic, _WORD_START)
+        for topic, context in self.exceptions.items():
+            add(context, 'context', topic)
+
+        # Длинные литералы первыми: при общем начале совпадает самый длинный
+        self.anchor_pattern = re.compile('|'.join(
+            re.escape(anchor) for anchor in sorted(self.rules, key=len, reverse=True)
+        ))
+        self.long_token_pattern = re.compile(LONG_TOKEN_PATTERN)
+        self.stats = {'checks': 0, 'prefiltered': 0, 'leak': 0, 'banned': 0, 'stream_chunks': 0}
+
+    def _scan(self, text, start, state):
+        """Ищет нарушения начиная с позиции start; state - найденные темы и контексты"""
+        match = self.long_token_pattern.search(text, start)
+        if match:
+            return GuardVerdict(False, 'leak', "pattern:long_token", match.start())
+
+        lowered = text[start:].lower()
+        for match in self.anchor_pattern.finditer(lowered):
+            state['anchors'] += 1
+            for category, reason, verify in self.rules[match.group()]:
+                if verify is _WORD_START:
+                    previous = lowered[match.start() - 1] if match.start() else text[start - 1:start]
+                    if previous and _is_word_char(previous):
+                        continue
+                elif verify is not None and not verify.match(lowered, match.start()):
+                    continue
+                position = start + match.start()
+                if category == 'leak':
+                    return GuardVerdict(False, category, reason, position)
+                if category == 'context':
+                    state['contexts'].add(reason)
+                elif reason in self.exceptions:
+                    state['pending'].setdefault(reason, position)
+                else:
+                    return GuardVerdict(False, category, reason, position)
+        return None
+
+    def _resolve(self, state):
+        """Тема из pending запрещена, если в тексте так и не встретился ее контекст"""
+        for topic, position in state['pending'].items():
+            if topic not in state['contexts']:
+                return GuardVerdict(False, 'banned', topic, position)
+        return ALLOWED
+
+    def _count(self, verdict):
+        if not verdict.allowed:
+            self.stats[verdict.category] += 1
+            logger.warning(f"Ответ модели отклонен: {verdict.category} ({verdict.reason})")
+        return verdict
+
+    def check(self, text):
+        """Проверяет готовый ответ целиком"""
+        self.stats['checks'] += 1
+        if not text:
+            return ALLOWED
+        state = _new_state()
+        verdict = self._scan(text, 0, state)
+        if verdict is None:
+            if not state['anchors']:
+                self.stats['prefiltered'] += 1
+            verdict = self._resolve(state)
+        return self._count(verdict)
+
+    def stream(self):
+        """Инкрементальная проверка потокового ответа"""
+        return StreamGuard(self)
+
+    def get_stats(self):
+        return dict(self.stats)
+
+_WORD_START = object()  # проверка: совпадение с начала слова
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+def _new_state():
+    return {'pending': {}, 'contexts': set(), 'anchors': 0}
+
+class StreamGuard:
+    """Проверка растущего текста: каждый вызов feed досматривает только новую часть.
+
+    feed принимает накопленный текст и возвращает вердикт для частичного ответа: утечки
+    и безусловно запрещенные темы отклоняются сразу, темы с контекстом ("авто") решаются
+    в finish, когда ответ завершен.
+    """
+
+    def __init__(self, guard):
+        self.guard = guard
+        self.state = _new_state()
+        self.scanned = 0  # все совпадения до этой позиции уже учтены (начало незавершенной строки)
+        self.verdict = ALLOWED
+
+    def feed(self, text):
+        self.guard.stats['stream_chunks'] += 1
+        if not self.verdict.allowed:
+            return self.verdict
+        if len(text) < self.scanned:
+            # Генерация началась заново - проверяем с начала
+            self.state = _new_state()
+            self.scanned = 0
+
+        verdict = self.guard._scan(text, self.scanned, self.state)
+        if verdict is not None:
+            self.verdict = self.guard._count(verdict)
+            return self.verdict
+
+        # Совпадения в завершенных строках окончательны; незавершенную строку досмотрим заново
+        line_start = text.rfind('\n', self.scanned) + 1
+        if line_start:
+            self.scanned = line_start
+        return ALLOWED
+
+    def finish(self, text=None):
+        """Итоговый вердикт по завершенному ответу"""
+        if text is not None:
+            verdict = self.feed(text)
+            if not verdict.allowed:
+                return verdict
+        if not self.verdict.allowed:
+            return self.verdict
+        self.guard.stats['checks'] += 1
+        self.verdict = self.guard._count(self.guard._resolve(self.state))
+        return self.verdict
@@ -0,0 +1,176 @@
+# profiling.py
+import os
+import sys
+import time
+import signal
+import asyncio
+import threading
+import tracemalloc
+from collections import Counter
+
+# Ограничения профилирования по запросу администратора
+PROFILING_CONFIG = {
+    'MAX_SECONDS': float(os.getenv("PROFILE_MAX_SECONDS", "60")),
+    'DEFAULT_INTERVAL': 0.005,  # период выборки стека (сек)
+    'MIN_INTERVAL': 0.001,
+    'MAX_DEPTH': 64,
+    'TRACEMALLOC_FRAMES': 10,
+    'TOP': 30,
+}
+
+class ProfilerBusy(Exception):
+    """Профилирование уже выполняется"""
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+class SamplingProfiler:
+    """Статистический профилировщик стека потока event loop.
+
+    Основной режим - таймер процессорного времени (SIGPROF): обработчик сигнала выполняется
+    в самом потоке event loop между инструкциями байткода и видит точный стек, а пока
+    процесс простаивает, выборок нет. Вне главного потока (и без setitimer) стек снимает
+    отдельный поток; такая выборка смещена к местам, где event loop отпускает GIL.
+    """
+
+    def __init__(self, interval, max_depth=None):
+        self.interval = interval
+        self.max_depth = max_depth or PROFILING_CONFIG['MAX_DEPTH']
+        self.stacks = Counter()  # "a;b;c" (от корня к вершине): число выборок
+        self.samples = 0
+        self.thread_id = threading.get_ident()
+        self.use_signal = hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+        self.mode = 'cpu_timer' if self.use_signal else 'thread'
+
+    def _record(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if names:
+            self.stacks[';'.join(reversed(names))] += 1
+            self.samples += 1
+
+    def _on_signal(self, signum, frame):
+        self._record(frame)
+
+    def _sample_thread(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self._record(sys._current_frames().get(self.thread_id))
+            time.sleep(self.interval)
+
+    async def run(self, seconds):
+        if not self.use_signal:
+            await asyncio.get_running_loop().run_in_executor(None, self._sample_thread, seconds)
+            return
+        previous = signal.signal(signal.SIGPROF, self._on_signal)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+
+    def top_functions(self, limit):
+        """Функции по доле выборок, где они на вершине стека (self) и где-либо в стеке (total)"""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            names = stack.split(';')
+            own[names[-1]] += count
+            for name in set(names):
+                total[name] += count
+        samples = self.samples or 1
+        return [
+            {'function': name, 'self_pct': round(own[name] * 100 / samples, 1),
+             'total_pct': round(total[name] * 100 / samples, 1)}
+            for name, _ in own.most_common(limit)
+        ]
+
+    def report(self, limit=None):
+        limit = limit or PROFILING_CONFIG['TOP']
+        return {
+            'mode': self.mode,
+            'samples': self.samples,
+            'interval_ms': round(self.interval * 1000, 2),
+            'top': self.top_functions(limit),
+            # Свернутые стеки: формат flamegraph.pl / speedscope
+            'collapsed': '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()),
+        }
+
+class ProfilingSession:
+    """Профилирование по запросу: одновременно выполняется не больше одного замера"""
+
+    def __init__(self):
+        self.config = PROFILING_CONFIG
+        self.lock = asyncio.Lock()
+        self.stats = {'cpu_profiles': 0, 'memory_profiles': 0, 'rejected': 0}
+
+    def _clamp(self, seconds):
+        return max(0.1, min(float(seconds), self.config['MAX_SECONDS']))
+
+    async def _exclusive(self):
+        if self.lock.locked():
+            self.stats['rejected'] += 1
+            raise ProfilerBusy("Профилирование уже выполняется")
+        await self.lock.acquire()
+
+    async def cpu_profile(self, seconds, interval=None):
+        """Снимает стеки event loop в течение seconds и возвращает отчет"""
+        await self._exclusive()
+        try:
+            seconds = self._clamp(seconds)
+            interval = max(self.config['MIN_INTERVAL'], float(interval or self.config['DEFAULT_INTERVAL']))
+            profiler = SamplingProfiler(interval)
+            started = time.monotonic()
+            await profiler.run(seconds)
+            self.stats['cpu_profiles'] += 1
+            report = profiler.report()
+            report['seconds'] = round(time.monotonic() - started, 2)
+            return report
+        finally:
+            self.lock.release()
+
+    async def memory_diff(self, seconds, limit=None):
+        """Разница снимков tracemalloc за seconds: где выделенная память выросла"""
+        await self._exclusive()
+        limit = limit or self.config['TOP']
+        # Если tracemalloc уже запущен (PYTHONTRACEMALLOC), не останавливаем его
+        started_here = not tracemalloc.is_tracing()
+        try:
+            if started_here:
+                tracemalloc.start(self.config['TRACEMALLOC_FRAMES'])
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(self._clamp(seconds))
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            self.stats['memory_profiles'] += 1
+        finally:
+            if started_here:
+                tracemalloc.stop()
+            self.lock.release()
+
+        # Сравнение снимков заметно нагружает CPU - выполняем вне event loop
+        diff = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: after.compare_to(before, 'lineno')[:limit]
+        )
+        return {
+            'seconds': self._clamp(seconds),
+            'traced_current_kb': round(current / 1024, 1),
+            'traced_peak_kb': round(peak / 1024, 1),
+            'top': [
+                {'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                 'size_diff_kb': round(stat.size_diff / 1024, 1), 'size_kb': round(stat.size / 1024, 1),
+                 'count_diff': stat.count_diff}
+                for stat in diff
+            ],
+        }
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['running'] = self.lock.locked()
+        return stats
+
+# Глобальный экземпляр
+profiling = ProfilingSession()
@@ -0,0 +1,87 @@
+# rate_limiter.py
+import time
+from collections import deque
+
+class _Window:
+    """Окно одного ключа: события (время, количество) по порядку и их сумма"""
+    __slots__ = ('events', 'total')
+
+    def __init__(self):
+        self.events = deque()
+        self.total = 0
+
+class SlidingWindowLimiter:
+    """Точный лимитер скользящего окна с амортизированной сложностью O(1).
+
+    Для каждого ключа хранится очередь событий в порядке времени. Устаревшие события
+    снимаются с головы очереди, новые добавляются в хвост, а счетчик поддерживается
+    инкрементально, поэтому проверка не перебирает всю историю запросов.
+    """
+
+    def __init__(self):
+        self.windows = {}
+
+    def _prune(self, window, period, now):
+        events = window.events
+        while events and now - events[0][0] >= period:
+            window.total -= events.popleft()[1]
+
+    def peek(self, key, period, now=None):
+        """Количество событий ключа за период (без регистрации нового)"""
+        window = self.windows.get(key)
+        if window is None:
+            return 0
+        self._prune(window, period, now if now is not None else time.time())
+        return window.total
+
+    def record(self, key, cost=1, now=None):
+        """Регистрирует события без проверки лимита"""
+        now = now if now is not None else time.time()
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = _Window()
+
+        # События в один и тот же момент хранятся одной записью
+        if window.events and window.events[-1][0] == now:
+            window.events[-1][1] += cost
+        else:
+            window.events.append([now, cost])
+        window.total += cost
+
+    def try_acquire(self, key, limit, period, cost=1, now=None):
+        """Проверка и регистрация за одну операцию: возвращает (разрешено, текущее количество)"""
+        now = now if now is not None else time.time()
+        window = self.windows.get(key)
+        if window is not None:
+            self._prune(window, period, now)
+            if window.total + cost > limit:
+                return False, window.total
+
+        self.record(key, cost, now)
+        return True, self.windows[key].total
+
+    def last_seen(self, key):
+        """Время последнего события ключа или None"""
+        window = self.windows.get(key)
+        if window is None or not window.events:
+            return None
+        return window.events[-1][0]
+
+    def discard(self, key):
+        """Удаляет состояние ключа"""
+        self.windows.pop(key, None)
+
+    def evict_idle(self, period, now=None):
+        """Удаляет ключи без событий за период, возвращает количество удаленных"""
+        now = now if now is not None else time.time()
+        idle = []
+        for key, window in self.windows.items():
+            self._prune(window, period, now)
+            if not window.total:
+                idle.append(key)
+        for key in idle:
+            del self.windows[key]
+        return len(idle)
+
+    def __len__(self):
+        return len(self.windows)
@@ -0,0 +1,131 @@
+# response_cache.py
+import os
+import re
+import html
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Настройки кэша ответов LLM с возможностью переопределения через переменные окружения
+RESPONSE_CACHE_CONFIG = {
+    'ENABLED': os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true",
+    'TTL': int(os.getenv("RESPONSE_CACHE_TTL", "3600")),  # время жизни ответа (сек)
+    'MAX_BYTES': int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(2 * 1024 * 1024))),  # 2MB
+    'MIN_KEY_LENGTH': 3,  # слишком короткие вопросы ("да", "ок") не кэшируем
+}
+
+# Все, что не буква/цифра/пробел, считается пунктуацией
+_PUNCTUATION_PATTERN = re.compile(r'[^\w\s]|_')
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_question(text):
+    """Нормализует текст вопроса для использования в качестве ключа кэша"""
+    if not text:
+        return ""
+    # sanitize_input экранирует HTML, возвращаем исходные символы
+    text = html.unescape(text).lower().replace('ё', 'е')
+    text = _PUNCTUATION_PATTERN.sub(' ', text)
+    return _WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def make_fingerprint(*parts):
+    """Отпечаток содержимого, от которого зависят ответы (системный промпт, настройки модели)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+class ResponseCache:
+    """LRU-кэш ответов LLM с TTL и ограничением суммарного размера в байтах"""
+
+    def __init__(self, max_bytes=None, ttl=None):
+        self.config = RESPONSE_CACHE_CONFIG
+        self.max_bytes = max_bytes or self.config['MAX_BYTES']
+        self.ttl = ttl or self.config['TTL']
+        self.entries = OrderedDict()  # key: (reply, expires_at, size)
+        self.current_bytes = 0
+        self.fingerprint = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def ensure_fingerprint(self, fingerprint):
+        """Сбрасывает кэш, если изменилась конфигурация салона или системный промпт"""
+        if fingerprint != self.fingerprint:
+            if self.fingerprint is not None and self.entries:
+                logger.info(f"Конфигурация ответов изменилась, кэш сброшен ({len(self.entries)} записей)")
+            self.invalidate()
+            self.fingerprint = fingerprint
+
+    def invalidate(self):
+        """Полная очистка кэша"""
+        if self.entries:
+            self.stats['invalidations'] += 1
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def get(self, key):
+        """Возвращает закэшированный ответ или None"""
+        if not self.config['ENABLED'] or len(key) < self.config['MIN_KEY_LENGTH']:
+            return None
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        reply, expires_at, size = entry
+        if time.monotonic() >= expires_at:
+            self._remove(key)
+            self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return reply
+
+    def put(self, key, reply):
+        """Сохраняет ответ, вытесняя самые старые записи при превышении лимита размера"""
+        if not self.config['ENABLED'] or len(key) < self.config['MIN_KEY_LENGTH']:
+            return
+
+        size = len(key.encode('utf-8')) + len(reply.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+
+        while self.entries and self.current_bytes + size > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            self._remove(oldest_key)
+            self.stats['evictions'] += 1
+
+        self.entries[key] = (reply, time.monotonic() + self.ttl, size)
+        self.current_bytes += size
+        self.stats['stores'] += 1
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def get_stats(self):
+        """Статистика попаданий для оценки сэкономленных запросов к LLM"""
+        stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['entries'] = len(self.entries)
+        stats['bytes'] = self.current_bytes
+        return stats
+
+# Инициализация кэша ответов
+response_cache = ResponseCache()
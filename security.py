@@ -1,21 +1,27 @@
 # security.py
 import time
 import html
+import asyncio
 import re
 import logging
-import asyncio
-from datetime import datetime
-from collections import defaultdict
+from collections import OrderedDict, namedtuple
 from functools import wraps
-import logging.handlers
 import os
 
+from expiry_scheduler import ExpiryScheduler
+from security_storage import create_storage
+from outbound_scheduler import outbound
+from metrics import SECURITY_CHECK_SECONDS, SECURITY_REJECTIONS, SECURITY_BLOCKS
+from tracing import tracer
+from log_pipeline import log_pipeline
+
 # Добавляем необходимые импорты для telegram бота
 from telegram import Update
 from telegram.ext import ContextTypes
 
 # Настройка логгера для модуля безопасности
 logger = logging.getLogger(__name__)
+security_logger = logging.getLogger('security')
 
 # Конфигурация безопасности с возможностью переопределения через переменные окружения
 SECURITY_CONFIG = {
@@ -28,15 +34,128 @@ SECURITY_CONFIG = {
     'WARNING_THRESHOLD': int(os.getenv("WARNING_THRESHOLD", "3")),
     'WARNING_DURATION': int(os.getenv("WARNING_DURATION", "3600")),
     'LOG_MAX_BYTES': 10 * 1024 * 1024,  # 10MB
-    'LOG_BACKUP_COUNT': 5
+    'LOG_BACKUP_COUNT': 5,
+    'SCAN_CACHE_SIZE': int(os.getenv("SCAN_CACHE_SIZE", "512")),  # сколько вердиктов сканера хранить
+    'SCAN_MAX_GAP': 200,  # максимальное расстояние для ".*" в паттернах (защита от катастрофического возврата)
 }
 
+# Символы, которые re.IGNORECASE сопоставляет с ASCII-буквами, а str.lower() - нет
+# (длинная s и турецкие i): префильтр приводит их к той же букве, иначе пропустит совпадение
+_ASCII_FOLD = str.maketrans({'ſ': 's', 'ı': 'i', 'İ': 'i'})
+
+# Результат проверки текста: категория ('critical'/'non_critical') и сработавший паттерн
+ScanVerdict = namedtuple('ScanVerdict', ['category', 'pattern'])
+
+class ThreatScanner:
+    """Сканер входящего текста на подозрительные паттерны с литеральным префильтром.
+    
+    Из каждого паттерна один раз при старте извлекается обязательная литеральная подстрока.
+    Все литералы объединены в одну скомпилированную альтернативу, которая за один проход
+    по тексту в нижнем регистре отсеивает обычные сообщения. Регулярные выражения
+    (скомпилированные и с ограниченными ".*") проверяются только для найденных кандидатов.
+    """
+    
+    def __init__(self, critical_patterns, non_critical_patterns, cache_size=None, max_gap=None):
+        self.max_gap = max_gap or SECURITY_CONFIG['SCAN_MAX_GAP']
+        self.cache_size = cache_size or SECURITY_CONFIG['SCAN_CACHE_SIZE']
+        
+        # Порядок правил важен: критические паттерны проверяются первыми
+        self.rules = []
+        for category, patterns in (('critical', critical_patterns), ('non_critical', non_critical_patterns)):
+            for pattern in patterns:
+                self.rules.append((
+                    ScanVerdict(category, pattern),
+                    self._required_literal(pattern),
+                    re.compile(self._bound_pattern(pattern), re.IGNORECASE)
+                ))
+        
+        literals = sorted({literal for _, literal, _ in self.rules if literal}, key=len, reverse=True)
+        self.literal_regex = re.compile("|".join(re.escape(literal) for literal in literals)) if literals else None
+        # Паттерны без литерала префильтр не отсеивает
+        self.always_check = any(literal is None for _, literal, _ in self.rules)
+        
+        self.cache = OrderedDict()
+        self.stats = {'scans': 0, 'prefilter_rejects': 0, 'regex_checks': 0, 'cache_hits': 0}
+    
+    def _bound_pattern(self, pattern):
+        """Заменяет неограниченные ".*" на ограниченные, чтобы исключить квадратичный перебор"""
+        pattern = pattern.replace('.*?', f'.{{0,{self.max_gap}}}?')
+        return re.sub(r'\.\*(?!\?)', f'.{{0,{self.max_gap}}}', pattern)
+    
+    @staticmethod
+    def _required_literal(pattern):
+        """Самая длинная литеральная подстрока, без которой паттерн не может совпасть"""
+        # Группы и альтернативы не разбираем - такие паттерны проверяются всегда
+        unescaped = re.sub(r'\\.', '', pattern)
+        if '|' in unescaped or '(' in unescaped:
+            return None
+        
+        runs, current, i = [], "", 0
+        while i < len(pattern):
+            char = pattern[i]
+            if char == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                current += pattern[i + 1]
+                i += 2
+                continue
+            if char in '*?{':
+                # Предыдущий символ необязателен
+                current = current[:-1]
+                runs.append(current)
+                current = ""
+                if char == '{':
+                    i = pattern.find('}', i) + 1 or len(pattern)
+                    continue
+            elif char == '[':
+                runs.append(current)
+                current = ""
+                i = pattern.find(']', i + 1) + 1 or len(pattern)
+                continue
+            elif char == '\\' or char in '.^$+)':
+                runs.append(current)
+                current = ""
+                if char == '\\':
+                    i += 1
+            else:
+                current += char
+            i += 1
+        runs.append(current)
+        
+        literal = max(runs, key=len).lower()
+        return literal if len(literal) >= 2 else None
+    
+    def scan(self, text):
+        """Возвращает ScanVerdict для первого найденного паттерна (критические важнее) или None"""
+        if not text or not isinstance(text, str):
+            return None
+        
+        if text in self.cache:
+            self.cache.move_to_end(text)
+            self.stats['cache_hits'] += 1
+            return self.cache[text]
+        
+        self.stats['scans'] += 1
+        verdict = None
+        lowered = text.lower() if text.isascii() else text.translate(_ASCII_FOLD).lower()
+        if not self.always_check and (self.literal_regex is None or not self.literal_regex.search(lowered)):
+            self.stats['prefilter_rejects'] += 1
+        else:
+            for rule_verdict, literal, regex in self.rules:
+                if literal is not None and literal not in lowered:
+                    continue
+                self.stats['regex_checks'] += 1
+                if regex.search(text):
+                    verdict = rule_verdict
+                    break
+        
+        self.cache[text] = verdict
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return verdict
+
 class SecuritySystem:
-    def __init__(self):
-        self.user_activity = defaultdict(list)
-        self.global_activity = []
-        self.blocked_users = {}
-        self.user_warnings = defaultdict(list)  # user_id: list of (timestamp, reason)
+    def __init__(self, storage=None):
+        # Счетчики запросов, блокировки и предупреждения (в памяти или общие для нескольких процессов)
+        self.storage = storage or create_storage()
         self.config = SECURITY_CONFIG
         
         # Критические паттерны - немедленная блокировка
@@ -55,136 +174,135 @@ class SecuritySystem:
             r"api[_-]?key", r"auth", r"login", r"credential"
         ]
         
+        # Единый планировщик сроков: разблокировки, истечение предупреждений, очистка неактивных
+        self.scheduler = ExpiryScheduler()
+        self.scheduler.register('unblock', self._expire_block)
+        self.scheduler.register('warnings', self._expire_warnings)
+        self.scheduler.register('idle', self._evict_idle)
+        
+        # Сканер собирается один раз при старте
+        self.scanner = ThreatScanner(self.critical_patterns, self.non_critical_patterns)
+        
         # Настройка ротации логов
         self.setup_logging()
     
     def setup_logging(self):
-        """Настройка ротации логов безопасности"""
+        """Настройка ротации логов безопасности: записи логгера 'security' дополнительно идут в файл"""
         try:
-            # Создаем директорию для логов, если её нет
-            os.makedirs("logs", exist_ok=True)
-            
-            log_handler = logging.handlers.RotatingFileHandler(
-                "logs/security.log",
-                maxBytes=self.config['LOG_MAX_BYTES'],
-                backupCount=self.config['LOG_BACKUP_COUNT'],
-                encoding='utf-8'
-            )
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            log_handler.setFormatter(formatter)
-            
-            security_logger = logging.getLogger('security')
-            security_logger.addHandler(log_handler)
+            # Запись в файл выполняет фоновый поток конвейера логов
+            log_pipeline.add_file("logs/security.log", prefix='security',
+                                  max_bytes=self.config['LOG_MAX_BYTES'],
+                                  backup_count=self.config['LOG_BACKUP_COUNT'])
             security_logger.setLevel(logging.INFO)
         except Exception as e:
             logger.error(f"Failed to setup security log rotation: {e}")
     
-    def get_current_request_count(self, user_id, period=None):
+    @staticmethod
+    def _user_key(user_id):
+        return f"user:{user_id}"
+    
+    async def _storage(self, method, *args):
+        """Вызов хранилища: блокирующее (SQLite) выполняется в потоке, чтобы не держать event loop"""
+        if self.storage.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+    
+    async def get_current_request_count(self, user_id, period=None):
         """Возвращает текущее количество запросов пользователя за период"""
         period = period or self.config['USER_RATE_PERIOD']
-        current_time = time.time()
-        
-        # Очистка старых запросов
-        self.user_activity[user_id] = [
-            t for t in self.user_activity[user_id] 
-            if current_time - t < period
-        ]
-        
-        return len(self.user_activity[user_id])
+        return await self._storage(self.storage.count, self._user_key(user_id), period)
+    
+    async def record_requests(self, user_id, count=1):
+        """Регистрирует запросы пользователя без проверки лимита"""
+        await self._storage(self.storage.record, self._user_key(user_id), count)
+        self._schedule_idle(user_id)
+    
+    def _schedule_idle(self, user_id):
+        """Планирует удаление истории пользователя после периода неактивности (один срок на пользователя)"""
+        if not self.scheduler.is_scheduled('idle', user_id):
+            self.scheduler.schedule('idle', user_id, time.time() + self.config['USER_RATE_PERIOD'])
+    
+    async def _evict_idle(self, user_id, now):
+        """Удаляет историю запросов неактивного пользователя или переносит проверку"""
+        last_seen = await self._storage(self.storage.last_seen, self._user_key(user_id))
+        if last_seen is None:
+            return
+        if now - last_seen >= self.config['USER_RATE_PERIOD']:
+            await self._storage(self.storage.discard, self._user_key(user_id))
+        else:
+            self.scheduler.schedule('idle', user_id, last_seen + self.config['USER_RATE_PERIOD'])
+    
+    def scan_text(self, text):
+        """Проверка текста с указанием категории и сработавшего паттерна"""
+        return self.scanner.scan(text)
     
     def detect_suspicious(self, text):
         """Обнаружение подозрительных паттернов с разделением на критические и не критические"""
-        if not text or not isinstance(text, str):
-            return None
-            
-        # Сначала проверяем критические паттерны
-        for pattern in self.critical_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return 'critical'
-        
-        # Затем не критические паттерны
-        for pattern in self.non_critical_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return 'non_critical'
-                
-        return None
+        verdict = self.scanner.scan(text)
+        return verdict.category if verdict else None
     
-    def check_rate_limit(self, user_id, max_requests=None, period=None):
+    async def check_rate_limit(self, user_id, max_requests=None, period=None):
         """Проверка ограничения частоты запросов"""
         max_requests = max_requests or self.config['USER_RATE_LIMIT']
         period = period or self.config['USER_RATE_PERIOD']
         
-        current_time = time.time()
-        
-        # Очистка старых запросов
-        self.user_activity[user_id] = [
-            t for t in self.user_activity[user_id] 
-            if current_time - t < period
-        ]
-        
-        if len(self.user_activity[user_id]) >= max_requests:
+        allowed, count = await self._storage(self.storage.hit, self._user_key(user_id), max_requests, period)
+        self._schedule_idle(user_id)
+        if not allowed:
+            _REJECTED_USER_RATE.inc()
             self.log_security_event(user_id, "RATE_LIMIT_EXCEEDED", 
-                                  f"Attempts: {len(self.user_activity[user_id])}")
-            return False
-        
-        self.user_activity[user_id].append(current_time)
-        return True
+                                  f"Attempts: {count}")
+        return allowed
     
-    def check_global_limit(self, max_requests=None, period=None):
+    async def check_global_limit(self, max_requests=None, period=None):
         """Глобальное ограничение запросов"""
         max_requests = max_requests or self.config['GLOBAL_RATE_LIMIT']
         period = period or self.config['GLOBAL_RATE_PERIOD']
         
-        current_time = time.time()
-        self.global_activity = [
-            t for t in self.global_activity 
-            if current_time - t < period
-        ]
-        
-        if len(self.global_activity) >= max_requests:
+        allowed, count = await self._storage(self.storage.hit, "global", max_requests, period)
+        if not allowed:
             self.log_security_event("GLOBAL", "GLOBAL_RATE_LIMIT_EXCEEDED",
-                                  f"Global attempts: {len(self.global_activity)}")
-            return False
-        
-        self.global_activity.append(current_time)
-        return True
+                                  f"Global attempts: {count}")
+        return allowed
     
-    def add_warning(self, user_id, reason):
+    async def add_warning(self, user_id, reason):
         """Добавляет предупреждение пользователю и возвращает True, если превышен лимит"""
         current_time = time.time()
         
-        # Очищаем старые предупреждения
-        self.user_warnings[user_id] = [
-            (t, r) for t, r in self.user_warnings[user_id] 
-            if current_time - t < self.config['WARNING_DURATION']
-        ]
+        # Добавляем новое предупреждение (старые очищаются хранилищем)
+        warnings = await self._storage(self.storage.add_warning, user_id, current_time, reason,
+                                       self.config['WARNING_DURATION'])
+        if not warnings:
+            # Хранилище недоступно - предупреждение не записано, лимит не проверяем
+            return False
         
-        # Добавляем новое предупреждение
-        self.user_warnings[user_id].append((current_time, reason))
+        # Срок истечения назначается по самому старому активному предупреждению
+        if not self.scheduler.is_scheduled('warnings', user_id):
+            self.scheduler.schedule('warnings', user_id, warnings[0][0] + self.config['WARNING_DURATION'])
         
         # Логируем добавление предупреждения
         self.log_security_event(user_id, "WARNING_ADDED", 
-                              f"Reason: {reason}, Count: {len(self.user_warnings[user_id])}")
+                              f"Reason: {reason}, Count: {len(warnings)}")
         
         # Проверяем, превышен ли лимит предупреждений
-        if len(self.user_warnings[user_id]) >= self.config['WARNING_THRESHOLD']:
+        if len(warnings) >= self.config['WARNING_THRESHOLD']:
             self.log_security_event(user_id, "WARNING_LIMIT_EXCEEDED",
-                                  f"Warning count: {len(self.user_warnings[user_id])}")
+                                  f"Warning count: {len(warnings)}")
             return True
             
         return False
     
-    def get_warning_count(self, user_id):
+    async def _expire_warnings(self, user_id, now):
+        """Срок самого старого предупреждения истек: очищаем и планируем следующий"""
+        warnings = await self._storage(self.storage.get_warnings, user_id, now, self.config['WARNING_DURATION'])
+        if warnings:
+            self.scheduler.schedule('warnings', user_id, warnings[0][0] + self.config['WARNING_DURATION'])
+    
+    async def get_warning_count(self, user_id):
         """Возвращает количество активных предупреждений пользователя"""
-        current_time = time.time()
-        
-        # Очищаем старые предупреждения
-        self.user_warnings[user_id] = [
-            (t, r) for t, r in self.user_warnings[user_id] 
-            if current_time - t < self.config['WARNING_DURATION']
-        ]
-        
-        return len(self.user_warnings[user_id])
+        warnings = await self._storage(self.storage.get_warnings, user_id, time.time(),
+                                       self.config['WARNING_DURATION'])
+        return len(warnings)
     
     def sanitize_input(self, text):
         """Очистка входных данных"""
@@ -210,35 +328,45 @@ class SecuritySystem:
         duration = duration or self.config['DEFAULT_BLOCK_DURATION']
         unblock_time = time.time() + duration
         
-        self.blocked_users[user_id] = unblock_time
+        await self._storage(self.storage.block, user_id, unblock_time)
+        SECURITY_BLOCKS.inc()
         self.log_security_event(user_id, "USER_BLOCKED", f"Duration: {duration} seconds")
         
-        # Запланировать автоматическую разблокировку
-        asyncio.create_task(self._unblock_user(user_id, duration))
+        # Запланировать автоматическую разблокировку (повторная блокировка переносит срок)
+        self.scheduler.schedule('unblock', user_id, unblock_time)
     
-    async def _unblock_user(self, user_id, duration):
+    async def _expire_block(self, user_id, now):
         """Автоматическая разблокировка пользователя после истечения времени"""
-        await asyncio.sleep(duration)
-        if user_id in self.blocked_users:
-            del self.blocked_users[user_id]
+        unblock_time = await self._storage(self.storage.blocked_until, user_id)
+        if unblock_time is not None and now >= unblock_time:
+            await self._storage(self.storage.unblock, user_id)
             self.log_security_event(user_id, "USER_UNBLOCKED", "Auto-unblock after timeout")
+    
+    def start_background_tasks(self):
+        """Запуск фонового планировщика сроков (вызывается при инициализации бота)"""
+        self.scheduler.start()
+    
+    async def stop_background_tasks(self):
+        """Остановка фонового планировщика сроков и запись накопленных изменений"""
+        await self.scheduler.stop()
+        await self._storage(self.storage.flush)
         
-    def is_user_blocked(self, user_id):
+    async def is_user_blocked(self, user_id):
         """Проверка, заблокирован ли пользователь"""
-        if user_id not in self.blocked_users:
+        unblock_time = await self._storage(self.storage.blocked_until, user_id)
+        if unblock_time is None:
             return False
             
         # Проверяем, не истекло ли время блокировки
-        if time.time() > self.blocked_users[user_id]:
-            del self.blocked_users[user_id]
+        if time.time() > unblock_time:
+            await self._storage(self.storage.unblock, user_id)
+            self.scheduler.cancel('unblock', user_id)
             return False
             
         return True
     
     def log_security_event(self, user_id, event_type, message=""):
         """Логирование событий безопасности с маскированием конфиденциальных данных"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
         # Маскирование пользовательских данных в логах
         masked_message = message
         if "Text:" in message:
@@ -247,30 +375,30 @@ class SecuritySystem:
             if len(text_part) > 50:
                 masked_message = message.replace(text_part, text_part[:50] + "...")
         
-        log_message = f"[SECURITY] {timestamp} - {event_type} - User: {user_id}"
+        if "RATE_LIMIT" in event_type or "BLOCKED" in event_type or "WARNING_LIMIT" in event_type:
+            level = logging.WARNING
+        else:
+            level = logging.INFO
         
+        # Одна запись: консоль и logs/security.log получают ее из очереди конвейера логов
+        extra = {'event': 'security_event', 'fields': {'security_event': event_type, 'user_id': user_id}}
         if masked_message:
-            log_message += f" - Details: {masked_message}"
-        
-        # Запись в файл с ротацией
-        try:
-            security_logger = logging.getLogger('security')
-            if "RATE_LIMIT" in event_type or "BLOCKED" in event_type or "WARNING_LIMIT" in event_type:
-                security_logger.warning(log_message)
-            else:
-                security_logger.info(log_message)
-        except Exception as e:
-            logger.error(f"Failed to write to security log: {e}")
-        
-        # Также логируем через стандартный логгер
-        if "RATE_LIMIT" in event_type or "BLOCKED" in event_type or "WARNING_LIMIT" in event_type:
-            logger.warning(log_message)
+            security_logger.log(level, "[SECURITY] %s - User: %s - Details: %s", event_type, user_id,
+                                masked_message, extra=extra)
         else:
-            logger.info(log_message)
+            security_logger.log(level, "[SECURITY] %s - User: %s", event_type, user_id, extra=extra)
 
 # Инициализация системы безопасности
 security = SecuritySystem()
 
+# Метрики отказов по причинам (метки создаются один раз)
+_REJECTED_USER_RATE = SECURITY_REJECTIONS.labels('user_rate_limit')
+_REJECTED_BLOCKED = SECURITY_REJECTIONS.labels('blocked_user')
+_REJECTED_GLOBAL = SECURITY_REJECTIONS.labels('global_limit')
+_REJECTED_CRITICAL = SECURITY_REJECTIONS.labels('critical_pattern')
+_REJECTED_SUSPICIOUS = SECURITY_REJECTIONS.labels('suspicious_pattern')
+_REJECTED_INVALID = SECURITY_REJECTIONS.labels('invalid_content')
+
 # Исправленный декоратор secure_handler
 def secure_handler(func):
     @wraps(func)
@@ -280,38 +408,53 @@ def secure_handler(func):
             return await func(update, context)
             
         user_id = update.effective_user.id
+        checks_started = time.perf_counter()
         
         # Проверка блокировки
-        if security.is_user_blocked(user_id):
-            await update.message.reply_text("⛔ Вы временно заблокированы за нарушение правил.")
+        if await security.is_user_blocked(user_id):
+            _REJECTED_BLOCKED.inc()
+            tracer.record('security', checks_started, outcome='blocked_user')
+            await outbound.reply_text(update.message, "⛔ Вы временно заблокированы за нарушение правил.")
             security.log_security_event(user_id, "BLOCKED_USER_ATTEMPT")
             return
         
         # Проверка глобального лимита
-        if not security.check_global_limit():
-            await update.message.reply_text("⚠️ Система перегружена. Попробуйте позже.")
+        if not await security.check_global_limit():
+            _REJECTED_GLOBAL.inc()
+            tracer.record('security', checks_started, outcome='global_limit')
+            await outbound.reply_text(update.message, "⚠️ Система перегружена. Попробуйте позже.")
             return
         
         # Проверка на опасные паттерны в сыром тексте
         raw_text = update.message.text
-        suspicious_type = security.detect_suspicious(raw_text)
-        
+        verdict = security.scan_text(raw_text)
+        suspicious_type = verdict.category if verdict else None
+        if verdict:
+            security.log_security_event(user_id, f"SUSPICIOUS_PATTERN_{verdict.category.upper()}",
+                                      f"Pattern: {verdict.pattern}")
+        
+        if suspicious_type is not None:
+            SECURITY_CHECK_SECONDS.observe(time.perf_counter() - checks_started)
+            tracer.record('security', checks_started, outcome=suspicious_type)
         if suspicious_type == 'critical':
             # Критическое нарушение - немедленная блокировка
+            _REJECTED_CRITICAL.inc()
             await security.block_user(user_id)
-            await update.message.reply_text("❌ Обнаружены недопустимые символы. Вы заблокированы на 1 час.")
+            await outbound.reply_text(update.message, "❌ Обнаружены недопустимые символы. Вы заблокированы на 1 час.")
             return
         elif suspicious_type == 'non_critical':
             # Не критическое нарушение - добавляем предупреждение
-            warning_exceeded = security.add_warning(user_id, "SUSPICIOUS_CONTENT")
+            _REJECTED_SUSPICIOUS.inc()
+            warning_exceeded = await security.add_warning(user_id, "SUSPICIOUS_CONTENT")
             
             if warning_exceeded:
                 await security.block_user(user_id)
-                await update.message.reply_text("❌ Вы заблокированы за многократные нарушения.")
+                await outbound.reply_text(update.message, "❌ Вы заблокированы за многократные нарушения.")
             else:
-                warning_count = security.get_warning_count(user_id)
+                warning_count = await security.get_warning_count(user_id)
                 max_warnings = security.config['WARNING_THRESHOLD']
-                await update.message.reply_text(
+                await outbound.reply_text(
+                    update.message,
                     f"⚠️ Обнаружены подозрительные символы. Предупреждение {warning_count}/{max_warnings}. "
                     f"После {max_warnings} предупреждений вы будете заблокированы."
                 )
@@ -319,17 +462,21 @@ def secure_handler(func):
         
         # Очистка входных данных
         safe_text = security.sanitize_input(raw_text)
+        SECURITY_CHECK_SECONDS.observe(time.perf_counter() - checks_started)
+        tracer.record('security', checks_started, outcome='ok' if safe_text is not None else 'invalid_content')
         if safe_text is None:
+            _REJECTED_INVALID.inc()
             # Добавляем предупреждение за недопустимые символы
-            warning_exceeded = security.add_warning(user_id, "INVALID_CONTENT")
+            warning_exceeded = await security.add_warning(user_id, "INVALID_CONTENT")
             
             if warning_exceeded:
                 await security.block_user(user_id)
-                await update.message.reply_text("❌ Вы заблокированы за многократные нарушения.")
+                await outbound.reply_text(update.message, "❌ Вы заблокированы за многократные нарушения.")
             else:
-                warning_count = security.get_warning_count(user_id)
+                warning_count = await security.get_warning_count(user_id)
                 max_warnings = security.config['WARNING_THRESHOLD']
-                await update.message.reply_text(
+                await outbound.reply_text(
+                    update.message,
                     f"⚠️ Обнаружены недопустимые символы. Предупреждение {warning_count}/{max_warnings}. "
                     f"После {max_warnings} предупреждений вы будете заблокированы."
                 )
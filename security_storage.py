@@ -0,0 +1,351 @@
+# security_storage.py
+import os
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from functools import wraps
+from collections import defaultdict
+
+from rate_limiter import SlidingWindowLimiter
+
+logger = logging.getLogger(__name__)
+
+# Настройки хранилища состояния безопасности
+STORAGE_CONFIG = {
+    'BACKEND': os.getenv("SECURITY_STORAGE", "memory"),  # memory | sqlite
+    'SQLITE_PATH': os.getenv("SECURITY_STORAGE_PATH", "data/security.db"),
+    'SQLITE_BUSY_TIMEOUT_MS': int(os.getenv("SECURITY_STORAGE_BUSY_TIMEOUT_MS", "200")),
+    'WRITE_BATCH_SIZE': int(os.getenv("SECURITY_STORAGE_BATCH_SIZE", "100")),
+    'WRITE_FLUSH_INTERVAL': float(os.getenv("SECURITY_STORAGE_FLUSH_INTERVAL", "0.5")),
+    'BLOCK_CACHE_TTL': float(os.getenv("SECURITY_STORAGE_BLOCK_CACHE_TTL", "1.0")),  # сек
+}
+
+class SecurityStorage(ABC):
+    """Интерфейс хранилища счетчиков запросов, блокировок и предупреждений.
+
+    Ключи счетчиков - строки ("user:<id>", "global"). Все методы синхронные: они
+    вызываются на горячем пути обработки каждого обновления. Хранилище с blocking = True
+    обращается к диску или сети, и SecuritySystem вызывает его из отдельного потока.
+    """
+
+    blocking = False
+
+    @abstractmethod
+    def hit(self, key, limit, period, cost=1, now=None):
+        """Атомарная проверка и регистрация запроса: возвращает (разрешено, количество)"""
+
+    @abstractmethod
+    def count(self, key, period, now=None):
+        """Количество запросов ключа за период"""
+
+    @abstractmethod
+    def record(self, key, cost=1, now=None):
+        """Регистрация запросов без проверки лимита (может выполняться пачками)"""
+
+    @abstractmethod
+    def last_seen(self, key):
+        """Время последнего запроса ключа или None"""
+
+    @abstractmethod
+    def discard(self, key):
+        """Удаление истории запросов ключа"""
+
+    @abstractmethod
+    def block(self, user_id, until):
+        """Блокировка пользователя до времени until"""
+
+    @abstractmethod
+    def unblock(self, user_id):
+        """Снятие блокировки"""
+
+    @abstractmethod
+    def blocked_until(self, user_id):
+        """Время окончания блокировки или None"""
+
+    @abstractmethod
+    def add_warning(self, user_id, timestamp, reason, ttl):
+        """Добавляет предупреждение, возвращает список активных (время, причина) по возрастанию времени"""
+
+    @abstractmethod
+    def get_warnings(self, user_id, now, ttl):
+        """Активные предупреждения пользователя (истекшие удаляются)"""
+
+    def flush(self):
+        """Запись накопленных изменений"""
+
+    def close(self):
+        """Освобождение ресурсов"""
+
+    def get_stats(self):
+        return {}
+
+class MemorySecurityStorage(SecurityStorage):
+    """Состояние в памяти процесса (лимиты действуют в пределах одной реплики)"""
+
+    def __init__(self):
+        self.activity = SlidingWindowLimiter()
+        self.blocked_users = {}
+        self.user_warnings = defaultdict(list)  # user_id: list of (timestamp, reason)
+
+    def hit(self, key, limit, period, cost=1, now=None):
+        return self.activity.try_acquire(key, limit, period, cost, now)
+
+    def count(self, key, period, now=None):
+        return self.activity.peek(key, period, now)
+
+    def record(self, key, cost=1, now=None):
+        self.activity.record(key, cost, now)
+
+    def last_seen(self, key):
+        return self.activity.last_seen(key)
+
+    def discard(self, key):
+        self.activity.discard(key)
+
+    def block(self, user_id, until):
+        self.blocked_users[user_id] = until
+
+    def unblock(self, user_id):
+        self.blocked_users.pop(user_id, None)
+
+    def blocked_until(self, user_id):
+        return self.blocked_users.get(user_id)
+
+    def add_warning(self, user_id, timestamp, reason, ttl):
+        warnings = self.get_warnings(user_id, timestamp, ttl)
+        warnings.append((timestamp, reason))
+        self.user_warnings[user_id] = warnings
+        return warnings
+
+    def get_warnings(self, user_id, now, ttl):
+        warnings = self.user_warnings.get(user_id)
+        if warnings is None:
+            return []
+        warnings = [(t, r) for t, r in warnings if now - t < ttl]
+        if warnings:
+            self.user_warnings[user_id] = warnings
+        else:
+            del self.user_warnings[user_id]
+        return warnings
+
+    def get_stats(self):
+        return {
+            'backend': 'memory',
+            'tracked_keys': len(self.activity),
+            'blocked_users': len(self.blocked_users),
+            'users_with_warnings': len(self.user_warnings),
+        }
+
+def _fail_open(default=None):
+    """Метод хранилища под общей блокировкой потоков; если база занята другой репликой
+    дольше busy timeout (database is locked), ошибка не уходит в обработчик: метод
+    возвращает нейтральное значение default (вызываемое - фабрика значения)"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.lock:
+                try:
+                    return method(self, *args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    self.stats['lock_timeouts'] += 1
+                    logger.warning(f"Хранилище безопасности занято, {method.__name__} пропущен: {e}")
+                    return default() if callable(default) else default
+        return wrapper
+    return decorator
+
+class SQLiteSecurityStorage(SecurityStorage):
+    """Общее состояние для нескольких процессов на одном хосте (SQLite в режиме WAL).
+
+    Проверка лимита выполняется в транзакции BEGIN IMMEDIATE, поэтому check-and-increment
+    атомарен между репликами. Запросы без проверки (record) копятся в буфере и пишутся
+    одной транзакцией по размеру пачки или интервалу; до записи они учитываются
+    в счетчиках этой реплики из памяти, другим репликам видны после записи.
+    Если база занята дольше SQLITE_BUSY_TIMEOUT_MS, методы не бросают исключение
+    (fail open): лимит пропускает запрос, чтения возвращают пустой результат, а
+    блокировка действует на этой реплике через локальный кэш. Вызовы блокирующие,
+    SecuritySystem выполняет их в отдельном потоке (blocking = True).
+    """
+
+    blocking = True
+
+    def __init__(self, path=None):
+        self.config = STORAGE_CONFIG
+        self.path = path or self.config['SQLITE_PATH']
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Ручное управление транзакциями; соединение используется из потоков под self.lock
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                  timeout=self.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS rate_events (key TEXT NOT NULL, ts REAL NOT NULL, cost INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS rate_events_key_ts ON rate_events (key, ts);
+            CREATE TABLE IF NOT EXISTS blocks (user_id TEXT PRIMARY KEY, until REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS warnings (user_id TEXT NOT NULL, ts REAL NOT NULL, reason TEXT);
+            CREATE INDEX IF NOT EXISTS warnings_user_ts ON warnings (user_id, ts);
+        """)
+
+        self.lock = threading.RLock()
+        self.pending = []  # (key, ts, cost)
+        self.last_flush = time.monotonic()
+        self.block_cache = {}  # user_id: (until, fetched_at)
+        self.stats = {'hits': 0, 'flushes': 0, 'flushed_rows': 0, 'block_cache_hits': 0,
+                      'lock_timeouts': 0}
+
+    def _maybe_flush(self):
+        if self.pending and (len(self.pending) >= self.config['WRITE_BATCH_SIZE'] or
+                             time.monotonic() - self.last_flush >= self.config['WRITE_FLUSH_INTERVAL']):
+            self.flush()
+
+    def _pending_total(self, key, since):
+        """Сумма еще не записанных запросов ключа после since"""
+        return sum(cost for pending_key, ts, cost in self.pending if pending_key == key and ts > since)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            rows, self.pending = self.pending, []
+            self.last_flush = time.monotonic()
+            try:
+                with self.db:
+                    self.db.execute("BEGIN")
+                    self.db.executemany("INSERT INTO rate_events (key, ts, cost) VALUES (?, ?, ?)", rows)
+            except sqlite3.OperationalError as e:
+                # База занята: строки остаются в буфере до следующего интервала
+                self.pending = rows + self.pending
+                self.stats['lock_timeouts'] += 1
+                logger.warning(f"Не удалось записать запросы в хранилище безопасности ({len(rows)}): {e}")
+                return
+            self.stats['flushes'] += 1
+            self.stats['flushed_rows'] += len(rows)
+
+    def hit(self, key, limit, period, cost=1, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            self._maybe_flush()
+            self.stats['hits'] += 1
+            try:
+                with self.db:
+                    self.db.execute("BEGIN IMMEDIATE")
+                    self.db.execute("DELETE FROM rate_events WHERE key = ? AND ts <= ?", (key, now - period))
+                    total = self.db.execute(
+                        "SELECT COALESCE(SUM(cost), 0) FROM rate_events WHERE key = ?", (key,)
+                    ).fetchone()[0] + self._pending_total(key, now - period)
+                    if total + cost > limit:
+                        return False, total
+                    self.db.execute("INSERT INTO rate_events (key, ts, cost) VALUES (?, ?, ?)", (key, now, cost))
+            except sqlite3.OperationalError as e:
+                # Блокировка базы другой репликой (database is locked): пропускаем запрос,
+                # но учитываем его в буфере, чтобы он вошел в лимит после записи
+                self.stats['lock_timeouts'] += 1
+                logger.warning(f"Хранилище безопасности занято, лимит {key} не проверен: {e}")
+                self.pending.append((key, now, cost))
+                return True, self._pending_total(key, now - period)
+        return True, total + cost
+
+    @_fail_open(default=0)
+    def count(self, key, period, now=None):
+        now = now if now is not None else time.time()
+        self._maybe_flush()
+        return self.db.execute(
+            "SELECT COALESCE(SUM(cost), 0) FROM rate_events WHERE key = ? AND ts > ?", (key, now - period)
+        ).fetchone()[0] + self._pending_total(key, now - period)
+
+    def record(self, key, cost=1, now=None):
+        with self.lock:
+            self.pending.append((key, now if now is not None else time.time(), cost))
+            self._maybe_flush()
+
+    @_fail_open()
+    def last_seen(self, key):
+        self._maybe_flush()
+        stored = self.db.execute("SELECT MAX(ts) FROM rate_events WHERE key = ?", (key,)).fetchone()[0]
+        pending = [ts for pending_key, ts, _ in self.pending if pending_key == key]
+        return max(pending + ([stored] if stored is not None else []), default=None)
+
+    @_fail_open()
+    def discard(self, key):
+        self.pending = [row for row in self.pending if row[0] != key]
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM rate_events WHERE key = ?", (key,))
+
+    @_fail_open()
+    def block(self, user_id, until):
+        # Кэш обновляется до записи: если база занята, блокировка все равно действует на этой реплике
+        self.block_cache[user_id] = (until, time.monotonic())
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("INSERT OR REPLACE INTO blocks (user_id, until) VALUES (?, ?)", (str(user_id), until))
+
+    @_fail_open()
+    def unblock(self, user_id):
+        self.block_cache.pop(user_id, None)
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM blocks WHERE user_id = ?", (str(user_id),))
+
+    @_fail_open()
+    def blocked_until(self, user_id):
+        # Короткий локальный кэш: блокировка с другой реплики видна с задержкой не больше BLOCK_CACHE_TTL
+        cached = self.block_cache.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < self.config['BLOCK_CACHE_TTL']:
+            self.stats['block_cache_hits'] += 1
+            return cached[0]
+
+        row = self.db.execute("SELECT until FROM blocks WHERE user_id = ?", (str(user_id),)).fetchone()
+        until = row[0] if row else None
+        if len(self.block_cache) > 10000:
+            self.block_cache.clear()
+        self.block_cache[user_id] = (until, time.monotonic())
+        return until
+
+    @_fail_open(default=list)
+    def add_warning(self, user_id, timestamp, reason, ttl):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("INSERT INTO warnings (user_id, ts, reason) VALUES (?, ?, ?)",
+                            (str(user_id), timestamp, reason))
+        return self.get_warnings(user_id, timestamp, ttl)
+
+    @_fail_open(default=list)
+    def get_warnings(self, user_id, now, ttl):
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM warnings WHERE user_id = ? AND ts <= ?", (str(user_id), now - ttl))
+            rows = self.db.execute(
+                "SELECT ts, reason FROM warnings WHERE user_id = ? ORDER BY ts", (str(user_id),)
+            ).fetchall()
+        return [(ts, reason) for ts, reason in rows]
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['backend'] = 'sqlite'
+            stats['pending_writes'] = len(self.pending)
+            try:
+                stats['blocked_users'] = self.db.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+            except sqlite3.OperationalError:
+                stats['blocked_users'] = len([c for c in self.block_cache.values() if c[0] is not None])
+        return stats
+
+def create_storage(backend=None):
+    """Создает хранилище по настройке SECURITY_STORAGE"""
+    backend = backend or STORAGE_CONFIG['BACKEND']
+    if backend == 'sqlite':
+        logger.info(f"Состояние безопасности хранится в SQLite: {STORAGE_CONFIG['SQLITE_PATH']}")
+        return SQLiteSecurityStorage()
+    if backend != 'memory':
+        logger.warning(f"Неизвестное хранилище безопасности {backend}, используется memory")
+    return MemorySecurityStorage()
@@ -0,0 +1,438 @@
+# supervisor.py
+import os
+import sys
+import hmac
+import json
+import time
+import signal
+import asyncio
+import logging
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+
+from metrics import METRICS_CONFIG, MetricsRegistry, merge_expositions
+
+logger = logging.getLogger(__name__)
+
+# Настройки многопроцессного режима
+SUPERVISOR_CONFIG = {
+    'WORKERS': int(os.getenv("BOT_WORKERS", "1")),
+    'HOST': os.getenv("BOT_HOST", "0.0.0.0"),
+    'PORT': int(os.getenv("PORT", "10000")),
+    'WORKER_BASE_PORT': int(os.getenv("BOT_WORKER_BASE_PORT", "10100")),  # воркер i слушает base + i на 127.0.0.1
+    'WEBHOOK_SECRET': os.getenv("WEBHOOK_SECRET", "default_secret_token"),
+    'ADMIN_TOKEN': os.getenv("ADMIN_TOKEN"),  # без него маршруты администрирования не подключаются
+    'START_TIMEOUT': float(os.getenv("BOT_WORKER_START_TIMEOUT", "60")),  # ожидание готовности воркера (сек)
+    'STOP_TIMEOUT': float(os.getenv("BOT_WORKER_STOP_TIMEOUT", "20")),  # ожидание завершения перед kill (сек)
+    'FORWARD_TIMEOUT': float(os.getenv("BOT_FORWARD_TIMEOUT", "10")),
+    'ADMIN_PROXY_TIMEOUT': 120.0,  # профилирование воркера длится до PROFILE_MAX_SECONDS
+    'MAX_BUFFERED': int(os.getenv("BOT_WORKER_MAX_BUFFERED", "1000")),  # обновлений на время перезапуска воркера
+    'FAST_BOOT': os.getenv("FAST_BOOT", "0") == "1",  # порт фронта открывается до запуска воркеров
+    'MONITOR_INTERVAL': 1.0,
+    'LATENCY_WINDOW': 512,
+}
+
+# Поля обновления, из которых берется отправитель (первое найденное)
+ROUTING_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query',
+                  'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member')
+
+def get_routing_key(data):
+    """Ключ маршрутизации обновления: пользователь, иначе чат, иначе номер обновления.
+
+    Работает с сырым JSON, чтобы фронт не тратил время на Update.de_json.
+    """
+    for field in ROUTING_FIELDS:
+        payload = data.get(field)
+        if not payload:
+            continue
+        sender = payload.get('from')
+        if sender and 'id' in sender:
+            return int(sender['id'])
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat and 'id' in chat:
+            return int(chat['id'])
+    return int(data.get('update_id', 0))
+
+class WorkerProcess:
+    """Дочерний процесс бота и его статистика глазами супервизора"""
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process = None
+        self.state = 'stopped'  # starting | draining | ready | restarting | failed | stopped
+        self.started_at = None
+        self.restarts = 0
+        self.in_flight = 0
+        self.buffer = deque()  # (body, received_at) на время перезапуска
+        self.lock = asyncio.Lock()  # один перезапуск за раз
+        self.latencies = deque(maxlen=SUPERVISOR_CONFIG['LATENCY_WINDOW'])
+        self.stats = {'forwarded': 0, 'errors': 0, 'rejected': 0, 'buffered': 0}
+
+    def get_stats(self):
+        ordered = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 1)
+
+        stats = dict(self.stats)
+        stats.update({
+            'index': self.index,
+            'pid': self.process.pid if self.process else None,
+            'port': self.port,
+            'state': self.state,
+            'uptime': round(time.monotonic() - self.started_at, 1) if self.started_at else 0.0,
+            'restarts': self.restarts,
+            'in_flight': self.in_flight,
+            'buffer': len(self.buffer),
+            'forward_p50_ms': percentile(0.5),
+            'forward_p99_ms': percentile(0.99),
+        })
+        return stats
+
+class Supervisor:
+    """Фронт-процесс: запускает N воркеров и направляет обновления одного пользователя в один воркер.
+
+    Воркер выбирается как ключ маршрутизации по модулю числа воркеров, поэтому очереди
+    сообщений, история и состояние безопасности пользователя остаются внутри одного процесса.
+    Пока воркер перезапускается, его обновления копятся в буфере и доставляются
+    по порядку после того, как новый процесс ответит на /health.
+    """
+
+    def __init__(self, workers=None):
+        self.config = SUPERVISOR_CONFIG
+        count = workers or self.config['WORKERS']
+        self.workers = [WorkerProcess(i, self.config['WORKER_BASE_PORT'] + i) for i in range(count)]
+        self.session = None
+        self.monitor_task = None
+        self.start_task = None
+        self.stopping = False
+        self.stats = {'received': 0, 'invalid': 0}
+        # Запуск модулем: bot.py тоже загружается из скомпилированного байткода
+        self.directory = os.path.dirname(os.path.abspath(__file__))
+        self.command = [sys.executable, "-u", "-m", "bot"]
+
+    def pick_worker(self, routing_key):
+        return self.workers[routing_key % len(self.workers)]
+
+    # ---------- Жизненный цикл воркеров ----------
+
+    def _worker_env(self, worker):
+        env = dict(os.environ)
+        env.update({
+            'BOT_ROLE': 'worker',
+            'BOT_WORKER_ID': str(worker.index),
+            'PORT': str(worker.port),
+            # Вебхук устанавливает только первый воркер, остальные его не трогают
+            'BOT_SET_WEBHOOK': '1' if worker.index == 0 else '0',
+        })
+        # Лимит Telegram общий на бота - делим его между воркерами
+        if 'OUTBOUND_GLOBAL_RATE' not in os.environ:
+            env['OUTBOUND_GLOBAL_RATE'] = str(30 / len(self.workers))
+            env['OUTBOUND_GLOBAL_BURST'] = str(max(1, 30 // len(self.workers)))
+        return env
+
+    async def _spawn(self, worker):
+        worker.state = 'starting'
+        worker.process = await asyncio.create_subprocess_exec(*self.command, env=self._worker_env(worker),
+                                                              cwd=self.directory)
+        worker.started_at = time.monotonic()
+        logger.info(f"Воркер {worker.index} запущен: pid {worker.process.pid}, порт {worker.port}")
+
+        if not await self._wait_ready(worker):
+            worker.state = 'failed'
+            raise RuntimeError(f"Воркер {worker.index} не ответил за {self.config['START_TIMEOUT']} сек")
+
+        # Сначала накопленные обновления, затем новые - порядок сохраняется
+        worker.state = 'draining'
+        await self._drain_buffer(worker)
+        if worker.state == 'draining':
+            worker.state = 'ready'
+
+    async def _wait_ready(self, worker):
+        deadline = time.monotonic() + self.config['START_TIMEOUT']
+        while time.monotonic() < deadline:
+            if worker.process.returncode is not None:
+                return False
+            try:
+                async with self.session.get(f"{worker.url}/health", timeout=aiohttp.ClientTimeout(total=1)) as response:
+                    if response.status == 200:
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(0.2)
+        return False
+
+    async def _terminate(self, worker):
+        """Мягкая остановка: SIGTERM (воркер дожидается своей очереди), по таймауту - kill"""
+        process = worker.process
+        if process is None or process.returncode is not None:
+            return
+        process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self.config['STOP_TIMEOUT'])
+        except asyncio.TimeoutError:
+            logger.warning(f"Воркер {worker.index} не завершился за {self.config['STOP_TIMEOUT']} сек, kill")
+            process.kill()
+            await process.wait()
+
+    async def restart_worker(self, index):
+        """Перезапуск одного воркера; обновления его пользователей на это время буферизуются"""
+        worker = self.workers[index]
+        async with worker.lock:
+            worker.state = 'restarting'
+            # Дожидаемся уже отправленных запросов, чтобы не потерять ответы
+            while worker.in_flight:
+                await asyncio.sleep(0.05)
+            await self._terminate(worker)
+            worker.restarts += 1
+            await self._spawn(worker)
+        logger.info(f"Воркер {index} перезапущен")
+
+    async def _monitor(self):
+        """Поднимает воркеры, завершившиеся без команды супервизора"""
+        while not self.stopping:
+            await asyncio.sleep(self.config['MONITOR_INTERVAL'])
+            for worker in self.workers:
+                if worker.state == 'failed' or (worker.state == 'ready' and worker.process.returncode is not None):
+                    logger.error(f"Воркер {worker.index} недоступен (код {worker.process.returncode}), перезапуск")
+                    try:
+                        await self.restart_worker(worker.index)
+                    except Exception as e:
+                        logger.error(f"Не удалось перезапустить воркер {worker.index}: {e}")
+
+    async def _start_workers(self):
+        # Первый воркер устанавливает вебхук - поднимаем его раньше остальных
+        await self._spawn(self.workers[0])
+        await asyncio.gather(*(self._spawn(worker) for worker in self.workers[1:]))
+        logger.info(f"Супервизор запущен: {len(self.workers)} воркеров")
+
+    async def _start_workers_in_background(self):
+        try:
+            await self._start_workers()
+        except Exception as e:
+            # Не поднявшиеся воркеры в состоянии failed - их перезапустит монитор
+            logger.error(f"Ошибка запуска воркеров: {e}")
+
+    async def start(self, app=None):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=60)
+        )
+        if self.config['FAST_BOOT']:
+            # Обновления, пришедшие до готовности воркеров, ждут в их буферах
+            self.start_task = asyncio.create_task(self._start_workers_in_background())
+        else:
+            await self._start_workers()
+        self.monitor_task = asyncio.create_task(self._monitor())
+
+    async def stop(self, app=None):
+        self.stopping = True
+        for task in (self.start_task, self.monitor_task):
+            if task is not None:
+                task.cancel()
+        for worker in self.workers:
+            worker.state = 'stopped'
+        await asyncio.gather(*(self._terminate(worker) for worker in self.workers), return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+    # ---------- Пересылка обновлений ----------
+
+    async def _forward(self, worker, body):
+        """Отправляет обновление воркеру, возвращает HTTP-статус его ответа"""
+        worker.in_flight += 1
+        start_time = time.monotonic()
+        try:
+            async with self.session.post(
+                f"{worker.url}/", data=body,
+                headers={'Content-Type': 'application/json',
+                         'X-Telegram-Bot-Api-Secret-Token': self.config['WEBHOOK_SECRET']},
+                timeout=aiohttp.ClientTimeout(total=self.config['FORWARD_TIMEOUT'])
+            ) as response:
+                await response.read()
+                worker.stats['forwarded'] += 1
+                return response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            worker.stats['errors'] += 1
+            logger.error(f"Ошибка пересылки обновления воркеру {worker.index}: {e}")
+            return 502
+        finally:
+            worker.in_flight -= 1
+            worker.latencies.append(time.monotonic() - start_time)
+
+    async def _drain_buffer(self, worker):
+        while worker.buffer:
+            body, _ = worker.buffer[0]
+            if await self._forward(worker, body) == 502:
+                # Воркер снова недоступен - остаток буфера дождется следующего перезапуска
+                worker.state = 'failed'
+                return
+            worker.buffer.popleft()
+
+    def _buffer(self, worker, body):
+        if len(worker.buffer) >= self.config['MAX_BUFFERED']:
+            worker.stats['rejected'] += 1
+            return False
+        worker.buffer.append((body, time.monotonic()))
+        worker.stats['buffered'] += 1
+        return True
+
+    async def handle_webhook(self, request):
+        """Прием вебхука и пересылка воркеру пользователя"""
+        received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(received, self.config['WEBHOOK_SECRET']):
+            logger.warning("Invalid webhook secret token")
+            return web.Response(text="Invalid token", status=403)
+
+        body = await request.read()
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.stats['invalid'] += 1
+            return web.Response(text="Invalid JSON", status=400)
+        self.stats['received'] += 1
+
+        worker = self.pick_worker(get_routing_key(data))
+        # Пока есть буфер, новые обновления встают за ним, чтобы не нарушить порядок
+        if worker.state != 'ready' or worker.buffer:
+            if not self._buffer(worker, body):
+                return web.Response(text="Worker is restarting", status=429)
+            return web.Response(text="OK")
+
+        status = await self._forward(worker, body)
+        if status == 502:
+            # Воркер недоступен - сохраняем обновление до его перезапуска
+            return web.Response(text="OK") if self._buffer(worker, body) else web.Response(text="Worker unavailable", status=429)
+        return web.Response(text="OK" if status == 200 else "Worker error", status=status)
+
+    # ---------- Администрирование ----------
+
+    def _authorized(self, request):
+        token = self.config['ADMIN_TOKEN']
+        return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+    async def _fetch_worker_stats(self, worker):
+        if worker.state != 'ready':
+            return None
+        try:
+            async with self.session.get(f"{worker.url}/stats", timeout=aiohttp.ClientTimeout(total=2)) as response:
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+
+    async def handle_workers(self, request):
+        """Отчет о нагрузке по воркерам: данные супервизора и собственная статистика процесса"""
+        if not self._authorized(request):
+            return web.Response(text="Forbidden", status=403)
+        reports = await asyncio.gather(*(self._fetch_worker_stats(worker) for worker in self.workers))
+        workers = []
+        for worker, report in zip(self.workers, reports):
+            stats = worker.get_stats()
+            stats['report'] = report
+            workers.append(stats)
+        return web.json_response({'supervisor': self.stats, 'workers': workers})
+
+    async def _fetch_worker_metrics(self, worker, headers):
+        if worker.state != 'ready':
+            return None
+        try:
+            async with self.session.get(f"{worker.url}/metrics", headers=headers,
+                                        timeout=aiohttp.ClientTimeout(total=2)) as response:
+                if response.status != 200:
+                    return None
+                return await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    async def handle_metrics(self, request):
+        """Метрики всех воркеров одним ответом (у каждой серии есть метка worker)"""
+        token = METRICS_CONFIG['TOKEN']
+        headers = {}
+        if token:
+            header = request.headers.get('Authorization', '')
+            received = header[7:] if header.startswith('Bearer ') else request.headers.get('X-Admin-Token', '')
+            if not hmac.compare_digest(received, token):
+                return web.Response(text="Forbidden", status=403)
+            headers['Authorization'] = f"Bearer {token}"
+        texts = await asyncio.gather(*(self._fetch_worker_metrics(worker, headers) for worker in self.workers))
+        return web.Response(body=merge_expositions(text for text in texts if text).encode(),
+                            headers={'Content-Type': MetricsRegistry.CONTENT_TYPE})
+
+    async def handle_worker_admin(self, request):
+        """Диагностика воркера (трассы, профилирование): /workers/{index}/admin/..."""
+        if not self._authorized(request):
+            return web.Response(text="Forbidden", status=403)
+        try:
+            worker = self.workers[int(request.match_info['index'])]
+        except (ValueError, IndexError):
+            return web.Response(text="Unknown worker", status=404)
+        if worker.state != 'ready':
+            return web.Response(text="Worker is not ready", status=503)
+
+        try:
+            async with self.session.request(
+                request.method, f"{worker.url}/admin/{request.match_info['path']}", params=request.query,
+                headers={'X-Admin-Token': request.headers.get('X-Admin-Token', '')},
+                timeout=aiohttp.ClientTimeout(total=self.config['ADMIN_PROXY_TIMEOUT'])
+            ) as response:
+                body = await response.read()
+                return web.Response(body=body, status=response.status,
+                                    content_type=response.content_type, charset=response.charset)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return web.Response(text=f"Worker error: {e}", status=502)
+
+    async def handle_restart(self, request):
+        """Мягкий перезапуск воркера: POST /workers/{index}/restart"""
+        if not self._authorized(request):
+            return web.Response(text="Forbidden", status=403)
+        try:
+            index = int(request.match_info['index'])
+            self.workers[index]
+        except (ValueError, IndexError):
+            return web.Response(text="Unknown worker", status=404)
+
+        try:
+            await self.restart_worker(index)
+        except Exception as e:
+            logger.error(f"Не удалось перезапустить воркер {index}: {e}")
+            return web.json_response({'restarted': False, 'error': str(e)}, status=500)
+        return web.json_response({'restarted': True, 'worker': self.workers[index].get_stats()})
+
+    async def handle_health(self, request):
+        ready = sum(1 for worker in self.workers if worker.state in ('ready', 'draining'))
+        status = 200 if ready else 503
+        return web.Response(text=f"✅ Supervisor: {ready}/{len(self.workers)} workers ready", status=status)
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/", self.handle_webhook)
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_get("/", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        if self.config['ADMIN_TOKEN']:
+            app.router.add_get("/workers", self.handle_workers)
+            app.router.add_post("/workers/{index}/restart", self.handle_restart)
+            app.router.add_route("*", "/workers/{index}/admin/{path:.+}", self.handle_worker_admin)
+        else:
+            logger.info("ADMIN_TOKEN не задан: маршруты /workers отключены")
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
+
+def run_supervisor(workers=None):
+    """Запуск фронт-процесса с воркерами"""
+    supervisor = Supervisor(workers)
+    if os.getenv("SECURITY_STORAGE", "memory") == "memory":
+        logger.warning("Общий лимит запросов считается в каждом воркере отдельно; "
+                       "для единого лимита задайте SECURITY_STORAGE=sqlite")
+    web.run_app(supervisor.create_app(), host=supervisor.config['HOST'], port=supervisor.config['PORT'])
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    exit(run_supervisor())
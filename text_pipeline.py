@@ -0,0 +1,160 @@
+# text_pipeline.py
+import re
+
+# Специальные символы MarkdownV2, включая обратную косую черту
+MARKDOWN_V2_SPECIAL = re.compile(r'([_*\[\]()~`>#+\-=|{}.!\\])')
+
+# Экранированный символ или маркер жирного шрифта в уже размеченном тексте
+_MARKUP_TOKEN = re.compile(r'\\.|\*', re.DOTALL)
+
+# Структура строк ответа модели; правила применяются к уже экранированному тексту.
+# Подзаголовок в начале строки: "Стоимость:", "Срок службы:" (но не "https://")
+_LABEL = r'[^\W\d_][^\W_]*(?:(?: |\\-)[^\W_]+){0,3}:(?=\s|$)'
+_LINE_RULES = re.compile(
+    rf'^(?:(?P<bullet>[ \t]*(?:\\-|•|\\\*)[ \t]+)(?=\S)(?P<bullet_label>{_LABEL})?'
+    rf'|(?P<number>[ \t]*\d+)\\[.)][ \t]+(?=\S)(?P<item>[^\n]*)'
+    rf'|(?P<label>{_LABEL}))',
+    re.MULTILINE,
+)
+# **Жирный** в стиле Markdown, который модель ставит сама (внутри - без маркеров бота)
+_MODEL_BOLD = re.compile(r'\\\*\\\*((?:\\.|[^\\*\n])+?)\\\*\\\*')
+_MODEL_BOLD_MARKER = '\\*\\*'
+_WORD = re.compile(r'\w+')
+
+def escape_markdown_v2(text: str) -> str:
+    """Экранирует специальные символы MarkdownV2"""
+    return MARKDOWN_V2_SPECIAL.sub(r'\\\1', text)
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+def truncate_markdown_v2(text: str, limit: int, suffix: str = r"\.\.\.") -> str:
+    """Обрезает размеченный текст, не разрывая экранирование и жирный шрифт"""
+    if len(text) <= limit:
+        return text
+    limit = max(0, limit - len(suffix))
+    cut = text.rfind('\n', 0, limit + 1)
+    if cut > 0:
+        # Каждая строка размечена независимо - обрезка по строке всегда корректна
+        return text[:cut].rstrip() + suffix
+
+    # Режем строку вне экранирования, оставляя место для закрытия жирного шрифта
+    cut = max(0, limit - 1)
+    bold_start = None
+    for match in _MARKUP_TOKEN.finditer(text, 0, cut + 1):
+        if match.start() >= cut:
+            break
+        if match.end() > cut:
+            cut = match.start()
+            break
+        if match.group() == '*':
+            bold_start = None if bold_start is not None else match.start()
+    if bold_start is None:
+        result = text[:cut]
+    elif bold_start == cut - 1:
+        result = text[:bold_start]  # пустой жирный фрагмент недопустим
+    else:
+        result = text[:cut] + '*'
+    return result + suffix
+
+class TermRewriter:
+    """Замена бытовых терминов профессиональными за один проход по строке.
+
+    Все термины собраны в одну альтернативу; замена происходит только для целого слова,
+    поэтому "скол" не задевает "сколько", а "чистка" - "химчистку". Первая буква термина
+    может быть заглавной, регистр сохраняется в замене. Термин не заменяется, если перед ним
+    уже стоит слово из замены: "керамическое покрытие" остается как есть.
+    """
+
+    def __init__(self, mapping):
+        self.mapping = {term.lower(): replacement for term, replacement in mapping.items()}
+        self.guards = {
+            term: {word.lower() for word in _WORD.findall(replacement)} - {term}
+            for term, replacement in self.mapping.items()
+        }
+        # Без IGNORECASE и проверок границ в самом шаблоне: альтернатива из литералов
+        # ищется быстро, а границы слова проверяются только для найденных совпадений
+        alternation = '|'.join(
+            re.escape(variant)
+            for term in sorted(self.mapping, key=len, reverse=True)
+            for variant in (term, term[0].upper() + term[1:])
+        )
+        self.pattern = re.compile(alternation)
+
+    def _replace(self, match):
+        found = match.group()
+        text = match.string
+        start, end = match.span()
+        if (start and _is_word_char(text[start - 1])) or (end < len(text) and _is_word_char(text[end])):
+            return found
+        term = found.lower()
+        previous = text[max(0, start - 40):start].split()
+        if previous and previous[-1].lower() in self.guards[term]:
+            return found
+        replacement = self.mapping[term]
+        if found[0].isupper():
+            replacement = replacement[0].upper() + replacement[1:]
+        return replacement
+
+    def rewrite(self, text: str) -> str:
+        return self.pattern.sub(self._replace, text)
+
+class MarkdownV2Formatter:
+    """Разметка ответа модели для Telegram MarkdownV2 с предкомпилированными правилами.
+
+    Текст экранируется целиком один раз, после чего маркеры жирного шрифта ставятся вокруг
+    уже экранированных фрагментов, поэтому разметка всегда парная и не ломает экранирование.
+    Всего три прохода: экранирование, правила строк и **жирный** от модели (если он есть):
+    - пункты списков "-", "*", "•" приводятся к "• ";
+    - в нумерованных пунктах выделяется заголовок до двоеточия, а без него - весь пункт;
+    - выделяется подзаголовок в начале строки ("Стоимость:");
+    - **жирный** от модели превращается в жирный шрифт MarkdownV2.
+    """
+
+    def format(self, text: str) -> str:
+        text = _LINE_RULES.sub(self._format_line, escape_markdown_v2(text))
+        if _MODEL_BOLD_MARKER in text:
+            text = _MODEL_BOLD.sub(self._format_model_bold, text)
+        return text
+
+    def _format_line(self, match):
+        bullet = match.group('bullet')
+        if bullet is not None:
+            label = match.group('bullet_label')
+            return '• ' + _bold(label) if label else '• '
+
+        number = match.group('number')
+        if number is not None:
+            item = match.group('item')
+            head, colon, tail = item.partition(':')
+            if colon and head.strip():
+                # "1. **Мойка:** текст" - маркеры модели вокруг заголовка поглощаются
+                if tail.startswith(_MODEL_BOLD_MARKER):
+                    tail = tail[len(_MODEL_BOLD_MARKER):]
+                return f"{number}\\. {_bold(head + colon)}{tail}"
+            return f"{number}\\. {_bold(item)}"
+
+        return _bold(match.group('label'))
+
+    @staticmethod
+    def _format_model_bold(match):
+        return _bold(match.group(1))
+
+def _bold(escaped):
+    """Жирный шрифт для экранированного фрагмента; вложенный жирный в MarkdownV2 недопустим"""
+    escaped = escaped.replace(_MODEL_BOLD_MARKER, '')
+    if not escaped.strip():
+        return escaped
+    return f"*{escaped}*"
+
+class TextPipeline:
+    """Постобработка ответа: замена терминов и разметка MarkdownV2 с предкомпилированными правилами"""
+
+    def __init__(self, term_mapping=None):
+        self.terms = TermRewriter(term_mapping) if term_mapping else None
+        self.formatter = MarkdownV2Formatter()
+
+    def process(self, text: str) -> str:
+        if self.terms is not None:
+            text = self.terms.rewrite(text)
+        return self.formatter.format(text)
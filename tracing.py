@@ -0,0 +1,193 @@
+# tracing.py
+import os
+import time
+import contextvars
+from collections import deque
+
+# Настройки трассировки обновлений
+TRACING_CONFIG = {
+    'ENABLED': os.getenv("TRACING_ENABLED", "1") == "1",
+    'SLOW_THRESHOLD': float(os.getenv("TRACE_SLOW_THRESHOLD", "5.0")),  # трассы дольше (сек) сохраняются
+    'RING_SIZE': int(os.getenv("TRACE_RING_SIZE", "200")),  # сколько медленных трасс хранить
+    'MAX_ACTIVE': int(os.getenv("TRACE_MAX_ACTIVE", "5000")),  # незавершенных трасс; сверх - без трассировки
+    'ACTIVE_TTL': 600,  # незавершенная трасса старше этого считается потерянной (сек)
+    'MAX_SPANS': 64,  # этапов в одной трассе (правки потокового ответа не раздувают трассу)
+}
+
+# Трасса обновления, которое обрабатывается в текущей задаче
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class Trace:
+    """Трасса одного обновления: этапы с временем начала и длительностью.
+
+    Время - time.perf_counter(). Трассу завершает тот, кто обработал обновление последним:
+    диспетчер, а для текстовых сообщений - буфер сообщений после отправки ответа (deferred).
+    """
+    __slots__ = ('update_id', 'started', 'started_at', 'finished', 'cursor', 'spans', 'attrs', 'deferred')
+
+    def __init__(self, update_id, started=None):
+        self.update_id = update_id
+        self.started = started if started is not None else time.perf_counter()
+        self.started_at = time.time()
+        self.finished = None
+        self.cursor = self.started  # окончание последнего записанного этапа
+        self.spans = []  # (name, start, end, attrs)
+        self.attrs = {}
+        self.deferred = False
+
+    def add_span(self, name, start, end=None, **attrs):
+        end = end if end is not None else time.perf_counter()
+        if len(self.spans) >= TRACING_CONFIG['MAX_SPANS']:
+            self.attrs['dropped_spans'] = self.attrs.get('dropped_spans', 0) + 1
+        else:
+            self.spans.append((name, start, end, attrs))
+        self.cursor = max(self.cursor, end)
+
+    def span(self, name, **attrs):
+        return _SpanContext(self, name, attrs)
+
+    def duration(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self):
+        return {
+            'update_id': self.update_id,
+            'started_at': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            'duration_ms': round(self.duration() * 1000, 1),
+            'attrs': self.attrs,
+            'spans': [
+                dict(attrs, name=name, offset_ms=round((start - self.started) * 1000, 1),
+                     duration_ms=round((end - start) * 1000, 1))
+                for name, start, end, attrs in self.spans
+            ],
+        }
+
+class _SpanContext:
+    __slots__ = ('trace', 'name', 'attrs', 'start')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.trace.add_span(self.name, self.start, **self.attrs)
+        return False
+
+class _NoopSpan:
+    """Этап вне трассы: ничего не записывает"""
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class Tracer:
+    """Трассы обновлений от вебхука до отправки ответа и кольцо последних медленных трасс.
+
+    Трасса создается в handle_webhook и хранится по update_id, пока обновление ждет
+    в очереди диспетчера; дальше она передается через contextvars, поэтому этапы
+    записываются вызовом tracer.record или tracer.span без передачи трассы по цепочке.
+    В памяти остаются только медленные трассы (не больше RING_SIZE).
+    """
+
+    def __init__(self, config=None):
+        self.config = config or TRACING_CONFIG
+        self.active = {}  # update_id: Trace (ожидают обработки)
+        self.slow = deque(maxlen=self.config['RING_SIZE'])
+        self.stats = {'started': 0, 'finished': 0, 'slow': 0, 'skipped': 0, 'discarded': 0, 'expired': 0}
+
+    def start(self, update_id, started=None):
+        """Новая трасса обновления; None - трассировка выключена или незавершенных трасс слишком много"""
+        if not self.config['ENABLED'] or update_id is None:
+            return None
+        if len(self.active) >= self.config['MAX_ACTIVE']:
+            self.stats['skipped'] += 1
+            return None
+        trace = self.active[update_id] = Trace(update_id, started)
+        self.stats['started'] += 1
+        return trace
+
+    def take(self, update_id):
+        """Забирает трассу обновления, дошедшего до обработки"""
+        return self.active.pop(update_id, None)
+
+    def discard(self, update_id):
+        """Обновление отклонено - трасса не нужна"""
+        if self.active.pop(update_id, None) is not None:
+            self.stats['discarded'] += 1
+
+    def defer(self):
+        """Завершение текущей трассы передается дальше (сообщение ждет в буфере)"""
+        trace = current_trace.get()
+        if trace is not None:
+            trace.deferred = True
+        return trace
+
+    def finish(self, trace):
+        if trace is None or trace.finished is not None:
+            return
+        trace.finished = time.perf_counter()
+        self.stats['finished'] += 1
+        if trace.finished - trace.started >= self.config['SLOW_THRESHOLD']:
+            self.slow.append(trace)
+            self.stats['slow'] += 1
+
+    def record(self, name, start, end=None, **attrs):
+        """Записывает этап текущей трассы (если она есть)"""
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span(name, start, end, **attrs)
+
+    def span(self, name, **attrs):
+        """Контекстный менеджер этапа текущей трассы"""
+        trace = current_trace.get()
+        return trace.span(name, **attrs) if trace is not None else _NOOP_SPAN
+
+    def annotate(self, **attrs):
+        trace = current_trace.get()
+        if trace is not None:
+            trace.attrs.update(attrs)
+
+    def evict_stale(self, now=None):
+        """Удаляет трассы обновлений, которые так и не дошли до обработки"""
+        now = now if now is not None else time.perf_counter()
+        stale = [update_id for update_id, trace in self.active.items()
+                 if now - trace.started > self.config['ACTIVE_TTL']]
+        for update_id in stale:
+            del self.active[update_id]
+        self.stats['expired'] += len(stale)
+        return len(stale)
+
+    def get_slow(self, limit=None, min_duration=None):
+        """Последние медленные трассы, новые первыми"""
+        traces = [trace for trace in reversed(self.slow)
+                  if min_duration is None or trace.duration() >= min_duration]
+        return [trace.to_dict() for trace in traces[:limit]]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['active'] = len(self.active)
+        stats['slow_kept'] = len(self.slow)
+        stats['slow_threshold'] = self.config['SLOW_THRESHOLD']
+        return stats
+
+# Глобальный экземпляр
+tracer = Tracer()
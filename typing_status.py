@@ -0,0 +1,111 @@
+# typing_status.py
+import os
+import math
+import time
+import logging
+
+from expiry_scheduler import ExpiryScheduler
+from outbound_scheduler import outbound
+
+logger = logging.getLogger(__name__)
+
+# Настройки статуса "печатает"
+TYPING_CONFIG = {
+    'REFRESH_AFTER': float(os.getenv("TYPING_REFRESH_AFTER", "4.5")),  # Telegram скрывает статус через 5 сек
+    'TICK': float(os.getenv("TYPING_TICK", "0.5")),  # шаг сетки обновлений: чаты обновляются пачками
+    'MAX_DURATION': float(os.getenv("TYPING_MAX_DURATION", "120")),  # страховка от забытого unregister (сек)
+}
+
+class _ChatTyping:
+    __slots__ = ('bot', 'holders', 'until', 'hold_deadline', 'sent_at')
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.holders = 0  # регистрации до явного unregister
+        self.until = 0.0  # регистрации на время
+        self.hold_deadline = 0.0
+        self.sent_at = 0.0
+
+class TypingStatus:
+    """Статус "печатает" для всех чатов из одной фоновой задачи.
+
+    Обработчики регистрируют чат (до unregister или до момента until), повторные регистрации
+    того же чата только продлевают статус. Обновления назначаются на общую сетку с шагом TICK
+    чуть раньше истечения статуса, поэтому планировщик отправляет их пачками, а не по таймеру
+    на каждый чат.
+    """
+
+    def __init__(self):
+        self.config = TYPING_CONFIG
+        self.chats = {}
+        self.scheduler = ExpiryScheduler()
+        self.scheduler.register('refresh', self._refresh)
+        self.stats = {'registrations': 0, 'deduplicated': 0, 'actions': 0, 'released': 0}
+
+    def register(self, bot, chat_id, duration=None):
+        """Чат "печатает" до unregister (duration=None) или в течение duration секунд"""
+        now = time.time()
+        self.stats['registrations'] += 1
+        state = self.chats.get(chat_id)
+        is_new = state is None
+        if is_new:
+            state = self.chats[chat_id] = _ChatTyping(bot)
+
+        if duration is None:
+            state.holders += 1
+            state.hold_deadline = now + self.config['MAX_DURATION']
+        else:
+            state.until = max(state.until, now + duration)
+
+        if is_new or now - state.sent_at >= self.config['REFRESH_AFTER']:
+            self._send(chat_id, state, now)
+        else:
+            # Статус уже показан - повторный запрос не нужен
+            self.stats['deduplicated'] += 1
+
+    def unregister(self, chat_id):
+        """Снимает одну регистрацию без срока; статус гаснет сам, когда регистраций не остается"""
+        state = self.chats.get(chat_id)
+        if state is None or not state.holders:
+            return
+        state.holders -= 1
+        if not self._is_active(state, time.time()):
+            self._release(chat_id)
+
+    def _is_active(self, state, now):
+        return (state.holders and now < state.hold_deadline) or now < state.until
+
+    def _send(self, chat_id, state, now):
+        outbound.send_chat_action(state.bot, chat_id)
+        state.sent_at = now
+        self.stats['actions'] += 1
+        # Следующее обновление - на ближайшем шаге сетки до истечения статуса
+        tick = self.config['TICK']
+        refresh_at = math.floor((now + self.config['REFRESH_AFTER']) / tick) * tick
+        self.scheduler.schedule('refresh', chat_id, max(refresh_at, now + tick))
+
+    def _refresh(self, chat_id, now):
+        state = self.chats.get(chat_id)
+        if state is None:
+            return
+        if self._is_active(state, now):
+            self._send(chat_id, state, now)
+        else:
+            self._release(chat_id)
+
+    def _release(self, chat_id):
+        del self.chats[chat_id]
+        self.scheduler.cancel('refresh', chat_id)
+        self.stats['released'] += 1
+
+    async def stop(self):
+        await self.scheduler.stop()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['active_chats'] = len(self.chats)
+        stats['scheduler'] = self.scheduler.get_stats()
+        return stats
+
+# Глобальный экземпляр
+typing_status = TypingStatus()
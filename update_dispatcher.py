@@ -0,0 +1,140 @@
+# update_dispatcher.py
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Настройки диспетчера обновлений
+DISPATCHER_CONFIG = {
+    'WORKERS': int(os.getenv("DISPATCH_WORKERS", "16")),  # сколько обновлений обрабатывается одновременно
+    'MAX_PENDING': int(os.getenv("DISPATCH_MAX_PENDING", "1000")),  # всего обновлений в очереди
+    'MAX_PENDING_PER_CHAT': int(os.getenv("DISPATCH_MAX_PENDING_PER_CHAT", "50")),
+    'DRAIN_TIMEOUT': float(os.getenv("DISPATCH_DRAIN_TIMEOUT", "10")),  # ожидание очереди при остановке (сек)
+    'LATENCY_WINDOW': 1024,
+}
+
+def get_chat_key(update):
+    """Ключ упорядочивания: чат, иначе пользователь, иначе само обновление"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return f"user:{update.effective_user.id}"
+    return f"update:{update.update_id}"
+
+class UpdateDispatcher:
+    """Пул обработчиков: параллельно между чатами, строго по порядку внутри одного чата.
+
+    У каждого чата своя очередь. Чат с ожидающими обновлениями стоит в общей очереди
+    готовых чатов не более одного раза, поэтому обновления одного чата никогда
+    не обрабатываются двумя воркерами одновременно. После каждого обновления чат
+    возвращается в конец очереди, что дает справедливое чередование между чатами.
+    """
+
+    def __init__(self, process, workers=None, max_pending=None, max_pending_per_chat=None):
+        self.config = DISPATCHER_CONFIG
+        self.process = process
+        self.workers_count = workers or self.config['WORKERS']
+        self.max_pending = max_pending or self.config['MAX_PENDING']
+        self.max_pending_per_chat = max_pending_per_chat or self.config['MAX_PENDING_PER_CHAT']
+
+        self.chat_queues = {}  # chat_key: deque of (update, enqueued_at)
+        self.ready = None
+        self.workers = []
+        self.pending = 0
+        self.in_progress = 0
+        self.dispatch_latencies = deque(maxlen=self.config['LATENCY_WINDOW'])
+        self.processing_times = deque(maxlen=self.config['LATENCY_WINDOW'])
+        self.stats = {'submitted': 0, 'processed': 0, 'rejected': 0, 'errors': 0, 'max_pending_seen': 0}
+
+    def start(self):
+        """Запускает воркеры (нужен работающий event loop)"""
+        if self.workers:
+            return
+        self.ready = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+        logger.info(f"Диспетчер обновлений запущен: {self.workers_count} воркеров, очередь до {self.max_pending}")
+
+    async def stop(self, drain_timeout=None):
+        """Дожидается обработки очереди (с таймаутом) и останавливает воркеры"""
+        drain_timeout = self.config['DRAIN_TIMEOUT'] if drain_timeout is None else drain_timeout
+        deadline = time.monotonic() + drain_timeout
+        while (self.pending or self.in_progress) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.pending:
+            logger.warning(f"Диспетчер остановлен с необработанными обновлениями: {self.pending}")
+
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, chat_key, update):
+        """Ставит обновление в очередь чата. False - очередь переполнена (нужно вернуть 429)"""
+        queue = self.chat_queues.get(chat_key)
+        if self.pending >= self.max_pending or (queue is not None and len(queue) >= self.max_pending_per_chat):
+            self.stats['rejected'] += 1
+            return False
+
+        if queue is None:
+            # Чат не активен - ставим его в очередь готовых
+            queue = self.chat_queues[chat_key] = deque()
+            self.ready.put_nowait(chat_key)
+
+        queue.append((update, time.monotonic()))
+        self.pending += 1
+        self.stats['submitted'] += 1
+        self.stats['max_pending_seen'] = max(self.stats['max_pending_seen'], self.pending)
+        return True
+
+    async def _worker(self):
+        while True:
+            chat_key = await self.ready.get()
+            queue = self.chat_queues[chat_key]
+            update, enqueued_at = queue.popleft()
+            self.pending -= 1
+            self.in_progress += 1
+
+            start_time = time.monotonic()
+            self.dispatch_latencies.append(start_time - enqueued_at)
+            try:
+                await self.process(update)
+                self.stats['processed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"Ошибка обработки обновления в чате {chat_key}: {e}")
+            finally:
+                self.in_progress -= 1
+                self.processing_times.append(time.monotonic() - start_time)
+
+                # Следующее обновление этого чата - только после текущего
+                if queue:
+                    self.ready.put_nowait(chat_key)
+                else:
+                    del self.chat_queues[chat_key]
+
+    @staticmethod
+    def _percentile(samples, fraction):
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def get_stats(self):
+        """Глубина очереди и задержки диспетчеризации"""
+        stats = dict(self.stats)
+        stats.update({
+            'pending': self.pending,
+            'in_progress': self.in_progress,
+            'active_chats': len(self.chat_queues),
+            'workers': len(self.workers),
+            'dispatch_p50_ms': round(self._percentile(self.dispatch_latencies, 0.5) * 1000, 1),
+            'dispatch_p99_ms': round(self._percentile(self.dispatch_latencies, 0.99) * 1000, 1),
+            'processing_p50_ms': round(self._percentile(self.processing_times, 0.5) * 1000, 1),
+            'processing_p99_ms': round(self._percentile(self.processing_times, 0.99) * 1000, 1),
+        })
+        return stats
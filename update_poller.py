@@ -0,0 +1,149 @@
+# update_poller.py
+import os
+import time
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram.error import Conflict, NetworkError, RetryAfter
+
+from metrics import POLL_SECONDS, POLL_BATCH_UPDATES, POLL_ERRORS
+from tracing import tracer
+from update_dispatcher import get_chat_key
+
+logger = logging.getLogger(__name__)
+
+# Настройки приема обновлений через getUpdates
+POLLING_CONFIG = {
+    'BATCH_SIZE': min(100, int(os.getenv("POLL_BATCH_SIZE", "100"))),  # обновлений за запрос (максимум Telegram - 100)
+    'TIMEOUT': int(os.getenv("POLL_TIMEOUT", "30")),  # long polling: сколько Telegram держит пустой запрос (сек)
+    # Обновлений в очереди и обработке диспетчера; пока окно занято, следующая пачка не запрашивается
+    'CONCURRENCY': int(os.getenv("POLL_CONCURRENCY", "200")),
+    'BACKPRESSURE_DELAY': 0.05,  # пауза, когда окно или очередь чата заполнены (сек)
+    'RETRY_DELAY': 1.0,  # первая пауза после ошибки, дальше удваивается (сек)
+    'MAX_RETRY_DELAY': 30.0,
+}
+
+_POLL_ERRORS = {reason: POLL_ERRORS.labels(reason) for reason in ('retry_after', 'conflict', 'network', 'error')}
+
+class UpdatePoller:
+    """Прием обновлений пачками через getUpdates (long polling) в тот же диспетчер, что и вебхук.
+
+    Смещение (offset) - номер следующего обновления: Telegram считает обновления
+    подтвержденными при запросе с большим offset, поэтому offset сдвигается только
+    после того, как обновление принято диспетчером. Очередь чата заполнена - опрос
+    ждет, а не отбрасывает обновление. Параллельность обработки задает диспетчер
+    (DISPATCH_WORKERS), опрос ограничивает только число обновлений в работе.
+    """
+
+    def __init__(self, bot, dispatcher, allowed_updates=None, config=None):
+        self.config = config or POLLING_CONFIG
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.allowed_updates = allowed_updates
+        self.offset = None
+        self.confirmed = None  # offset последнего запроса getUpdates
+        self.task = None
+        self.stats = {'requests': 0, 'received': 0, 'empty': 0, 'errors': 0, 'conflicts': 0,
+                      'throttled': 0, 'chat_waits': 0, 'max_batch': 0}
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        """Запускает опрос (нужен работающий event loop)"""
+        if self.running:
+            return
+        self.task = asyncio.create_task(self._run())
+        logger.info(f"Опрос getUpdates запущен: пачка до {self.config['BATCH_SIZE']}, "
+                    f"ожидание {self.config['TIMEOUT']} сек, в работе до {self.config['CONCURRENCY']}")
+
+    async def stop(self):
+        """Останавливает опрос и подтверждает принятые обновления"""
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        # Без подтверждения Telegram отдаст последнюю пачку повторно при следующем опросе
+        if self.offset is not None and self.offset != self.confirmed:
+            try:
+                await self.bot.get_updates(offset=self.offset, limit=1, timeout=0,
+                                           allowed_updates=self.allowed_updates)
+                self.confirmed = self.offset
+            except Exception as e:
+                logger.warning(f"Не удалось подтвердить обновления до {self.offset}: {e}")
+        logger.info(f"Опрос getUpdates остановлен, offset {self.offset}")
+
+    def _room(self):
+        return self.config['CONCURRENCY'] - self.dispatcher.pending - self.dispatcher.in_progress
+
+    async def _run(self):
+        delay = self.config['RETRY_DELAY']
+        while True:
+            room = self._room()
+            if room <= 0:
+                self.stats['throttled'] += 1
+                await asyncio.sleep(self.config['BACKPRESSURE_DELAY'])
+                continue
+
+            started = time.perf_counter()
+            offset = self.offset
+            try:
+                updates = await self.bot.get_updates(
+                    offset=offset, limit=min(self.config['BATCH_SIZE'], room),
+                    timeout=self.config['TIMEOUT'], allowed_updates=self.allowed_updates,
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._on_error(e, delay))
+                delay = min(delay * 2, self.config['MAX_RETRY_DELAY'])
+                continue
+            delay = self.config['RETRY_DELAY']
+            self.confirmed = offset
+            POLL_SECONDS.observe(time.perf_counter() - started)
+            POLL_BATCH_UPDATES.observe(len(updates))
+            self.stats['requests'] += 1
+            if not updates:
+                self.stats['empty'] += 1
+                continue
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(updates))
+            await self._submit_batch(updates)
+
+    async def _submit_batch(self, updates):
+        received = time.perf_counter()
+        for update in updates:
+            trace = tracer.start(update.update_id, received)
+            chat_key = get_chat_key(update)
+            while not self.dispatcher.submit(chat_key, update):
+                # Очередь чата (или общая) заполнена: ждем, обновление не теряется
+                self.stats['chat_waits'] += 1
+                await asyncio.sleep(self.config['BACKPRESSURE_DELAY'])
+            if trace is not None:
+                trace.add_span('poll', received, batch=len(updates))
+            self.offset = update.update_id + 1
+            self.stats['received'] += 1
+
+    def _on_error(self, error, delay):
+        """Учитывает ошибку getUpdates и возвращает паузу перед следующим запросом"""
+        self.stats['errors'] += 1
+        if isinstance(error, RetryAfter):
+            _POLL_ERRORS['retry_after'].inc()
+            retry_after = error.retry_after
+            return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+        if isinstance(error, Conflict):
+            # Установлен вебхук или опрос идет из другого процесса
+            self.stats['conflicts'] += 1
+            _POLL_ERRORS['conflict'].inc()
+            logger.error(f"getUpdates отклонен Telegram: {error}")
+            return self.config['MAX_RETRY_DELAY']
+        _POLL_ERRORS['network' if isinstance(error, NetworkError) else 'error'].inc()
+        logger.warning(f"Ошибка getUpdates, повтор через {delay:.0f} сек: {error}")
+        return delay
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats.update({'running': self.running, 'offset': self.offset})
+        return stats